@@ -1,3 +1,40 @@
+import importlib
+
 from .arviz_json import *
-from .pymc_dag import *
-from .pymc3_graph import *
\ No newline at end of file
+from .cache import *
+
+# names of the modules that need xarray, asyncio, or PyMC3 and Theano, which are
+# slow to import (and may not be installed). They are only imported when one of these
+# names is first used, so that processes that only write archives start quickly
+_LAZY_NAMES = {
+    "reader": ["decode_filters", "decode_coord", "decode_dag", "NpzReader", "json_to_arviz"],
+    "aio": ["ArchiveCache", "iter_archive"],
+    "server": ["ArchiveServer", "serve_archive"],
+    "pymc_dag": ["describe_distribution", "get_dag"],
+    "pymc3_graph": ["is_constant", "fold_graph", "model_hash", "ModelGraph"],
+}
+
+# `from arviz_json import *` imports the lazy names too (and so needs PyMC3)
+__all__ = [
+    "NpzWriter",
+    "NpzAppender",
+    "EntryCache",
+    "write_for_js",
+    "fix_dtype",
+    "format_report",
+    "arviz_to_json",
+    "multi_arviz_to_json",
+] + [name for names in _LAZY_NAMES.values() for name in names]
+
+
+def __getattr__(name):
+    for module, names in _LAZY_NAMES.items():
+        if name in names:
+            value = getattr(importlib.import_module(f".{module}", __name__), name)
+            globals()[name] = value
+            return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | {name for names in _LAZY_NAMES.values() for name in names})
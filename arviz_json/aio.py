@@ -0,0 +1,221 @@
+import asyncio
+import json
+import weakref
+from collections import OrderedDict
+
+from .arviz_json import arviz_to_json
+
+
+class ArchiveCache:
+    """
+        An in-process LRU cache of finished archives, for services that export
+        the same models again and again (see `iter_archive`).
+
+        Archives are keyed by the identity of the InferenceData object they
+        were built from, or by an explicit key, and by the export options.
+        When the archives held grow beyond max_bytes, the least recently used
+        are dropped. An archive larger than max_bytes is never cached.
+
+            archives = ArchiveCache(max_bytes=2**28)
+            async for chunk in iter_archive(data, cache=archives, shuffle=True):
+                await response.write(chunk)
+
+        Parameters:
+        -----------
+
+        max_bytes: The maximum total size of the cached archives
+    """
+
+    def __init__(self, max_bytes=2 ** 28):
+        self.max_bytes = max_bytes
+        # {key: (weak reference to the model or None, archive bytes)},
+        # least recently used first
+        self._archives = OrderedDict()
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(inference_data, options, key=None):
+        """Key of the archive of a model exported with options; the model is
+        identified by key if given, and otherwise by its identity"""
+        model = ("id", id(inference_data)) if key is None else ("key", key)
+        return repr(model) + json.dumps(options, sort_keys=True, default=repr)
+
+    def get(self, key, inference_data=None):
+        """Return the cached archive for key, or None. For keys made from the
+        identity of a model, inference_data must be that same model, so that
+        a new object that reuses the id of a collected one never matches"""
+        entry = self._archives.get(key)
+        if entry is not None and entry[0] is not None and entry[0]() is not inference_data:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._archives.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, archive, inference_data=None):
+        """Add a finished archive, dropping the least recently used archives
+        if the cache is now too large"""
+        if len(archive) > self.max_bytes:
+            return
+        self._remove(key)
+        ref = weakref.ref(inference_data) if inference_data is not None else None
+        self._archives[key] = (ref, archive)
+        self._total += len(archive)
+        while self._total > self.max_bytes:
+            self._remove(next(iter(self._archives)))
+
+    def _remove(self, key):
+        entry = self._archives.pop(key, None)
+        if entry is not None:
+            self._total -= len(entry[1])
+
+    def clear(self):
+        """Drop every cached archive"""
+        self._archives.clear()
+        self._total = 0
+
+    def __len__(self):
+        return len(self._archives)
+
+
+class _ReaderGone(Exception):
+    """Raised in the building thread when the reader of the archive has gone"""
+
+
+class _ChunkStream:
+    """Write-only file object that passes what is written to an asyncio queue
+    in chunks of chunk_size bytes. Writing blocks while the queue is full, so
+    the archive is never built far ahead of the reader."""
+
+    def __init__(self, loop, queue, chunk_size, keep=False):
+        self.loop = loop
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        # every chunk sent, if the whole archive is wanted afterwards
+        self.chunks = [] if keep else None
+        self.cancelled = False
+        self.closed = False
+
+    def write(self, data):
+        # once the build has ended, writes (e.g. an abandoned zipfile writing
+        # its end record when it is collected) are dropped
+        if self.closed:
+            return len(data)
+        if self.cancelled:
+            self.closed = True
+            raise _ReaderGone()
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.send()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def send(self, item=None):
+        """Send a chunk of the buffered bytes, or item if given"""
+        if item is None:
+            item = bytes(self.buffer[: self.chunk_size])
+            del self.buffer[: self.chunk_size]
+            if self.chunks is not None:
+                self.chunks.append(item)
+        asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+
+_DONE = object()
+
+
+def _build(inference_data, stream, options):
+    """Build an archive into stream; run in an executor thread. Ends the
+    stream with _DONE, or with the exception that stopped the build"""
+    try:
+        arviz_to_json(inference_data, stream, **options)
+        if stream.buffer:
+            stream.send()
+        stream.send(_DONE)
+    except _ReaderGone:
+        pass
+    except Exception as e:
+        stream.closed = True
+        if not stream.cancelled:
+            stream.send(e)
+    finally:
+        stream.closed = True
+
+
+async def iter_archive(
+    inference_data, chunk_size=2 ** 16, cache=None, key=None, executor=None, **options
+):
+    """
+        Build the archive of an InferenceData object (as `arviz_to_json`) in an
+        executor, without blocking the event loop, and yield it as an async
+        iterator of byte chunks as it is written. A response can start while
+        the rest of the archive is still being built:
+
+            async def handler(request):
+                response = web.StreamResponse(headers={"Content-Type": "application/zip"})
+                await response.prepare(request)
+                async for chunk in iter_archive(data, cache=archives, shuffle=True):
+                    await response.write(chunk)
+                return response
+
+        Building pauses while the reader is more than a few chunks behind, and
+        stops if the iterator is closed early (e.g. the client disconnected).
+        The archive is written to a stream that cannot seek, so its entries
+        carry zip data descriptors; every zip reader handles them.
+
+        Parameters:
+        -----------
+
+        inference_data: An ARviz inference data object
+        chunk_size: Size of the chunks yielded, in bytes (the last may be smaller)
+        cache: An ArchiveCache. A cached archive is yielded without building it
+               again; a newly built archive is added once it is complete
+        key: Identifies the model in the cache, e.g. a name and version, if
+             the same model may be passed as different objects; by default,
+             the identity of inference_data
+        executor: The concurrent.futures.Executor to build in; a thread pool, as
+                  the chunks are passed back in memory. Defaults to the
+                  default executor of the event loop
+        options: Keyword options of `arviz_to_json`, e.g. shuffle=True
+    """
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(inference_data, options, key)
+        cached = cache.get(cache_key, inference_data if key is None else None)
+        if cached is not None:
+            view = memoryview(cached)
+            for start in range(0, len(view), chunk_size):
+                yield bytes(view[start : start + chunk_size])
+            return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=4)
+    stream = _ChunkStream(loop, queue, chunk_size, keep=cache is not None)
+    build = loop.run_in_executor(executor, _build, inference_data, stream, options)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        await build
+        if cache is not None:
+            cache.put(cache_key, b"".join(stream.chunks), inference_data if key is None else None)
+    finally:
+        if not build.done():
+            # the reader has gone: stop the build, unblocking it if it is
+            # waiting for room in the queue
+            stream.cancelled = True
+            while not build.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
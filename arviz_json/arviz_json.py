@@ -1,33 +1,586 @@
-import arviz as az
 import numpy as np
+import hashlib
 import json
+import os
+import re
+import struct
+import time
+import zlib
 import zipfile
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from io import BytesIO
+from itertools import repeat
 
-def write_for_js(npz_file, header, arrays, compressed=True, verbose=False):
-    """Write the data to a JSON file for loading in JS, along with
-    the NPZ file containing the arrays"""
+from .cache import EntryCache
+
+def _json_default(obj):
+    """Convert numpy scalars and arrays (e.g. in attrs) to plain Python types for JSON"""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
-    # dump the arrays to the file output    
+
+def _encode_npy(arr, compressed=True):
+    """Encode an array as an npy file, optionally deflating it as zipfile would.
+    Returns (crc, uncompressed size, payload). Module level so that it can
+    be run in a process pool as well as a thread pool."""
+    f = BytesIO()
+    np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
+    raw = f.getbuffer()
+    crc = zlib.crc32(raw)
     if compressed:
-        np.savez_compressed(npz_file, **arrays)
+        # raw deflate stream, with the same settings as zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        payload = compressor.compress(raw) + compressor.flush()
     else:
-        np.savez(npz_file, **arrays)
+        payload = bytes(raw)
+    return crc, len(raw), payload
 
-    # write JSON to the npz file
-    output = {"inference_data": header}
-    z = zipfile.ZipFile(npz_file, "a")
-    # header data will be in a file called "header.json" inside the zip
-    if compressed:
-        z.writestr("header.json", json.dumps(output), zipfile.ZIP_STORED)
+
+def _npy_parts(arr):
+    """Split an array into its npy header and a byte view of its data, without copying"""
+    arr = np.require(arr, requirements="C")
+    f = BytesIO()
+    np.lib.format.write_array_header_1_0(f, np.lib.format.header_data_from_array_1_0(arr))
+    return f.getvalue(), arr.reshape(-1).view(np.uint8)
+
+
+def _shuffle(arr):
+    """Byte shuffle an array, as in Blosc/HDF5: returns a |u1 array of shape
+    (itemsize, *shape), where plane k holds byte k of every element. The
+    (repetitive) sign and exponent bytes of floats then sit together, so
+    deflate compresses them much better."""
+    arr = np.require(arr, requirements="C")
+    planes = arr.reshape(-1).view(np.uint8).reshape(arr.shape + (arr.dtype.itemsize,))
+    return np.ascontiguousarray(np.moveaxis(planes, -1, 0))
+
+
+def _content_hash(arr):
+    """Hash of the npy encoding of an array (so including its dtype and shape),
+    used as the name of its entry in deduplicated archives"""
+    header, data = _npy_parts(arr)
+    digest = hashlib.blake2b(header, digest_size=16)
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def _cache_key(digest, compressed):
+    """Key of an encoded array in an EntryCache"""
+    return digest + (".deflate" if compressed else ".npy")
+
+
+def _alignment_extra(offset, align):
+    """Extra field padding a local file header ending at offset, so that the
+    entry data starts on a multiple of align. Uses the same extra field
+    (0xD935: 2 byte alignment, then zeros) as Android's zipalign."""
+    padding = -offset % align
+    # the field needs at least 6 bytes (id, size and alignment)
+    if padding < 6:
+        padding += align * ((6 - padding + align - 1) // align)
+    return struct.pack("<HHH", 0xD935, padding - 4, align) + bytes(padding - 6)
+
+
+def _block_slices(shape, itemsize, block_size, chunks=None):
+    """
+        Split an array into blocks of at most block_size bytes (or of one
+        element, if that is larger) that follow each other in C order, so
+        that writing the blocks one after another writes the whole array.
+        Each block is a slab along one axis, for every index of the axes
+        before it. Returns a list of index tuples.
+
+        chunks gives the chunks of the source, if it is stored in chunks
+        (e.g. a dask array, or a chunked netCDF or zarr variable), as a tuple
+        of chunk sizes for each axis, like dask's .chunks. Blocks then start
+        and end on chunk boundaries along the axis they are split on, and
+        hold at least one chunk along it, even if that is more than
+        block_size, so that no block reads part of a chunk that another block
+        reads too. (Chunks that span several indices of the axes before it
+        are still read once for each index, as C order needs.)
+    """
+    # find the first axis whose trailing slab fits in a block
+    axis, slab = len(shape), itemsize
+    while axis > 0 and slab * shape[axis - 1] <= block_size:
+        axis -= 1
+        slab *= shape[axis]
+    if axis == 0:
+        return [()]
+    # split the axis before it into runs of rows
+    split = axis - 1
+    rows = max(1, block_size // slab)
+    if chunks is None:
+        runs = [(start, start + rows) for start in range(0, shape[split], rows)]
     else:
-        z.writestr("header.json", json.dumps(output), zipfile.ZIP_DEFLATED)
+        # runs of whole chunks, of at most rows rows unless a chunk is longer
+        runs, start, stop = [], 0, 0
+        for size in chunks[split]:
+            if stop > start and stop + size - start > rows:
+                runs.append((start, stop))
+                start = stop
+            stop += size
+        runs.append((start, stop))
+    return [
+        index + (slice(start, stop),)
+        for index in np.ndindex(*shape[:split])
+        for start, stop in runs
+    ]
+
+
+def _source_chunks(var_data):
+    """The chunks of a variable that is stored in chunks, as a tuple of chunk
+    sizes for each axis (see `_block_slices`), or None. These are the chunks
+    of a dask array, or for a netCDF or zarr file opened lazily, the chunks
+    of the file"""
+    if var_data.chunks is not None:
+        return var_data.chunks
+    preferred = var_data.encoding.get("preferred_chunks")
+    if not preferred:
+        return None
+    chunks = []
+    for dim, n in zip(var_data.dims, var_data.shape):
+        size = max(1, preferred.get(dim, n))
+        chunks.append((size,) * (n // size) + ((n % size,) if n % size else ()))
+    return tuple(chunks)
+
+
+def _prefetch(read, keys):
+    """Yield read(key) for each key, reading the next one in a background
+    thread while the current one is being used (e.g. compressed)"""
+    with ThreadPoolExecutor(1) as executor:
+        future = None
+        for key in keys:
+            following = executor.submit(read, key)
+            if future is not None:
+                yield future.result()
+            future = following
+        if future is not None:
+            yield future.result()
+
+
+def _join_blocks(shape, dtype, blocks):
+    """Assemble blocks in C order (see `_block_slices`) into one array"""
+    arr = np.empty(shape, dtype=dtype)
+    flat = arr.reshape(-1)
+    offset = 0
+    for block in blocks:
+        block = np.asarray(block).reshape(-1)
+        flat[offset : offset + block.size] = block
+        offset += block.size
+    if offset != flat.size:
+        raise ValueError(f"Blocks hold {offset} elements, but shape {shape} needs {flat.size}")
+    return arr
+
+
+class NpzWriter:
+    """
+        Write arrays and a JSON header into an NPZ archive, one entry at a time.
+
+        Each array is written straight into its own `.npy` zip entry as soon as
+        it is passed in, so only a single array needs to be held in memory at
+        once. The header is written as the final entry of the same pass, so the
+        archive never has to be reopened to append it.
+
+        Can be used as a context manager:
+
+            with NpzWriter("model.npz") as npz:
+                npz.write_array("x", np.zeros(10))
+                npz.write_header({"x": "zeros"})
+
+        Parameters:
+        -----------
+
+        npz_file: A filename or a writable file object
+        compressed: If True, deflate each array entry
+        workers:    If given, encode and compress entries concurrently. Either
+                    a number of threads (zlib releases the GIL) or an existing
+                    concurrent.futures.Executor, e.g. a ProcessPoolExecutor.
+                    Entries are still written in the order they were passed in.
+        align:      If given (e.g. 64), pad the zip headers of uncompressed
+                    entries so that the data of every array starts on a multiple
+                    of this many bytes in the archive. Typed arrays (in JS) and
+                    memory maps (in Python) can then view the archive directly.
+                    The npy header itself is always padded to 64 bytes by numpy.
+        shuffle:    If True, byte shuffle float arrays before compressing them
+                    (see `_shuffle`). Each shuffled entry is listed in the
+                    "filters" of the header, with its original dtype.
+        dedup:      If True, store each distinct array only once, in an entry
+                    objects/<hash>.npy named by the hash of its contents. The
+                    "links" of the header map each array name to its entry.
+        store:      Directory of arrays shared between archives (implies dedup).
+                    Arrays already in the store are not written to the archive,
+                    but listed in the "external" map of the header as
+                    <hash>.npy in the store; new arrays are added to the store,
+                    so later archives only have to ship new content.
+        mode:       "w" to write a new archive, or "a" to append to an existing
+                    one. A header written to a name that is already in the
+                    archive replaces the old one in the central directory.
+        cache:      An EntryCache (or the directory of one). Arrays whose
+                    contents are in the cache are copied from it instead of
+                    being encoded and compressed again; new ones are added.
+    """
+
+    def __init__(
+        self,
+        npz_file,
+        compressed=True,
+        workers=None,
+        align=None,
+        shuffle=False,
+        dedup=False,
+        store=None,
+        mode="w",
+        cache=None,
+    ):
+        if compressed and align:
+            raise ValueError("align can only be used with compressed=False")
+        self.compressed = compressed
+        self.align = align
+        self.shuffle = shuffle
+        self.dedup = dedup or store is not None
+        self.store = store
+        if store is not None:
+            os.makedirs(store, exist_ok=True)
+        # the store is recorded relative to the archive, if it is a file
+        if store is not None and isinstance(npz_file, (str, os.PathLike)):
+            archive_dir = os.path.dirname(os.path.abspath(npz_file))
+            self._store_path = os.path.relpath(store, archive_dir).replace(os.sep, "/")
+        else:
+            self._store_path = None
+        # filters, links and external entries of the entries written since
+        # the last header, by entry name
+        self._filters = {}
+        self._links = {}
+        self._external = {}
+        # content entries written so far
+        self._contents = set()
+        # {array name: the entry it was written to, or None if it was
+        # already in the archive or the store}
+        self.entries = {}
+        if isinstance(cache, (str, os.PathLike)):
+            cache = EntryCache(cache)
+        self.cache = cache
+        if compressed:
+            self.compression = zipfile.ZIP_DEFLATED
+        else:
+            self.compression = zipfile.ZIP_STORED
+        self.zip = zipfile.ZipFile(npz_file, mode, compression=self.compression)
+
+        # optional pool for concurrent compression
+        self._own_executor = False
+        self.executor = None
+        self._max_pending = 0
+        if isinstance(workers, Executor):
+            self.executor = workers
+            self._max_pending = 2 * (os.cpu_count() or 1)
+        elif workers:
+            self.executor = ThreadPoolExecutor(workers)
+            self._own_executor = True
+            self._max_pending = 2 * workers
+        # (name, future, cache key) triples, in the order they must be written;
+        # the cache key is None if the entry need not be added to the cache
+        self._pending = deque()
+
+    def write_array(self, name, arr):
+        """Write a single array to the entry <name>.npy"""
+        arr = np.asanyarray(arr)
+        if self.shuffle and arr.dtype.kind == "f":
+            self._filters[name] = [{"id": "shuffle", "dtype": arr.dtype.str}]
+            arr = _shuffle(arr)
+        if self.dedup or self.cache is not None:
+            digest = _content_hash(arr)
+        if self.dedup:
+            self.entries[name] = self._content_entry(name, digest)
+            name = self.entries[name]
+            if name is None:
+                return
+            if self.store is not None:
+                self._store_entry(digest, _npy_parts(arr))
+        else:
+            self.entries[name] = name
+        if self.cache is not None:
+            key = _cache_key(digest, self.compressed)
+            cached = self.cache.get(key)
+            if cached is not None:
+                future, key = Future(), None
+                future.set_result(cached)
+            elif self.executor is not None:
+                future = self.executor.submit(_encode_npy, arr, self.compressed)
+            else:
+                future = Future()
+                future.set_result(_encode_npy(arr, self.compressed))
+            self._pending.append((name + ".npy", future, key))
+            while len(self._pending) > self._max_pending:
+                self._write_next()
+        elif self.executor is None and self.align:
+            header, data = _npy_parts(arr)
+            crc = zlib.crc32(data, zlib.crc32(header))
+            size = len(header) + data.nbytes
+            self.write_raw_entry(name + ".npy", crc, size, [header, data], self.compression)
+        elif self.executor is None:
+            # force_zip64 as in np.savez, as the size is not known in advance
+            with self.zip.open(name + ".npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, arr, allow_pickle=False)
+        else:
+            future = self.executor.submit(_encode_npy, arr, self.compressed)
+            self._pending.append((name + ".npy", future, None))
+            # bound the number of encoded arrays waiting in memory
+            while len(self._pending) > self._max_pending:
+                self._write_next()
+
+    def write_blocks(self, name, shape, dtype, blocks):
+        """
+            Write an array given as an iterable of blocks, in C order (see
+            `_block_slices`), to the entry <name>.npy without ever holding the
+            whole array in memory. The npy header is written from shape and
+            dtype before the first block is read, and each block is compressed
+            into the entry as soon as it arrives.
+
+            Shuffling, deduplication, the cache and alignment need the whole
+            array, so if any of them applies the blocks are joined first.
+        """
+        dtype = np.dtype(dtype)
+        shape = tuple(shape)
+        shuffled = self.shuffle and dtype.kind == "f"
+        if shuffled or self.dedup or self.cache is not None or self.align:
+            self.write_array(name, _join_blocks(shape, dtype, blocks))
+            return
+        # entries are written in the order they were passed in
+        self.flush()
+        self.entries[name] = name
+        header = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": shape,
+        }
+        expected, written = int(np.prod(shape)), 0
+        with self.zip.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for block in blocks:
+                block = np.require(block, requirements="C")
+                if block.dtype != dtype:
+                    raise ValueError(f"Block of {name} has dtype {block.dtype}, not {dtype}")
+                f.write(block.reshape(-1).view(np.uint8))
+                written += block.size
+        if written != expected:
+            raise ValueError(f"Blocks of {name} hold {written} elements, but shape {shape} needs {expected}")
+
+    def _content_entry(self, name, digest):
+        """Link the array <name> to the content entry for digest. Returns the
+        name the content must be written to, or None if it is already in the
+        archive or in the store"""
+        target = "objects/" + digest
+        if target in self._contents:
+            self._links[name] = target
+            return None
+        if self.store is not None and os.path.exists(os.path.join(self.store, digest + ".npy")):
+            self._external[name] = digest + ".npy"
+            return None
+        self._contents.add(target)
+        self._links[name] = target
+        return target
+
+    def _store_entry(self, digest, parts):
+        """Add an npy file (given as a list of bytes-like parts) to the store.
+        Written to a temporary file first, so that concurrent exports sharing
+        the store never see a partial array."""
+        path = os.path.join(self.store, digest + ".npy")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(tmp_path, path)
+
+    def write_encoded_entry(self, name, crc, file_size, payload, digest=None):
+        """Write an entry <name>.npy encoded by `_encode_npy`, deduplicating it by
+        digest (its `_content_hash`) if this writer deduplicates arrays"""
+        if self.dedup:
+            name = self._content_entry(name, digest)
+            if name is None:
+                return
+            if self.store is not None:
+                raw = zlib.decompress(payload, -15) if self.compressed else payload
+                self._store_entry(digest, [raw])
+        self.write_raw_entry(name + ".npy", crc, file_size, payload, self.compression)
+
+    def _write_next(self):
+        """Wait for the oldest pending entry and write it to the archive"""
+        name, future, cache_key = self._pending.popleft()
+        crc, file_size, payload = future.result()
+        if cache_key is not None:
+            self.cache.put(cache_key, crc, file_size, payload)
+        self.write_raw_entry(name, crc, file_size, payload, self.compression)
+
+    def flush(self):
+        """Write out all pending entries"""
+        while self._pending:
+            self._write_next()
+
+    def write_raw_entry(self, name, crc, file_size, payload, compress_type):
+        """Write an already encoded (and possibly compressed) entry to the archive.
+        payload may be a bytes-like object or a list of them.
+        zipfile has no public API for this, so the local header is written
+        directly and the entry registered so that it appears in the central directory."""
+        if not isinstance(payload, list):
+            payload = [payload]
+        zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0o600 << 16
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = sum(memoryview(part).nbytes for part in payload)
+        zip64 = max(file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+        z = self.zip
+        with z._lock:
+            z._writecheck(zinfo)
+            if z._seekable:
+                z.fp.seek(z.start_dir)
+            zinfo.header_offset = z.fp.tell()
+            if self.align and compress_type == zipfile.ZIP_STORED:
+                header_end = zinfo.header_offset + len(zinfo.FileHeader(zip64))
+                zinfo.extra = _alignment_extra(header_end, self.align)
+            z._didModify = True
+            z.fp.write(zinfo.FileHeader(zip64))
+            for part in payload:
+                z.fp.write(part)
+            z.start_dir = z.fp.tell()
+            z.filelist.append(zinfo)
+            z.NameToInfo[zinfo.filename] = zinfo
+
+    def write_header(self, header, name="header.json"):
+        """Write the JSON header; this should be the last entry written for its arrays"""
+        self.flush()
+        output = {"inference_data": header}
+        # filters, links and external entries of the entries under this
+        # header, by name relative to it (link targets stay absolute)
+        prefix = name[: -len("header.json")]
+        for key, entries in [
+            ("filters", self._filters),
+            ("links", self._links),
+            ("external", self._external),
+        ]:
+            under = [k for k in entries if k.startswith(prefix)]
+            if under:
+                output[key] = {k[len(prefix) :]: entries.pop(k) for k in under}
+        if self._store_path is not None:
+            output["store"] = self._store_path
+        # header data will be in a file called "header.json" inside the zip
+        # (aligned archives are read directly, so leave the header uncompressed)
+        if self.compressed or self.align:
+            compression = zipfile.ZIP_STORED
+        else:
+            compression = zipfile.ZIP_DEFLATED
+        # when appending, drop any previous header from the central directory;
+        # its bytes are left in place, but no reader will find them
+        old = self.zip.NameToInfo.pop(name, None)
+        if old is not None:
+            self.zip.filelist.remove(old)
+        self.zip.writestr(name, json.dumps(output, default=_json_default), compression)
+
+    def close(self):
+        self.flush()
+        if self._own_executor:
+            self.executor.shutdown()
+        self.zip.close()
+
+    def abort(self):
+        """Close the archive after a failure, without writing the pending entries"""
+        for _, future, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._own_executor:
+            self.executor.shutdown()
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 
-    # output listing if requested
+@contextmanager
+def _replacing(output):
+    """Yield a temporary filename next to output, which replaces output if the
+    block succeeds and is removed if it fails, so that a failed export never
+    leaves a truncated archive (or replaces a good one). File objects are
+    yielded as they are"""
+    if not isinstance(output, (str, os.PathLike)):
+        yield output
+        return
+    output = os.fspath(output)
+    temp = f"{output}.{os.urandom(6).hex()}.tmp"
+    try:
+        yield temp
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+    os.replace(temp, output)
+
+
+def write_for_js(
+    npz_file,
+    header,
+    arrays,
+    compressed=True,
+    verbose=False,
+    workers=None,
+    align=None,
+    shuffle=False,
+    dedup=False,
+    store=None,
+    cache=None,
+    on_report=None,
+):
+    """Write the data to a JSON file for loading in JS, along with
+    the NPZ file containing the arrays. If workers is given, the arrays
+    are compressed concurrently; if align is given, uncompressed arrays
+    start on aligned offsets; if shuffle is True, float arrays are
+    byte shuffled before compression; if dedup is True or a store is
+    given, identical arrays are only stored once; if a cache is given,
+    previously encoded arrays are reused (see NpzWriter).
+
+    Returns a report of the export (see `arviz_to_json`), which is also
+    passed to on_report if given, and printed if verbose is True."""
+
+    with _replacing(npz_file) as path, NpzWriter(
+        path,
+        compressed=compressed,
+        workers=workers,
+        align=align,
+        shuffle=shuffle,
+        dedup=dedup,
+        store=store,
+        cache=cache,
+    ) as npz:
+        report = _new_report()
+        start = time.perf_counter()
+        # dump the arrays to the file output
+        for name, arr in arrays.items():
+            arr = np.asanyarray(arr)
+            _report_variable(report, name, arr.dtype)
+            _report_write(report, npz, name, name, arr)
+        # write JSON to the npz file
+        return _finish_export(npz, header, report, start, verbose, on_report)
+
+
+def _finish_export(npz, header, report, start, verbose=False, on_report=None):
+    """Write the header and close the archive, then complete the report"""
+    with _timed(report["timings"], "compression"):
+        npz.flush()
+    with _timed(report["timings"], "header_serialization"):
+        npz.write_header(header)
+    npz.close()
+    _finish_report(report, npz, start)
     if verbose:
-        print("Writing archive file...")
-        z.printdir()
-    z.close()
+        print(format_report(report))
+    if on_report is not None:
+        on_report(report)
+    return report
 
 
 def fix_dtype(data):
@@ -51,7 +604,191 @@ def fix_dtype(data):
         )
     return arr
 
-def multi_arviz_to_json(models, output, compressed=True):
+def _encode_coord(values):
+    """
+        Convert the values of a coordinate to an array that the npy loader can
+        read, without looping over the elements in Python. Returns the array
+        and the "encoding" needed to decode it, which is one of:
+
+            "utf8":            strings, as UTF-8 bytes zero padded to the longest
+                               one, i.e. an |u1 array with an extra last axis
+            "datetime64[ns]":  dates, as <i8 nanoseconds since the epoch, with
+                               NaT as the smallest int64 (as numpy stores it)
+            "timedelta64[ns]": durations, as <i8 nanoseconds
+            null:              numbers, converted by `fix_dtype`
+
+        Dates and durations are encoded this way whether they are written as
+        an array entry or to the header, so both read back the same.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "mM":
+        encoding = "datetime64[ns]" if values.dtype.kind == "M" else "timedelta64[ns]"
+        return values.astype(encoding).view("<i8"), encoding
+    if values.dtype.kind in "USO":
+        encoded = np.char.encode(values.astype(str), "utf-8")
+        width = max(encoded.dtype.itemsize, 1)
+        encoded = encoded.astype(f"S{width}")
+        return encoded.view("|u1").reshape(values.shape + (width,)), "utf8"
+    return fix_dtype(values), None
+
+
+def _header_coord(values):
+    """The values of a coordinate as written to the header: a list, or for
+    dates and durations, their encoded values and dtype (see `_encode_coord`)"""
+    values = np.asarray(values)
+    if values.dtype.kind not in "mM":
+        return values.tolist()
+    arr, encoding = _encode_coord(values)
+    return {
+        "values": arr.tolist(),
+        "dtype": values.dtype.str,
+        "shape": list(values.shape),
+        "encoding": encoding,
+    }
+
+
+def _encode_dag(dag, array_prefix, coord_threshold=1000):
+    """
+        Encode a DAG from `get_dag` as compressed sparse row adjacency arrays
+        and a table of nodes, instead of one nested dict per node. Nodes are
+        numbered in the order of the dict; the parents of node i are the nodes
+        parent_indices[parent_offsets[i]:parent_offsets[i + 1]].
+
+        Types, dims and distributions are stored once each in the returned
+        description, and indexed per node; coordinates are stored once per
+        dimension, and as array entries (see `_encode_coord`) if they have
+        more than coord_threshold values.
+
+        Returns the description of the DAG, to take its place in the header,
+        and a mapping of {entry name: array} to write, named <array_prefix><field>.
+    """
+    names = list(dag)
+    index = {name: i for i, name in enumerate(names)}
+    parent_offsets = [0]
+    parent_indices = []
+    tables = {"types": {}, "dims": {}, "distributions": {}}
+    codes = {"type": [], "dims": [], "distribution": []}
+    coords = {}
+    for name, node in dag.items():
+        for parent in node.get("parents", []):
+            if parent not in index:
+                raise ValueError(f"Parent {parent} of {name} is not a node of the DAG")
+            parent_indices.append(index[parent])
+        parent_offsets.append(len(parent_indices))
+        for field, table, value in [
+            ("type", "types", node.get("type", "unknown")),
+            ("dims", "dims", list(node.get("dims", []))),
+            ("distribution", "distributions", node.get("distribution", {})),
+        ]:
+            key = json.dumps(value, sort_keys=True, default=_json_default)
+            codes[field].append(tables[table].setdefault(key, len(tables[table])))
+        for dim, values in node.get("coords", {}).items():
+            if coords.setdefault(dim, list(values)) != list(values):
+                raise ValueError(f"Nodes of the DAG have different coordinates for {dim}")
+
+    arrays = {
+        "parent_offsets": np.array(parent_offsets, dtype="<i4"),
+        "parent_indices": np.array(parent_indices, dtype="<i4"),
+        "size": fix_dtype([node.get("size", 0) for node in dag.values()]),
+        "type": np.array(codes["type"], dtype="<i4"),
+        "dims": np.array(codes["dims"], dtype="<i4"),
+        "distribution": np.array(codes["distribution"], dtype="<i4"),
+    }
+    description = {
+        "encoding": "csr",
+        "n_nodes": len(names),
+        "array_names": {field: array_prefix + field for field in arrays},
+    }
+    for table, values in tables.items():
+        description[table] = [json.loads(key) for key in values]
+
+    # node names, and long coordinates, are written like the coordinates of groups
+    def encode_values(field, values):
+        arr, encoding = _encode_coord(np.array(values, dtype=str))
+        arrays[field] = arr
+        return {
+            "array_name": array_prefix + field,
+            "dtype": np.array(values, dtype=str).dtype.str,
+            "shape": (len(values),),
+            "encoding": encoding,
+        }
+
+    description["names"] = encode_values("names", names)
+    description["coords"] = {}
+    for dim, values in coords.items():
+        if coord_threshold is None or len(values) <= coord_threshold:
+            description["coords"][dim] = values
+        else:
+            description["coords"][dim] = encode_values(f"coords/{dim}", values)
+    return description, {array_prefix + field: arr for field, arr in arrays.items()}
+
+
+class _EntryCollector:
+    """Stand-in for NpzWriter that encodes arrays into a list of
+    (name, crc, size, payload, digest) entries instead of writing an archive,
+    so a whole model can be encoded in another process. digest is the
+    `_content_hash` of the array if dedup is True, and None otherwise."""
+
+    def __init__(self, compressed=True, shuffle=False, dedup=False, cache=None):
+        self.compressed = compressed
+        self.shuffle = shuffle
+        self.dedup = dedup
+        self.cache = cache
+        self.entries = []
+        self.filters = {}
+
+    def write_array(self, name, arr):
+        arr = np.asanyarray(arr)
+        if self.shuffle and arr.dtype.kind == "f":
+            self.filters[name] = [{"id": "shuffle", "dtype": arr.dtype.str}]
+            arr = _shuffle(arr)
+        digest = _content_hash(arr) if self.dedup or self.cache is not None else None
+        encoded = None
+        if self.cache is not None:
+            key = _cache_key(digest, self.compressed)
+            encoded = self.cache.get(key)
+        if encoded is None:
+            encoded = _encode_npy(arr, self.compressed)
+            if self.cache is not None:
+                self.cache.put(key, *encoded)
+        self.entries.append((name,) + encoded + (digest if self.dedup else None,))
+
+    def write_blocks(self, name, shape, dtype, blocks):
+        # entries are returned whole, so there is nothing to gain by streaming
+        self.write_array(name, _join_blocks(shape, dtype, blocks))
+
+
+def _encode_model(
+    inference_data, compressed=True, options=None, shuffle=False, dedup=False, cache=None
+):
+    """Encode every array of a model; returns (header, entries, filters)"""
+    collector = _EntryCollector(compressed, shuffle, dedup, cache)
+    header = _write_groups(inference_data, collector, **(options or {}))
+    return header, collector.entries, collector.filters
+
+
+def _model_to_npz_bytes(inference_data, compressed=True, workers=None, options=None):
+    """Write a model as a complete npz file in memory"""
+    f = BytesIO()
+    arviz_to_json(inference_data, f, compressed=compressed, workers=workers, **(options or {}))
+    return f.getvalue()
+
+
+def multi_arviz_to_json(
+    models,
+    output,
+    compressed=True,
+    workers=None,
+    layout="nested",
+    processes=None,
+    align=None,
+    shuffle=False,
+    dedup=False,
+    store=None,
+    cache=None,
+    model_options=None,
+    **options,
+):
     """
         Take a mapping of {name:InferenceData objects}, and write all of the
         corresponding models into a single ZIP file with the given name.
@@ -64,41 +801,532 @@ def multi_arviz_to_json(models, output, compressed=True):
                 "model_quadratic" : model_quadratic
             }
 
-        Each model will be an `npz` file exactly as written by `arviz_to_json`
+        With layout="nested", each model will be an `npz` file exactly as
+        written by `arviz_to_json`, stored inside the zip.
+
+        With layout="flat", the arrays of each model are written directly into
+        the single zip as `<name>/<array_name>.npy`, along with the model header
+        as `<name>/header.json`. This avoids compressing and unzipping twice,
+        and never holds a whole model archive in memory.
+
+        If workers is given, the entries of each model are compressed
+        concurrently (see NpzWriter). If processes is given, the models are
+        exported in parallel on a pool of that many processes. align,
+        shuffle, dedup, store and cache are passed to NpzWriter; with
+        layout="nested" and align, each model archive also starts on an
+        aligned offset, so its arrays are aligned in the zip. Any other
+        keyword options (e.g. chunks) are passed to `arviz_to_json` for every
+        model. model_options maps model names to options for that model only,
+        which override the shared ones, e.g. to select different variables
+        from each model:
+
+            multi_arviz_to_json(models, "models.zip", groups=["posterior"],
+                                model_options={"model_linear": {"var_names": ["slope"]}})
+
+        With layout="flat" and dedup=True, arrays that are identical across
+        models (e.g. observed_data) are only stored once in the archive. With
+        layout="nested", each model archive is deduplicated separately.
     """
-    z = zipfile.ZipFile(output, "w")
+    if layout not in ("nested", "flat"):
+        raise ValueError(f"Unknown layout {layout}; should be 'nested' or 'flat'")
+    if compressed and align:
+        raise ValueError("align can only be used with compressed=False")
+    unknown = set(model_options or {}) - set(models)
+    if unknown:
+        raise ValueError(f"model_options given for unknown models {sorted(unknown)}")
+    # the options of each model, in the order of models
+    per_model = [dict(options, **(model_options or {}).get(name, {})) for name in models]
 
-    # select compression flag
-    if compressed:
-        zip_mode = zipfile.ZIP_DEFLATED
+    if processes:
+        # imports multiprocessing, so only when it is used
+        from concurrent.futures import ProcessPoolExecutor
+
+    executor = ProcessPoolExecutor(processes) if processes else None
+    try:
+        if layout == "nested":
+            if executor:
+                results = executor.map(
+                    _model_to_npz_bytes,
+                    models.values(),
+                    repeat(compressed),
+                    repeat(None),
+                    [
+                        dict(
+                            model_opts,
+                            align=align,
+                            shuffle=shuffle,
+                            dedup=dedup,
+                            store=store,
+                            cache=cache,
+                        )
+                        for model_opts in per_model
+                    ],
+                )
+            else:
+                results = (
+                    _model_to_npz_bytes(
+                        model,
+                        compressed,
+                        workers,
+                        dict(
+                            model_opts,
+                            align=align,
+                            shuffle=shuffle,
+                            dedup=dedup,
+                            store=store,
+                            cache=cache,
+                        ),
+                    )
+                    for model, model_opts in zip(models.values(), per_model)
+                )
+            with _replacing(output) as path, NpzWriter(path, compressed=False, align=align) as z:
+                # each npz is already compressed if requested, so store it as it is;
+                # with align, each npz starts aligned, so its arrays stay aligned
+                for name, npz_bytes in zip(models, results):
+                    crc = zlib.crc32(npz_bytes)
+                    z.write_raw_entry(
+                        name + ".npz", crc, len(npz_bytes), npz_bytes, zipfile.ZIP_STORED
+                    )
+        else:
+            with _replacing(output) as path, NpzWriter(
+                path,
+                compressed=compressed,
+                workers=workers,
+                align=align,
+                shuffle=shuffle,
+                dedup=dedup,
+                store=store,
+                cache=cache,
+            ) as npz:
+                if executor:
+                    results = executor.map(
+                        _encode_model,
+                        models.values(),
+                        repeat(compressed),
+                        per_model,
+                        repeat(shuffle),
+                        repeat(npz.dedup),
+                        repeat(npz.cache),
+                    )
+                    for name, (header, entries, filters) in zip(models, results):
+                        for entry_name, crc, file_size, payload, digest in entries:
+                            npz.write_encoded_entry(
+                                f"{name}/{entry_name}", crc, file_size, payload, digest
+                            )
+                        npz._filters.update({f"{name}/{k}": v for k, v in filters.items()})
+                        npz.write_header(header, f"{name}/header.json")
+                else:
+                    for (name, model), model_opts in zip(models.items(), per_model):
+                        header = _write_groups(model, npz, prefix=name + "/", **model_opts)
+                        npz.write_header(header, f"{name}/header.json")
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+def _select_var_names(names, var_names=None, filter_vars=None):
+    """
+        Select variables by name as ArviZ does. var_names is a name or a list
+        of names; names prefixed with "~" are excluded rather than included.
+        With filter_vars=None names must match exactly, with "like" they match
+        every variable containing them, and with "regex" every variable they
+        match as regular expressions. Returns the selected names, in order.
+    """
+    if filter_vars not in (None, "like", "regex"):
+        raise ValueError(f"Unknown filter_vars {filter_vars}; should be None, 'like' or 'regex'")
+    if var_names is None:
+        return list(names)
+    if isinstance(var_names, str):
+        var_names = [var_names]
+
+    def matches(pattern, name):
+        if filter_vars == "like":
+            return pattern in name
+        if filter_vars == "regex":
+            return re.search(pattern, name) is not None
+        return pattern == name
+
+    include = [v for v in var_names if not v.startswith("~")]
+    exclude = [v[1:] for v in var_names if v.startswith("~")]
+    return [
+        name
+        for name in names
+        if (not include or any(matches(p, name) for p in include))
+        and not any(matches(p, name) for p in exclude)
+    ]
+
+
+def _in_memory(var_data):
+    """Whether a variable is held in memory, rather than backed by dask or
+    by a lazily opened file"""
+    return var_data.chunks is None and var_data.variable._in_memory
+
+
+def _chunk_grid(var_data, chunks):
+    """Return the chunk shape and the number of chunks along each dimension of
+    a variable, or None if the variable fits in a single chunk"""
+    chunk_shape = [min(chunks.get(dim, size), size) or 1 for dim, size in var_data.sizes.items()]
+    grid = [-(-size // chunk) for size, chunk in zip(var_data.shape, chunk_shape)]
+    if all(n <= 1 for n in grid):
+        return None
+    return chunk_shape, grid
+
+
+def _summary_stats(group, hdi_prob=0.94):
+    """
+        Compute summary statistics over chain and draw for every variable of
+        a group that has both dimensions, vectorized over all coordinates.
+        Returns (stat names, {var: array of shape (n stats, *other dims)}).
+    """
+    sample_vars = [
+        var for var, var_data in group.data_vars.items()
+        if "chain" in var_data.dims and "draw" in var_data.dims
+    ]
+    stat_names = [
+        "mean",
+        "sd",
+        f"hdi_{100 * (1 - hdi_prob) / 2:g}%",
+        f"hdi_{100 * (1 + hdi_prob) / 2:g}%",
+        "ess_bulk",
+        "r_hat",
+    ]
+    if not sample_vars:
+        return stat_names, {}
+    # arviz is slow to import, and only needed for summaries
+    import arviz as az
+
+    samples = group[sample_vars].astype(float)
+    sample_dims = ("chain", "draw")
+    mean = samples.mean(sample_dims)
+    sd = samples.std(sample_dims, ddof=1)
+    hdi = az.hdi(samples, hdi_prob=hdi_prob)
+    ess = az.ess(samples, method="bulk")
+    r_hat = az.rhat(samples)
+
+    stats = {}
+    for var in sample_vars:
+        other_dims = [dim for dim in samples[var].dims if dim not in sample_dims]
+        stats[var] = np.stack(
+            [
+                stat.transpose(*other_dims).values
+                for stat in [
+                    mean[var],
+                    sd[var],
+                    hdi[var].sel(hdi="lower"),
+                    hdi[var].sel(hdi="higher"),
+                    ess[var],
+                    r_hat[var],
+                ]
+            ]
+        )
+    return stat_names, stats
+
+
+def _lod_steps(n_draws, lod_levels=None, lod_target=None):
+    """Thinning steps (2, 4, 8, ...) for the levels of detail of a variable with
+    n_draws draws: lod_levels levels, or as many as are needed to get down to
+    at most lod_target draws"""
+    steps = []
+    step = 2
+    while step < n_draws:
+        if lod_levels is not None:
+            if len(steps) == lod_levels:
+                break
+        # draws in the coarsest level so far
+        elif -(-n_draws // (step // 2)) <= lod_target:
+            break
+        steps.append(step)
+        step *= 2
+    return steps
+
+
+def _round_mantissa(arr, digits):
+    """Round floats to the number of mantissa bits needed for `digits`
+    significant decimal digits, zeroing the rest so that deflate can compress
+    them. Non-finite values are left unchanged."""
+    mantissa_bits = {4: 23, 8: 52}[arr.dtype.itemsize]
+    drop = mantissa_bits - min(mantissa_bits, int(np.ceil(digits * np.log2(10))))
+    if drop <= 0:
+        return arr
+    uint = np.dtype(f"<u{arr.dtype.itemsize}")
+    bits = arr.view(uint)
+    # round to nearest, letting any carry propagate into the exponent
+    rounded = (bits + uint.type(1 << (drop - 1))) & ~uint.type((1 << drop) - 1)
+    return np.where(np.isfinite(arr), rounded.view(arr.dtype), arr)
+
+
+def _precision_filter(var_data, policy, block_size=2 ** 26):
+    """
+        Describe how a float variable is encoded under a precision policy,
+        as an entry for the "filters" list of its header. Returns None if the
+        variable is not a float variable. Policies are:
+
+            "f4":       downcast to float32
+            "u1"/"u2":  linear quantization to 8 or 16 bit codes, with
+                        x = offset + scale * code. Non-finite values are stored
+                        as the largest code ("nan_code") and decode to NaN
+            int N:      round to N significant decimal digits (in binary, by
+                        zeroing low mantissa bits)
+
+        The maximum absolute error is filled in as the data is encoded. The
+        range of quantized variables is found block by block, so variables
+        that are not in memory are never loaded whole.
+    """
+    if var_data.dtype.kind != "f":
+        return None
+    if policy == "f4":
+        return {"id": "astype", "dtype": "<f4", "max_abs_error": 0.0}
+    if policy in ("u1", "u2"):
+        # the quantization is fixed over the whole variable, so that chunks
+        # and levels of detail all decode the same way
+        lo, hi, all_finite = np.inf, -np.inf, True
+        slices = _block_slices(
+            var_data.shape, var_data.dtype.itemsize, block_size, _source_chunks(var_data)
+        )
+        for index in slices:
+            block = np.asarray(var_data.variable[index].values)
+            finite = np.isfinite(block)
+            all_finite = all_finite and bool(finite.all())
+            if finite.any():
+                lo = min(lo, float(block[finite].min()))
+                hi = max(hi, float(block[finite].max()))
+        if lo > hi:
+            lo = hi = 0.0
+        code_max = {"u1": 255, "u2": 65535}[policy]
+        levels = code_max if all_finite else code_max - 1
+        return {
+            "id": "quantize",
+            "dtype": "|u1" if policy == "u1" else "<u2",
+            "scale": (hi - lo) / levels if hi > lo else 1.0,
+            "offset": lo,
+            "nan_code": None if all_finite else code_max,
+            "max_abs_error": 0.0,
+        }
+    if isinstance(policy, int):
+        return {"id": "round", "digits": policy, "max_abs_error": 0.0}
+    raise ValueError(f"Unknown precision policy {policy}; should be 'f4', 'u1', 'u2' or an int")
+
+
+def _apply_filter(arr, filt):
+    """Encode an array (or a piece of a variable) with a filter described
+    by `filt`, updating the maximum absolute error recorded in it"""
+    finite = np.isfinite(arr) if arr.dtype.kind == "f" else None
+    if filt["id"] == "astype":
+        encoded = decoded = arr.astype(filt["dtype"])
+    elif filt["id"] == "quantize":
+        levels = filt["nan_code"] if filt["nan_code"] is not None else np.iinfo(filt["dtype"]).max
+        codes = np.clip(np.round((arr - filt["offset"]) / filt["scale"]), 0, levels)
+        encoded = np.where(finite, codes, filt["nan_code"] or 0).astype(filt["dtype"])
+        decoded = filt["offset"] + filt["scale"] * encoded
+    elif filt["id"] == "round":
+        encoded = decoded = _round_mantissa(arr, filt["digits"])
     else:
-        zip_mode = zipfile.ZIP_STORED
+        raise ValueError(f"Unknown filter {filt['id']}")
+    if finite is not None and finite.any():
+        error = float(np.max(np.abs(decoded[finite] - arr[finite])))
+        filt["max_abs_error"] = max(filt["max_abs_error"], error)
+    return encoded
 
-    # write each npz file into memory, then compress into a single zip file
-    for name, model in models.items():
-        f = BytesIO()
-        arviz_to_json(model, f)
-        z.writestr(name+".npz", f.getvalue())
 
-    z.close()
+@contextmanager
+def _timed(timings, stage):
+    """Add the time spent in the block to timings[stage]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] += time.perf_counter() - start
 
 
-def arviz_to_json(inference_data, output_name):
+def _new_report():
     """
-        Take an inference data Xarray object, and return a JSON representation
-        that can be loaded client-side, along with an NPZ file that holds the
-        array data.
+        An empty export report, filled in by `_write_groups` and `_finish_report`:
 
-        Writes:            
-            <output_name>.npz: Arrays, as an NPZ file, with JSON included in archive
+            timings:   {stage: seconds}, for the stages "header" (building the
+                       header), "conversion" (dtype conversion and precision
+                       filters), "summary" (summary statistics), "compression"
+                       (encoding, shuffling and compressing entries),
+                       "header_serialization" (writing header.json) and "total"
+            variables: {"<group>/<var>" or "coords/<group>/<coord>": {
+                           "dtype", "stored_dtype", "coerced" (whether the
+                           dtype was changed), "entries" (array names),
+                           "raw_bytes", "compressed_bytes", "ratio"}}
+            raw_bytes, compressed_bytes, ratio: totals over all variables
+    """
+    return {"timings": defaultdict(float), "variables": {}}
 
-        Parameters:
-        -----------
 
-        inference_data: An ARviz inference data object
-        output_name: The name of the output file
+def _report_variable(report, key, dtype):
+    """Start the report of a variable, given its original dtype"""
+    report["variables"][key] = {
+        "dtype": np.dtype(dtype).str,
+        "stored_dtype": None,
+        "coerced": False,
+        "entries": [],
+        "raw_bytes": 0,
+    }
+
+
+def _report_write(report, npz, key, name, arr):
+    """Write an array of the variable key through npz, recording it in report"""
+    var_report = report["variables"][key]
+    if var_report["stored_dtype"] is None:
+        var_report["stored_dtype"] = arr.dtype.str
+        var_report["coerced"] = arr.dtype.str != var_report["dtype"]
+    var_report["entries"].append(name)
+    var_report["raw_bytes"] += arr.nbytes
+    with _timed(report["timings"], "compression"):
+        npz.write_array(name, arr)
+
+
+def _report_write_blocks(report, npz, key, name, shape, dtype, blocks):
+    """Write an array of the variable key given as blocks (see
+    `NpzWriter.write_blocks`) through npz, recording it in report. Blocks are
+    read and converted while the entry is written; that time is recorded as
+    conversion, and the rest as compression."""
+    var_report = report["variables"][key]
+    dtype = np.dtype(dtype)
+    if var_report["stored_dtype"] is None:
+        var_report["stored_dtype"] = dtype.str
+        var_report["coerced"] = dtype.str != var_report["dtype"]
+    var_report["entries"].append(name)
+    var_report["raw_bytes"] += int(np.prod(shape)) * dtype.itemsize
+    timings = report["timings"]
+    conversion, start = timings["conversion"], time.perf_counter()
+    npz.write_blocks(name, shape, dtype, blocks)
+    timings["compression"] += time.perf_counter() - start - (timings["conversion"] - conversion)
+
+
+def _finish_report(report, npz, start):
+    """Fill in the compressed size of every variable from the archive written
+    by npz (an NpzWriter), the totals, and the total time since start"""
+    infos = {info.filename: info for info in npz.zip.infolist()}
+    for var_report in report["variables"].values():
+        compressed = 0
+        for name in var_report["entries"]:
+            # deduplicated copies of an entry cost nothing
+            entry = npz.entries.get(name, name)
+            if entry is not None and entry + ".npy" in infos:
+                compressed += infos[entry + ".npy"].compress_size
+        var_report["compressed_bytes"] = compressed
+        var_report["ratio"] = var_report["raw_bytes"] / compressed if compressed else None
+    report["raw_bytes"] = sum(v["raw_bytes"] for v in report["variables"].values())
+    report["compressed_bytes"] = sum(v["compressed_bytes"] for v in report["variables"].values())
+    if report["compressed_bytes"]:
+        report["ratio"] = report["raw_bytes"] / report["compressed_bytes"]
+    else:
+        report["ratio"] = None
+    report["timings"] = dict(report["timings"], total=time.perf_counter() - start)
+    return report
+
+
+def format_report(report, top=None):
+    """
+        Format an export report (as returned by `arviz_to_json`) as a table of
+        the stage timings and of the variables, largest first. If top is
+        given, only list that many variables.
+    """
+    lines = ["Stage timings:"]
+    for stage, seconds in report["timings"].items():
+        lines.append(f"    {stage:24s} {seconds * 1000:10.1f} ms")
+    lines.append("")
+    lines.append(f"{'variable':40s} {'dtype':>13s} {'raw':>11s} {'compressed':>11s} {'ratio':>7s}")
+    variables = sorted(
+        report["variables"].items(), key=lambda item: item[1]["compressed_bytes"], reverse=True
+    )
+    for key, v in variables[:top]:
+        dtype = f"{v['dtype']}->{v['stored_dtype']}" if v["coerced"] else v["dtype"]
+        ratio = f"{v['ratio']:7.2f}" if v["ratio"] else f"{'-':>7s}"
+        lines.append(
+            f"{key:40s} {dtype:>13s} {v['raw_bytes']:11d} {v['compressed_bytes']:11d} {ratio}"
+        )
+    ratio = f"{report['ratio']:7.2f}" if report["ratio"] else f"{'-':>7s}"
+    raw, compressed = report["raw_bytes"], report["compressed_bytes"]
+    lines.append(f"{'total':40s} {'':>13s} {raw:11d} {compressed:11d} {ratio}")
+    return "\n".join(lines)
+
 
+def _write_groups(
+    inference_data,
+    npz,
+    prefix="",
+    chunks=None,
+    summary=False,
+    hdi_prob=0.94,
+    lod_levels=None,
+    lod_target=None,
+    precision=None,
+    coord_threshold=1000,
+    dag_format="json",
+    block_size=2 ** 26,
+    groups=None,
+    var_names=None,
+    filter_vars=None,
+    coords=None,
+    report=None,
+):
     """
+        Convert each group of an InferenceData object, writing its arrays
+        through `npz` (an NpzWriter) as entries named <prefix><array_name>.
+        Each array is converted and written as soon as it is reached, so only
+        one converted array is ever held in memory.
+
+        If chunks is given, as a mapping of {dimension: chunk size}, variables
+        that span more than one chunk are split into one entry per chunk, named
+        <array_name>/<i>.<j>... by the index of the chunk along each dimension.
+
+        If summary is True, summary statistics (see `_summary_stats`) of every
+        variable with chain and draw dimensions are written to the entry
+        <array_name>/summary.
+
+        If lod_levels or lod_target is given, thinned copies of every posterior
+        and prior variable (every 2nd, 4th, 8th... draw) are written to the
+        entries <array_name>/lod<step>. See `_lod_steps`.
+
+        If precision is given, float variables are encoded lossily according to
+        a policy (see `_precision_filter`) looked up in it by "<group>/<var>" or,
+        failing that, by "<group>". The encoding is described in the "filters"
+        list of the variable's header.
+
+        Coordinates with more than coord_threshold values are written to the
+        entry coords/<group>/<coord> (see `_encode_coord`), and given in the
+        header as {"array_name", "dtype", "shape", "encoding"} instead of a list.
+        If coord_threshold is None, all coordinates are written to the header.
+        Dates and durations are written to the header as {"values", "dtype",
+        "shape", "encoding"}, with the same int64 values as their entries.
+        The dims of coordinates that are not dimensions themselves (e.g. a
+        date along obs, or a scalar left by a selection) are listed in the
+        "coord_dims" of the group header.
+
+        If dag_format is "csr", a DAG from `get_dag` in the "graph" attribute of
+        a group is written as the arrays dag/<group>/... (see `_encode_dag`),
+        and its description replaces it in the header.
+
+        Variables that are not in memory (backed by dask, or opened lazily from
+        netCDF or zarr) are read block by block (see `_block_slices`), with at
+        most block_size bytes per block, and streamed into their entries, so
+        they are never loaded whole. The next block is read while the current
+        one is compressed.
+
+        Only the groups named in groups, the variables selected by var_names
+        and filter_vars (see `_select_var_names`), and the coordinates selected
+        by coords (a mapping of {dimension: labels or slice}, as for .sel) are
+        written, if given. Groups left without variables are not written at
+        all. The selection is made before any data is read or converted.
+
+        If report is given (see `_new_report`), the time spent in each stage
+        and the arrays written for each variable are recorded in it.
+
+        Returns the header describing all of the groups.
+    """
+    if dag_format not in ("json", "csr"):
+        raise ValueError(f"Unknown dag_format {dag_format}; should be 'json' or 'csr'")
+    if report is None:
+        report = _new_report()
+    timings = report["timings"]
+    start = time.perf_counter()
+    # time already spent in stages, e.g. from other models of a multi model archive
+    other_stages = sum(timings[stage] for stage in ("conversion", "summary", "compression"))
 
     # standard arviz groups
     arviz_groups = [
@@ -113,37 +1341,461 @@ def arviz_to_json(inference_data, output_name):
         "predictions",
         "predictions_constant_data",
     ]
+    if isinstance(groups, str):
+        groups = [groups]
+    unknown = set(groups or []) - set(arviz_groups)
+    if unknown:
+        raise ValueError(f"Unknown groups {sorted(unknown)}; should be some of {arviz_groups}")
+    selected = {}
+    for group_name in arviz_groups:
+        if group_name in inference_data._groups and (groups is None or group_name in groups):
+            group = inference_data.__getattribute__(group_name)
+            if var_names is None:
+                selected[group_name] = group
+                continue
+            names = _select_var_names(list(group.data_vars), var_names, filter_vars)
+            if names:
+                selected[group_name] = group[names]
+    if var_names is not None and filter_vars is None:
+        found = {var for group in selected.values() for var in group.data_vars}
+        wanted = [var_names] if isinstance(var_names, str) else var_names
+        missing = [v for v in wanted if not v.startswith("~") and v not in found]
+        if missing:
+            raise ValueError(f"Variables {missing} are not in the selected groups")
+
     array_index = 0
-    arrays = {}
     array_headers = {}
 
-    for group_name in arviz_groups:
-        if group_name in inference_data._groups:
-            group = inference_data.__getattribute__(group_name)
-            header = {
-                "attrs": dict(group.attrs),
-                "dims": dict(group.dims),
-                "coords": {k: [i.item() for i in v] for k, v in group.coords.items()},
-                "vars": {},
-                "array_names":{}
+    for group_name, group in selected.items():
+        if coords:
+            # lazy for data not in memory, and a view for slices
+            group = group.sel({k: v for k, v in coords.items() if k in group.dims})
+        header = {
+            "attrs": dict(group.attrs),
+            "dims": dict(group.dims),
+            "coords": {},
+            "coord_dims": {},
+            "vars": {},
+            "array_names":{}
+        }
+        for k, v in group.coords.items():
+            if v.dims != (k,):
+                header["coord_dims"][k] = list(v.dims)
+            if coord_threshold is None or v.size <= coord_threshold:
+                header["coords"][k] = _header_coord(v.values)
+                continue
+            array_name = f"coords/{group_name}/{k}"
+            _report_variable(report, prefix + array_name, v.dtype)
+            with _timed(timings, "conversion"):
+                arr, encoding = _encode_coord(v.values)
+            header["coords"][k] = {
+                "array_name": array_name,
+                "dtype": v.dtype.str,
+                "shape": v.shape,
+                "encoding": encoding,
             }
-            for var, var_data in group.data_vars.items():
-                # ensure each array has a unique filename
-                array_name = f"{group_name}_{var}_{array_index}"
-                array_index += 1
-                # store the header for this array,
-                header["vars"][var] = {
-                    "dims": list(var_data.dims),
-                    "attrs": dict(var_data.attrs),
-                    "dtype": var_data.data.dtype.str,  # *Original* dtype, in case we are forced to convert
-                    "shape": var_data.data.shape,
-                    "array_name": array_name,
+            _report_write(report, npz, prefix + array_name, prefix + array_name, arr)
+        if dag_format == "csr" and isinstance(header["attrs"].get("graph"), dict):
+            with _timed(timings, "conversion"):
+                graph, dag_arrays = _encode_dag(
+                    header["attrs"]["graph"], f"dag/{group_name}/", coord_threshold
+                )
+            header["attrs"]["graph"] = graph
+            for array_name, arr in dag_arrays.items():
+                _report_variable(report, prefix + array_name, arr.dtype)
+                _report_write(report, npz, prefix + array_name, prefix + array_name, arr)
+        if summary:
+            with _timed(timings, "summary"):
+                stat_names, stats = _summary_stats(group, hdi_prob)
+        for var, var_data in group.data_vars.items():
+            # ensure each array has a unique filename
+            array_name = f"{group_name}_{var}_{array_index}"
+            array_index += 1
+            key = f"{prefix}{group_name}/{var}"
+            _report_variable(report, key, var_data.dtype)
+            # store the header for this array,
+            header["vars"][var] = {
+                "dims": list(var_data.dims),
+                "attrs": dict(var_data.attrs),
+                "dtype": var_data.dtype.str,  # *Original* dtype, in case we are forced to convert
+                "shape": var_data.shape,
+                "array_name": array_name,
+            }
+            filters = []
+            policy = (precision or {}).get(f"{group_name}/{var}", (precision or {}).get(group_name))
+            if policy is not None:
+                filt = _precision_filter(var_data, policy, block_size)
+                if filt is not None:
+                    filters.append(filt)
+            if filters:
+                header["vars"][var]["filters"] = filters
+
+            def encode(data):
+                with _timed(timings, "conversion"):
+                    arr = fix_dtype(data)
+                    for filt in filters:
+                        arr = _apply_filter(arr, filt)
+                return arr
+
+            def write(name, arr):
+                _report_write(report, npz, key, prefix + name, arr)
+
+            def stream(name):
+                slices = _block_slices(
+                    var_data.shape, var_data.dtype.itemsize, block_size, _source_chunks(var_data)
+                )
+                blocks = _prefetch(lambda index: var_data.variable[index].values, slices)
+
+                def encoded_blocks():
+                    while True:
+                        # includes waiting for the block to be read
+                        with _timed(timings, "conversion"):
+                            block = next(blocks, None)
+                        if block is None:
+                            return
+                        yield encode(block)
+
+                # the dtype the converted blocks will have
+                dtype = encode(np.empty(0, dtype=var_data.dtype)).dtype
+                _report_write_blocks(
+                    report, npz, key, prefix + name, var_data.shape, dtype, encoded_blocks()
+                )
+
+            grid = _chunk_grid(var_data, chunks) if chunks else None
+            if grid is None and not _in_memory(var_data):
+                stream(array_name)
+            elif grid is None:
+                write(array_name, encode(var_data.data))
+            else:
+                chunk_shape, n_chunks = grid
+                chunk_names = []
+                # chunks are written in C order of their index in the grid
+                for index in np.ndindex(*n_chunks):
+                    chunk_name = f"{array_name}/{'.'.join(map(str, index))}"
+                    slices = tuple(
+                        slice(i * size, (i + 1) * size) for i, size in zip(index, chunk_shape)
+                    )
+                    write(chunk_name, encode(var_data.variable[slices].values))
+                    chunk_names.append(chunk_name)
+                header["vars"][var]["chunks"] = {
+                    "shape": chunk_shape,
+                    "grid": n_chunks,
+                    "array_names": chunk_names,
                 }
-                arrays[array_name] = fix_dtype(var_data.data)
-                header["array_names"][var] = array_name
+            thin = lod_levels is not None or lod_target is not None
+            if thin and group_name in ("posterior", "prior") and "draw" in var_data.dims:
+                levels = []
+                for step in _lod_steps(var_data.sizes["draw"], lod_levels, lod_target):
+                    lod_name = f"{array_name}/lod{step}"
+                    thinned = var_data.isel(draw=slice(None, None, step))
+                    write(lod_name, encode(thinned.data))
+                    levels.append(
+                        {"step": step, "shape": thinned.shape, "array_name": lod_name}
+                    )
+                if levels:
+                    # coarsest level first, as it is the one clients load first
+                    header["vars"][var]["lod"] = levels[::-1]
+            if summary and var in stats:
+                summary_name = f"{array_name}/summary"
+                write(summary_name, stats[var])
+                header["vars"][var]["summary"] = {
+                    "stats": stat_names,
+                    "dims": [dim for dim in var_data.dims if dim not in ("chain", "draw")],
+                    "array_name": summary_name,
+                }
+            header["array_names"][var] = array_name
+
+        array_headers[group_name] = header
+    # everything that was not another stage went into building the header
+    stages = sum(timings[stage] for stage in ("conversion", "summary", "compression"))
+    timings["header"] += time.perf_counter() - start - (stages - other_stages)
+    return array_headers
+
+
+def arviz_to_json(
+    inference_data,
+    output_name,
+    compressed=True,
+    verbose=False,
+    workers=None,
+    align=None,
+    shuffle=False,
+    dedup=False,
+    store=None,
+    cache=None,
+    chunks=None,
+    summary=False,
+    hdi_prob=0.94,
+    lod_levels=None,
+    lod_target=None,
+    precision=None,
+    coord_threshold=1000,
+    dag_format="json",
+    block_size=2 ** 26,
+    groups=None,
+    var_names=None,
+    filter_vars=None,
+    coords=None,
+    on_report=None,
+):
+    """
+        Take an inference data Xarray object, and return a JSON representation
+        that can be loaded client-side, along with an NPZ file that holds the
+        array data.
+
+        Writes:            
+            <output_name>.npz: Arrays, as an NPZ file, with JSON included in archive
+
+        Parameters:
+        -----------
+
+        inference_data: An ARviz inference data object
+        output_name: The name of the output file
+        compressed: If True, deflate the arrays in the archive
+        verbose: If True, print the report of the export (see `format_report`)
+        workers: Number of threads (or an Executor) used to compress arrays concurrently
+        align: With compressed=False, start the data of every array on a multiple
+               of this many bytes (e.g. 64), so it can be viewed without copying
+        shuffle: If True, byte shuffle float arrays before compression, which usually
+                 compresses posterior samples much better. The shuffled entries
+                 are listed in the "filters" of header.json and undone on loading
+        dedup: If True, store identical arrays only once, under the hash of their
+               contents, listed in the "links" of header.json
+        store: Directory of arrays shared between exports (implies dedup), e.g. for
+               nightly runs: arrays already in the store are only referenced from
+               the "external" map of header.json, and new arrays are added to it
+        cache: An EntryCache, or the directory of one. Arrays that were already
+               encoded in an earlier export are copied from the cache rather
+               than compressed again, so re-exporting an unchanged model only
+               costs a hash of each array
+        chunks: Mapping of {dimension: chunk size}, e.g. {"chain": 1, "draw": 1000}.
+                Variables larger than one chunk are written as one entry per chunk,
+                listed in the "chunks" field of the variable's header, so that
+                clients can use the first chunks while the rest are loading
+        summary: If True, also write the mean, sd, HDI, bulk ESS and R-hat of every
+                 variable with chain and draw dimensions, for every coordinate,
+                 so clients that only show summaries need not load the draws
+        hdi_prob: Probability of the HDI in the summary
+        lod_levels: Number of thinned levels of detail (every 2nd, 4th, 8th... draw)
+                    to write for each posterior and prior variable, listed coarsest
+                    first in the "lod" field of the variable's header
+        lod_target: Instead of lod_levels, keep adding levels until the coarsest
+                    has at most this many draws
+        precision: Lossy encoding of float variables, as a mapping from "<group>" or
+                   "<group>/<var>" to "f4" (downcast), "u1"/"u2" (linear quantization)
+                   or an int (significant digits), e.g. {"posterior": "f4",
+                   "posterior_predictive": "u2"}. The maximum absolute error is
+                   recorded in the "filters" field of each variable's header
+        coord_threshold: Coordinates with more values than this are written as
+                         binary arrays rather than JSON lists in the header, and
+                         reattached on loading. None to always use JSON lists
+        dag_format: "json" to write a DAG from `get_dag`, stored in the "graph"
+                    attribute of a group (e.g. sample_stats), to the header as it
+                    is, or "csr" to write it as binary adjacency arrays and a
+                    table of nodes, which keeps the header small for models with
+                    thousands of nodes. The graph is rebuilt on loading
+        block_size: Variables that are not in memory (dask arrays, or data opened
+                    lazily from netCDF or zarr) are exported block by block, with
+                    blocks of at most this many bytes, so that the export needs
+                    memory for a few blocks rather than for the whole variable
+        groups: Name or list of names of the groups to write (default: all)
+        var_names: Name or list of names of the variables to write, in every
+                   group; names prefixed with "~" are left out instead. Groups
+                   left without variables are not written
+        filter_vars: None to match var_names exactly, "like" to match variables
+                     containing them, or "regex" to match them as regular
+                     expressions, as in ArviZ
+        coords: Mapping of {dimension: labels or slice} selecting the part of
+                every group to write, as for Dataset.sel, e.g.
+                {"draw": slice(0, 500), "obs": ["a", "b"]}. Groups without
+                the dimension are written whole
+        on_report: Called with the report of the export, e.g. to send it to a
+                   metrics system
+
+        Returns a report of the export: the time spent in each stage, and for
+        each variable its raw and compressed size, compression ratio and any
+        dtype coercion. See `_new_report` for its fields.
+
+    """
+    # written to a temporary file first, so a failed export leaves no output
+    with _replacing(output_name) as path, NpzWriter(
+        path,
+        compressed=compressed,
+        workers=workers,
+        align=align,
+        shuffle=shuffle,
+        dedup=dedup,
+        store=store,
+        cache=cache,
+    ) as npz:
+        report = _new_report()
+        start = time.perf_counter()
+        array_headers = _write_groups(
+            inference_data,
+            npz,
+            report=report,
+            chunks=chunks,
+            summary=summary,
+            hdi_prob=hdi_prob,
+            lod_levels=lod_levels,
+            lod_target=lod_target,
+            precision=precision,
+            coord_threshold=coord_threshold,
+            dag_format=dag_format,
+            block_size=block_size,
+            groups=groups,
+            var_names=var_names,
+            filter_vars=filter_vars,
+            coords=coords,
+        )
+        return _finish_export(npz, array_headers, report, start, verbose, on_report)
+
+
+class NpzAppender:
+    """
+        Build an archive while sampling is still running, by appending batches
+        of draws to it.
 
-            array_headers[group_name] = header
+        Each call to `append` opens the archive in append mode, writes the new
+        draws of every variable as a new chunk entry, then writes an updated
+        header; no existing entry is rewritten. The archive is a complete npz
+        file once each append returns, so clients can poll it and fetch only
+        the chunks that they do not already have. While an append is running,
+        the new entries overwrite the old central directory until the new one
+        is written at the end, so a reader that opens the archive during an
+        append can see an incomplete zip file (zipfile.BadZipFile, or a
+        failed range request in JS), and should retry.
 
-    write_for_js(output_name, array_headers, arrays)
+            appender = NpzAppender("run.npz")
+            for batch in batches:        # e.g. collected by a sampler callback
+                appender.append(batch)   # an InferenceData of the new draws
 
+        Variables with the dimension `dim` are concatenated along it. Their
+        chunks are listed in the "chunks" field of the variable's header, with
+        the start of each chunk in "offsets". Variables without it (e.g. in
+        observed_data) are written once, from the first batch that has them.
+        Appending to an existing archive continues from its header; the
+        archive must have been written by NpzAppender.
+
+        Parameters:
+        -----------
+
+        npz_file:   The name of the archive
+        compressed: If True, deflate each array entry
+        shuffle:    If True, byte shuffle float arrays (see NpzWriter)
+        dim:        The dimension that batches are appended along
+    """
+
+    def __init__(self, npz_file, compressed=True, shuffle=False, dim="draw"):
+        self.npz_file = npz_file
+        self.compressed = compressed
+        self.shuffle = shuffle
+        self.dim = dim
+        self.header = {}
+        self.filters = {}
+        if os.path.exists(npz_file):
+            with zipfile.ZipFile(npz_file) as z:
+                if "header.json" not in z.namelist():
+                    raise ValueError(f"{npz_file} has no header.json to append to")
+                output = json.loads(z.read("header.json"))
+            self.header = output["inference_data"]
+            self.filters = output.get("filters", {})
+            for group_name, group_header in self.header.items():
+                for var, var_header in group_header["vars"].items():
+                    appended = "offsets" in var_header.get("chunks", {})
+                    if dim in var_header["dims"] and not appended:
+                        raise ValueError(
+                            f"{npz_file} was not written by NpzAppender: {group_name}/{var} "
+                            f"is not stored as chunks appended along {dim}"
+                        )
+
+    def append(self, inference_data):
+        """Append a batch of draws, given as an InferenceData object"""
+        mode = "a" if os.path.exists(self.npz_file) else "w"
+        with NpzWriter(
+            self.npz_file, compressed=self.compressed, shuffle=self.shuffle, mode=mode
+        ) as npz:
+            for group_name in inference_data._groups:
+                self._append_group(npz, group_name, getattr(inference_data, group_name))
+            # the header lists the filters of every entry, not just the new ones
+            self.filters.update(npz._filters)
+            npz._filters = dict(self.filters)
+            npz.write_header(self.header)
+
+    def _append_group(self, npz, group_name, group):
+        """Write the arrays of one group of a batch, and update its header"""
+        dim = self.dim
+        group_header = self.header.setdefault(
+            group_name,
+            {
+                "attrs": dict(group.attrs),
+                "dims": {},
+                "coords": {},
+                "coord_dims": {},
+                "vars": {},
+                "array_names": {},
+            },
+        )
+        for var, var_data in group.data_vars.items():
+            var_header = group_header["vars"].get(var)
+            if var_header is not None and dim not in var_data.dims:
+                # written with an earlier batch
+                continue
+            if var_header is None:
+                n_vars = sum(len(g["vars"]) for g in self.header.values())
+                var_header = group_header["vars"][var] = {
+                    "dims": list(var_data.dims),
+                    "attrs": dict(var_data.attrs),
+                    "dtype": var_data.dtype.str,
+                    "shape": list(var_data.shape),
+                    "array_name": f"{group_name}_{var}_{n_vars}",
+                }
+                if dim not in var_data.dims:
+                    npz.write_array(var_header["array_name"], fix_dtype(var_data.data))
+                    continue
+                axis = var_data.dims.index(dim)
+                var_header["shape"][axis] = 0
+                grid = [1] * var_data.ndim
+                grid[axis] = 0
+                var_header["chunks"] = {
+                    "shape": list(var_data.shape),
+                    "grid": grid,
+                    "array_names": [],
+                    "offsets": [],
+                }
+            axis = var_data.dims.index(dim)
+            expected = list(var_header["shape"])
+            expected[axis] = var_data.shape[axis]
+            if list(var_data.dims) != var_header["dims"] or list(var_data.shape) != expected:
+                raise ValueError(
+                    f"{group_name}/{var} has dims {var_data.sizes} in this batch, "
+                    f"which do not match the archive ({var_header['dims']}, {var_header['shape']})"
+                )
+            chunks = var_header["chunks"]
+            name = f"{var_header['array_name']}/{len(chunks['array_names'])}"
+            npz.write_array(name, fix_dtype(var_data.data))
+            offset = [0] * var_data.ndim
+            offset[axis] = var_header["shape"][axis]
+            chunks["array_names"].append(name)
+            chunks["offsets"].append(offset)
+            chunks["grid"][axis] += 1
+            var_header["shape"][axis] += var_data.shape[axis]
 
+        for d, size in group.sizes.items():
+            if d == dim:
+                group_header["dims"][d] = group_header["dims"].get(d, 0) + size
+            else:
+                group_header["dims"].setdefault(d, size)
+        # (archives appended to by older versions have no coord_dims)
+        coord_dims = group_header.setdefault("coord_dims", {})
+        for k, v in group.coords.items():
+            if v.dims != (k,):
+                coord_dims.setdefault(k, list(v.dims))
+            coord = _header_coord(v.values)
+            if dim not in v.dims or k not in group_header["coords"]:
+                group_header["coords"].setdefault(k, coord)
+            elif isinstance(coord, dict):
+                group_header["coords"][k]["values"].extend(coord["values"])
+                group_header["coords"][k]["shape"][0] += coord["shape"][0]
+            else:
+                group_header["coords"][k].extend(coord)
@@ -0,0 +1,103 @@
+import os
+import struct
+from collections import OrderedDict
+
+# crc and uncompressed size of the npy file, before the payload
+_ENTRY_HEADER = struct.Struct("<IQ")
+
+
+class EntryCache:
+    """
+        An on-disk cache of encoded (and possibly compressed) npy entries, so
+        that exporting an unchanged array again only costs a hash of its
+        contents rather than a full deflate pass.
+
+        Entries are keyed by the `_content_hash` of the converted array and
+        whether it was compressed, and stored as one file per entry. The cache
+        is bounded in size; when it grows beyond max_bytes, the least recently
+        used entries (by file modification time, which is updated on every
+        hit) are deleted. Files are written atomically, so a cache directory
+        can be shared by several processes.
+
+            cache = EntryCache("~/.cache/arviz_json", max_bytes=2**30)
+            arviz_to_json(data, "model.npz", cache=cache)
+
+        Parameters:
+        -----------
+
+        directory: The directory holding the cached entries
+        max_bytes: The maximum total size of the cached entries
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        # {key: size}, least recently used first
+        entries = [
+            e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith(".tmp")
+        ]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        self._sizes = OrderedDict((e.name, e.stat().st_size) for e in entries)
+        self._total = sum(self._sizes.values())
+        self.hits = 0
+        self.misses = 0
+        # max_bytes may be smaller than when the cache was last used
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the cached (crc, size, payload) for key, or None"""
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # possibly evicted by another process
+            self._forget(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        size = self._sizes.pop(key, None)
+        if size is None:
+            self._total += len(data)
+        self._sizes[key] = len(data)
+        crc, file_size = _ENTRY_HEADER.unpack_from(data)
+        return crc, file_size, data[_ENTRY_HEADER.size :]
+
+    def put(self, key, crc, file_size, payload):
+        """Add an encoded entry, evicting the least recently used entries if
+        the cache is now too large"""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_ENTRY_HEADER.pack(crc, file_size))
+            f.write(payload)
+        os.replace(tmp_path, path)
+        self._forget(key)
+        self._sizes[key] = _ENTRY_HEADER.size + len(payload)
+        self._total += self._sizes[key]
+        self._evict()
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache fits in
+        max_bytes, always keeping the most recent entry"""
+        while self._total > self.max_bytes and len(self._sizes) > 1:
+            self._remove(next(iter(self._sizes)))
+
+    def _forget(self, key):
+        self._total -= self._sizes.pop(key, 0)
+
+    def _remove(self, key):
+        self._forget(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Delete every cached entry"""
+        for key in list(self._sizes):
+            self._remove(key)
@@ -0,0 +1,334 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .arviz_json import _replacing, arviz_to_json, multi_arviz_to_json
+
+# prefix of the zip comment recording what an archive was written from
+_EXPORT_COMMENT = b"arviz_json export:"
+
+
+def find_inputs(paths):
+    """
+        Expand a list of files, directories and glob patterns into the list of
+        InferenceData files to convert: netCDF files (.nc) and zarr stores
+        (.zarr directories). Directories are searched recursively.
+    """
+    inputs = []
+    for path in paths:
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        for match in sorted(matches):
+            if os.path.isdir(match) and not match.rstrip("/\\").endswith(".zarr"):
+                for root, dirs, files in os.walk(match):
+                    dirs.sort()
+                    inputs += [os.path.join(root, d) for d in dirs if d.endswith(".zarr")]
+                    # zarr stores are inputs, not directories to search
+                    dirs[:] = [d for d in dirs if not d.endswith(".zarr")]
+                    inputs += [os.path.join(root, f) for f in sorted(files) if f.endswith(".nc")]
+            elif os.path.exists(match):
+                inputs.append(match)
+            else:
+                raise FileNotFoundError(f"No such input: {match}")
+    return inputs
+
+
+def _files(path):
+    """All files of an input; a zarr store is a directory of files"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(root, f) for root, dirs, files in os.walk(path) for f in files
+    )
+
+
+def source_hash(path):
+    """Hash of the contents of an input file or zarr store"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in _files(path):
+        digest.update(os.path.relpath(name, path).encode())
+        with open(name, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def is_up_to_date(sources, output, options, skip="mtime"):
+    """
+        Whether output need not be written again. It must be a complete
+        archive written with the same writer options (see `record_export`);
+        with skip="mtime", it must also be newer than every file of its
+        sources, and with skip="hash", the hash of the sources recorded in it
+        must match. With skip="none", outputs are always written.
+    """
+    if skip == "none" or not os.path.exists(output):
+        return False
+    try:
+        with zipfile.ZipFile(output) as z:
+            names = z.namelist()
+            comment = z.comment
+    except zipfile.BadZipFile:
+        return False
+    # the header is written last, so an archive without one is incomplete
+    if not any(n == "header.json" or n.endswith(("/header.json", ".npz")) for n in names):
+        return False
+    recorded = {}
+    if comment.startswith(_EXPORT_COMMENT):
+        recorded = json.loads(comment[len(_EXPORT_COMMENT) :])
+    if recorded.get("options") != _options_hash(options):
+        return False
+    if skip == "mtime":
+        newest = max(os.path.getmtime(f) for source in sources for f in _files(source))
+        return os.path.getmtime(output) >= newest
+    return recorded.get("source") == _sources_hash(sources)
+
+
+def _sources_hash(sources):
+    if len(sources) == 1:
+        return source_hash(sources[0])
+    return hashlib.blake2b(
+        "".join(source_hash(source) for source in sources).encode(), digest_size=16
+    ).hexdigest()
+
+
+def _options_hash(options):
+    return hashlib.blake2b(
+        json.dumps(options, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+def record_export(output, options, sources=None):
+    """Record the hash of the writer options, and of the sources if given, in
+    the zip comment of the output"""
+    recorded = {"options": _options_hash(options)}
+    if sources is not None:
+        recorded["source"] = _sources_hash(sources)
+    with zipfile.ZipFile(output, "a") as z:
+        z.comment = _EXPORT_COMMENT + json.dumps(recorded, sort_keys=True).encode()
+
+
+def load_inference_data(path):
+    """Load an InferenceData object from a netCDF file or a zarr store"""
+    import arviz as az
+
+    if os.path.isdir(path):
+        return az.InferenceData.from_zarr(path)
+    return az.from_netcdf(path)
+
+
+def _model_name(path):
+    return os.path.splitext(os.path.basename(path.rstrip("/\\")))[0]
+
+
+def export_file(source, output, options, skip="mtime"):
+    """Convert one input to an archive; module level, so that it can be run
+    in a process pool. Returns the time taken, or None if it was skipped"""
+    if is_up_to_date([source], output, options, skip):
+        return None
+    start = time.perf_counter()
+    # the output is only replaced once it is complete, including its comment
+    with _replacing(output) as path:
+        arviz_to_json(load_inference_data(source), path, **options)
+        record_export(path, options, [source] if skip == "hash" else None)
+    return time.perf_counter() - start
+
+
+def _parse_mapping(items, convert=str):
+    """Parse ["key=value", ...] into {key: convert(value)}"""
+    mapping = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"Expected key=value, got {item}")
+        mapping[key] = convert(value)
+    return mapping
+
+
+def _precision_policy(value):
+    return int(value) if value.isdigit() else value
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog="arviz-json",
+        description="Convert ArviZ InferenceData files (netCDF .nc or .zarr) "
+        "to npz archives for loading in the browser.",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="Input files, directories (searched recursively) or glob patterns",
+    )
+    parser.add_argument(
+        "-o", "--output-dir", help="Directory for the archives (default: next to each input)"
+    )
+    parser.add_argument(
+        "-m", "--multi", metavar="ZIP", help="Pack every input into this one multi-model zip file"
+    )
+    parser.add_argument(
+        "--layout", choices=["nested", "flat"], default="nested", help="Layout of a --multi zip"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=os.cpu_count(),
+        help="Number of worker processes (default: one per core)",
+    )
+    parser.add_argument(
+        "--skip", choices=["mtime", "hash", "none"], default="mtime",
+        help="Skip outputs that are newer than their input (mtime), that were "
+        "written from identical input (hash), or never (none). Outputs written "
+        "with different writer options are never skipped",
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not show progress")
+
+    writer = parser.add_argument_group("writer options (see arviz_to_json)")
+    writer.add_argument("--uncompressed", action="store_true", help="Store arrays without deflate")
+    writer.add_argument("--align", type=int, help="Align uncompressed arrays to this many bytes")
+    writer.add_argument("--shuffle", action="store_true", help="Byte shuffle float arrays")
+    writer.add_argument("--dedup", action="store_true", help="Store identical arrays once")
+    writer.add_argument("--store", help="Directory of arrays shared between archives")
+    writer.add_argument("--cache", help="Directory of an EntryCache of encoded arrays")
+    writer.add_argument(
+        "--chunks", nargs="*", metavar="DIM=SIZE", help="Chunk sizes, e.g. chain=1 draw=1000"
+    )
+    writer.add_argument("--summary", action="store_true", help="Write summary statistics")
+    writer.add_argument(
+        "--hdi-prob", type=float, default=0.94, help="Probability of the summary HDI"
+    )
+    writer.add_argument("--lod-levels", type=int, help="Number of thinned levels of detail")
+    writer.add_argument("--lod-target", type=int, help="Draws in the coarsest level of detail")
+    writer.add_argument(
+        "--precision", nargs="*", metavar="GROUP[/VAR]=POLICY",
+        help="Lossy float encodings, e.g. posterior=f4 posterior_predictive=u2 posterior/mu=3",
+    )
+    writer.add_argument(
+        "--coord-threshold", type=int, default=1000,
+        help="Write coordinates with more values than this as binary arrays",
+    )
+    writer.add_argument(
+        "--block-size", type=int, default=2 ** 26,
+        help="Export variables that are not in memory in blocks of at most this many bytes",
+    )
+    writer.add_argument("--groups", nargs="+", help="Only write these groups")
+    writer.add_argument(
+        "--var-names", nargs="+", help="Only write these variables; prefix a name with ~ to skip it"
+    )
+    writer.add_argument(
+        "--filter-vars", choices=["like", "regex"], help="Match --var-names as substrings or regexes"
+    )
+    writer.add_argument(
+        "--dag-format", choices=["json", "csr"], default="json",
+        help="Write the model DAG in the graph attribute as JSON, or as binary arrays (csr)",
+    )
+    return parser
+
+
+def writer_options(args):
+    """Keyword arguments of arviz_to_json given by the command line options"""
+    options = dict(
+        compressed=not args.uncompressed,
+        align=args.align,
+        shuffle=args.shuffle,
+        dedup=args.dedup,
+        store=args.store,
+        cache=args.cache,
+        summary=args.summary,
+        hdi_prob=args.hdi_prob,
+        lod_levels=args.lod_levels,
+        lod_target=args.lod_target,
+        coord_threshold=args.coord_threshold,
+        dag_format=args.dag_format,
+        block_size=args.block_size,
+        groups=args.groups,
+        var_names=args.var_names,
+        filter_vars=args.filter_vars,
+    )
+    if args.chunks:
+        options["chunks"] = _parse_mapping(args.chunks, int)
+    if args.precision:
+        options["precision"] = _parse_mapping(args.precision, _precision_policy)
+    return options
+
+
+def _output_name(source, output_dir):
+    directory = output_dir if output_dir is not None else os.path.dirname(source.rstrip("/\\"))
+    return os.path.join(directory, _model_name(source) + ".npz")
+
+
+def _name_collisions(names):
+    """{name: sources} of the names given to more than one input, from
+    {source: name}"""
+    sources = {}
+    for source, name in names.items():
+        sources.setdefault(name, []).append(source)
+    return {name: paths for name, paths in sources.items() if len(paths) > 1}
+
+
+def main(argv=None):
+    """Entry point of the arviz-json console script"""
+    args = make_parser().parse_args(argv)
+    try:
+        inputs = find_inputs(args.inputs)
+    except FileNotFoundError as e:
+        print(e, file=sys.stderr)
+        return 2
+    options = writer_options(args)
+    log = (lambda *a: None) if args.quiet else (lambda *a: print(*a, file=sys.stderr))
+    if not inputs:
+        log("No .nc or .zarr inputs found")
+        return 0
+
+    # inputs with the same name (e.g. a/m.nc and b/m.nc, or m.nc and m.zarr)
+    # would be written to the same archive, or the same model of --multi
+    if args.multi:
+        names = {source: _model_name(source) for source in inputs}
+    else:
+        names = {source: _output_name(source, args.output_dir) for source in inputs}
+    collisions = _name_collisions(names)
+    if collisions:
+        for name, sources in collisions.items():
+            print(f"{', '.join(sources)} would all be written to {name}", file=sys.stderr)
+        return 2
+
+    if args.multi:
+        options["layout"] = args.layout
+        if is_up_to_date(inputs, args.multi, options, args.skip):
+            log(f"{args.multi} is up to date")
+            return 0
+        start = time.perf_counter()
+        models = {names[source]: load_inference_data(source) for source in inputs}
+        with _replacing(args.multi) as path:
+            multi_arviz_to_json(models, path, processes=args.jobs, **options)
+            record_export(path, options, inputs if args.skip == "hash" else None)
+        log(f"Wrote {len(models)} models to {args.multi} in {time.perf_counter() - start:.1f}s")
+        return 0
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    failed = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {
+            executor.submit(
+                export_file, source, names[source], options, args.skip
+            ): source
+            for source in inputs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            source = futures[future]
+            try:
+                elapsed = future.result()
+            except Exception as e:
+                failed += 1
+                log(f"[{done}/{len(inputs)}] {source}: failed ({e})")
+                continue
+            status = "up to date" if elapsed is None else f"{elapsed:.1f}s"
+            log(f"[{done}/{len(inputs)}] {source}: {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,26 +4,98 @@
 # * arrays, like the observed variables
 # * "utility constants", used internally, like pi
 
-import itertools
+import hashlib
 
+import numpy as np
 from theano.gof.graph import ancestors
 
 from pymc3.util import get_default_varnames
 import pymc3 as pm
 
 def is_constant(v):
-    if v.__class__.__name__.endswith("TensorConstant"):        
-        if len(v.shape.eval())==0:
-            return True
-    return False
-
-def powerset(iterable):
-    """All *nonempty* subsets of an iterable.
-    From itertools docs.
-    powerset([1,2,3]) --> (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)
+    """Whether v is a scalar constant; reads the constant's data directly
+    rather than compiling a function to evaluate its shape"""
+    return v.__class__.__name__.endswith("TensorConstant") and np.ndim(v.data) == 0
+
+def fold_graph(root, memo, combine, stop=None):
+    """Compute combine(node, [values of node's inputs]) for root and every one
+    of its ancestors, in post order, and return the value of root. Values are
+    stored in memo, so that a memo shared between calls visits each node once.
+    If stop(node) returns a value other than None, that is the value of node,
+    and its inputs are not visited."""
+    # iterative, as graphs can be deeper than the recursion limit
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        if node in memo:
+            stack.pop()
+            continue
+        value = stop(node) if stop is not None else None
+        if value is not None:
+            memo[node] = value
+            stack.pop()
+            continue
+        inputs = node.owner.inputs if node.owner is not None else []
+        pending = [i for i in inputs if i not in memo]
+        if pending:
+            stack.extend(pending)
+        else:
+            memo[node] = combine(node, [memo[i] for i in inputs])
+            stack.pop()
+    return memo[root]
+
+def _node_hash(node, input_hashes):
+    """Hash of a node of the graph, from its op, type, name and inputs, and
+    the values of constants"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((node.__class__.__name__, str(node.type), node.name)).encode())
+    if node.owner is not None:
+        h.update(repr((str(node.owner.op), node.index)).encode())
+    elif hasattr(node, "data"):
+        data = np.asarray(node.data)
+        h.update(repr((data.dtype.str, data.shape)).encode())
+        h.update(np.ascontiguousarray(data).tobytes())
+    for input_hash in input_hashes:
+        h.update(input_hash)
+    return h.digest()
+
+def _shape_data(v):
+    """The shapes of a named variable that appear in its DAG node; graphs of
+    variables that differ only in shape= can be identical"""
+    distribution = getattr(v, "distribution", None)
+    shape = getattr(distribution, "shape", None)
+    test_value = getattr(getattr(v, "tag", None), "test_value", None)
+    return (
+        None if shape is None else tuple(int(n) for n in np.atleast_1d(shape)),
+        int(v.dsize) if hasattr(v, "dsize") else None,
+        None if test_value is None else np.shape(test_value),
+    )
+
+def model_hash(model):
+    """
+        Structural hash of a PyMC3 model: the names, types, shapes and graphs
+        of its variables, the values of its constants, and its dims and coords.
+        Models that hash equal have the same DAG. This needs one pass over the
+        graph, with no compilation.
     """
-    s = list(iterable)
-    return itertools.chain.from_iterable(itertools.combinations(s, r) for r in range(1, len(s)+1))
+    memo = {}
+    h = hashlib.blake2b(digest_size=16)
+    for name, v in model.named_vars.items():
+        kinds = [
+            kind
+            for kind in ("free_RVs", "observed_RVs", "deterministics", "potentials", "missing_values")
+            if v in getattr(model, kind)
+        ]
+        h.update(repr((name, kinds, _shape_data(v))).encode())
+        h.update(fold_graph(v, memo, _node_hash))
+        for attr in ("logpt", "transformed"):
+            if hasattr(v, attr):
+                h.update(fold_graph(getattr(v, attr), memo, _node_hash))
+        if hasattr(v, "distribution"):
+            h.update(repr(v.distribution.__class__.__name__).encode())
+    h.update(repr(sorted((k, list(dims)) for k, dims in model.RV_dims.items())).encode())
+    h.update(repr(sorted((k, list(map(str, c))) for k, c in model.coords.items())).encode())
+    return h.hexdigest()
 
 class ModelGraph:
     def __init__(self, model):
@@ -31,45 +103,54 @@ class ModelGraph:
         self.var_names = get_default_varnames(self.model.named_vars, include_transformed=False)
         self.var_list = self.model.named_vars.values()
         self.transform_map = {v.transformed: v.name for v in self.var_list if hasattr(v, 'transformed')}
-        self._deterministics = None
-
-    def get_deterministics(self, var):
-        """Compute the deterministic nodes of the graph"""
-        deterministics = []
-        attrs = ('transformed', 'logpt')
-        for v in self.var_list:
-            if v != var and all(not hasattr(v, attr) for attr in attrs):
-                deterministics.append(v)
-        return deterministics
+        self._named = set(self.var_list)
+        # {theano variable: named variables reached first going up from it}
+        # and {theano variable: scalar constant ancestors}, shared by every
+        # variable of the model
+        self._frontier = {}
+        self._constants = {}
 
     def _ancestors(self, var, func, blockers=None):
         """Get ancestors of a function that are also named PyMC3 variables"""
-        return set([j for j in ancestors([func], blockers=blockers) if j in self.var_list and j != var])        
+        return set([j for j in ancestors([func], blockers=blockers) if j in self._named and j != var])        
         
     # apply constant identification *after* full model graph is computed
     # we then have all nodes at most one level away from the leaves, and we just
     # process each of these to find any constant parents that a node may have
     def _constant_parents(self, var, func):
-        return set([float(j.eval()) for j in ancestors([func]) if is_constant(j)])        
+        def combine(node, input_constants):
+            if is_constant(node):
+                return frozenset([float(node.data)])
+            return frozenset().union(*input_constants)
+
+        return set(fold_graph(func, self._constants, combine))
+
+    def _frontier_of(self, root):
+        """Named variables that are reached first going up the graph from root,
+        i.e. without passing through another named variable. A named root is
+        its own frontier. Memoized over the whole model, so computing the
+        parents of every variable visits each node of the graph only once."""
+        return fold_graph(
+            root,
+            self._frontier,
+            lambda node, input_frontiers: frozenset().union(*input_frontiers),
+            stop=lambda node: frozenset([node]) if node in self._named else None,
+        )
 
     def _get_ancestors(self, var, func):
-        """Get all ancestors of a function, doing some accounting for deterministics
-        Specifically, if a deterministic is an input, theano.gof.graph.ancestors will
-        return only the inputs *to the deterministic*.  However, if we pass in the
-        deterministic as a blocker, it will skip those nodes.
+        """Get the named variables that are direct inputs to func, i.e. those that
+        can be reached from it without passing through another named variable.
+        A deterministic input is therefore a parent, but its own inputs are not.
         """
-        deterministics = self.get_deterministics(var)
-        upstream = self._ancestors(var, func)
-
-        # Usual case
-        if upstream == self._ancestors(var, func, blockers=upstream):
-            return upstream
-        else: # deterministic accounting
-            for d in powerset(upstream):
-                blocked = self._ancestors(var, func, blockers=d)
-                if set(d) == blocked:
-                    return d
-        raise RuntimeError('Could not traverse graph. Consider raising an issue with developers.')
+        upstream = set(self._frontier_of(func))
+        if var in upstream:
+            # func is var itself (a deterministic), or var appears in its own logp
+            # (e.g. an observed variable with missing values): go through it
+            upstream.discard(var)
+            if var.owner is not None:
+                for i in var.owner.inputs:
+                    upstream |= self._frontier_of(i)
+        return upstream - {var}
 
     def _filter_parents(self, var, parents):
         """Get direct parents of a var, as strings"""
@@ -110,13 +191,15 @@ class ModelGraph:
             func = var
         return set(self._constant_parents(var, func))
 
-    def make_compute_graph(self):
-        """Get map of var_name -> set(input var names) for the model"""
+    def make_compute_graph(self, include_constants=True):
+        """Get map of var_name -> set(input var names) for the model,
+        including the values of scalar constant parents if include_constants is True"""
         input_map = {}
         for var_name in self.var_names:
             input_map[var_name] = self.get_parents(self.model[var_name])
             # add in constants
-            input_map[var_name] = input_map[var_name] | self.get_constant_parents(self.model[var_name])
+            if include_constants:
+                input_map[var_name] = input_map[var_name] | self.get_constant_parents(self.model[var_name])
             
         return input_map
 
@@ -1,5 +1,12 @@
+import copy
+from collections import OrderedDict
+
 import pymc3 as pm
-from arviz_json import arviz_to_json, pymc3_graph
+from . import pymc3_graph
+
+# {model_hash: variable descriptors} of the most recently extracted DAGs
+_dag_cache = OrderedDict()
+_DAG_CACHE_SIZE = 64
 
 def describe_distribution(d):
     """
@@ -24,8 +31,12 @@ def describe_distribution(d):
 def get_dag(model):
     """
     Return a description of the DAG of a PyMC3 model as a dictionary, 
-    using the model_graph module to get the graph, and interrogating 
+    using the pymc3_graph module to get the graph, and interrogating 
     each variable node to get some basic properties.
+
+    DAGs are memoized by the structural hash of the model (see `model_hash`),
+    so extracting the DAG of an unchanged model, or of an identical model,
+    again only costs one pass over its graph.
     
 
     Parameters:
@@ -49,12 +60,25 @@ def get_dag(model):
             }
     """
 
+    key = pymc3_graph.model_hash(model)
+    if key in _dag_cache:
+        _dag_cache.move_to_end(key)
+        return copy.deepcopy(_dag_cache[key])
+
+    variable_descriptor = _extract_dag(model)
+    _dag_cache[key] = variable_descriptor
+    if len(_dag_cache) > _DAG_CACHE_SIZE:
+        _dag_cache.popitem(last=False)
+    return copy.deepcopy(variable_descriptor)
+
+
+def _extract_dag(model):
     variable_descriptor = {}
     variables = model.named_vars
 
     # get the DAG for this model
-    graph = pm.model_graph.ModelGraph(model)
-    dag = graph.make_compute_graph()
+    graph = pymc3_graph.ModelGraph(model)
+    dag = graph.make_compute_graph(include_constants=False)
     dag = {k: list(v) for k, v in dag.items()}
 
     # iterate over named variables in the graph
@@ -0,0 +1,371 @@
+import json
+import os
+import struct
+import threading
+import zipfile
+
+import arviz as az
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+
+def decode_filters(arr, filters):
+    """Undo the encodings listed in the "filters" of a variable's header,
+    in reverse order, e.g. the quantization of arviz_to_json(..., precision=...)"""
+    for filt in reversed(filters):
+        if filt["id"] == "quantize":
+            decoded = filt["offset"] + filt["scale"] * np.asarray(arr, dtype=float)
+            if filt["nan_code"] is not None:
+                decoded[arr == filt["nan_code"]] = np.nan
+            arr = decoded
+        # "astype" and "round" leave valid floats, which need no decoding
+    return arr
+
+
+def decode_coord(arr, coord):
+    """Convert a coordinate written as an array entry, or as encoded values in
+    the header (see `_encode_coord`), back to its original dtype"""
+    encoding = coord["encoding"]
+    if encoding == "utf8":
+        arr = np.ascontiguousarray(arr).view(f"S{arr.shape[-1]}")[..., 0]
+        arr = np.char.decode(arr, "utf-8")
+    elif encoding is not None:
+        # integer nanoseconds, with NaT as the smallest int64
+        arr = np.asarray(arr, dtype="<i8").view(encoding)
+    return arr.astype(coord["dtype"], copy=False).reshape(coord["shape"])
+
+
+def decode_dag(graph, read_entry):
+    """Rebuild a DAG written with arviz_to_json(..., dag_format="csr") (see
+    `_encode_dag`) as the dict returned by `get_dag`, reading its arrays with
+    read_entry(name)"""
+    arrays = {field: read_entry(name) for field, name in graph["array_names"].items()}
+    names = decode_coord(read_entry(graph["names"]["array_name"]), graph["names"])
+    coords = {
+        dim: decode_coord(read_entry(values["array_name"]), values).tolist()
+        if isinstance(values, dict)
+        else values
+        for dim, values in graph["coords"].items()
+    }
+    offsets = arrays["parent_offsets"]
+    dag = {}
+    for i, name in enumerate(names.tolist()):
+        dims = graph["dims"][arrays["dims"][i]]
+        parents = arrays["parent_indices"][offsets[i] : offsets[i + 1]]
+        dag[name] = {
+            "name": name,
+            "type": graph["types"][arrays["type"][i]],
+            "parents": [str(names[p]) for p in parents],
+            "size": int(arrays["size"][i]),
+            "dims": dims,
+            "coords": {dim: coords[dim] for dim in dims if dim in coords},
+            "distribution": graph["distributions"][arrays["distribution"][i]],
+        }
+    return dag
+
+
+def _is_encoded_dag(graph):
+    return isinstance(graph, dict) and graph.get("encoding") == "csr"
+
+
+def _index_range(k, n):
+    """The indices of an axis of length n selected by an int or a slice"""
+    if isinstance(k, (int, np.integer)):
+        i = range(n)[k]
+        return range(i, i + 1)
+    return range(*k.indices(n))
+
+
+class _LazyEntryArray(BackendArray):
+    """An array entry of an archive that is only read when it is indexed.
+    Values are converted back to the original dtype recorded in the header.
+
+    Variables written in chunks only read the chunks an index touches. Other
+    variables are a single entry, which is read once and kept, so that each
+    dask chunk or selection does not decompress the whole entry again."""
+
+    def __init__(self, reader, group, var):
+        self.reader = reader
+        self.group = group
+        self.var = var
+        var_header = reader.header[group]["vars"][var]
+        self.shape = tuple(var_header["shape"])
+        self.dtype = np.dtype(var_header["dtype"])
+        self.filters = var_header.get("filters", [])
+        self.chunked = "chunks" in var_header
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        if self.chunked:
+            arr = self.reader.get_array(self.group, self.var, key)
+        else:
+            with self._lock:
+                if self._entry is None:
+                    self._entry = self.reader.get_array(self.group, self.var)
+            arr = self._entry[key]
+        arr = decode_filters(np.asarray(arr), self.filters)
+        return arr.astype(self.dtype, copy=False)
+
+
+class NpzReader:
+    """
+        Read an archive written by `arviz_to_json` without loading its arrays.
+
+        Only the central directory and `header.json` are read when the reader
+        is opened. Each array is only decompressed when it is requested; arrays
+        in uncompressed (STORED) entries of an archive on disk are memory mapped
+        directly from the zip file, without any copy.
+
+            reader = NpzReader("model.npz")
+            reader.groups                        # ["posterior", ...]
+            reader.variables("posterior")        # ["mu", "tau", ...]
+            reader.get_array("posterior", "mu")  # np.ndarray or np.memmap
+            data = reader.to_inference_data()    # lazily loaded InferenceData
+
+        Parameters:
+        -----------
+
+        npz_file: A filename or a readable, seekable file object
+        prefix:   Prefix of the entries of the model to read. For a
+                  `multi_arviz_to_json` archive written with layout="flat"
+                  this is "<model name>/"
+        store:    Directory of the shared array store of an archive written
+                  with arviz_to_json(..., store=...). Defaults to the store
+                  recorded in the archive, relative to the archive file
+    """
+
+    def __init__(self, npz_file, prefix="", store=None):
+        self.prefix = prefix
+        # memory mapping needs a real file on disk
+        if isinstance(npz_file, (str, os.PathLike)):
+            self.filename = os.fspath(npz_file)
+        else:
+            self.filename = None
+        self.zip = zipfile.ZipFile(npz_file, "r")
+        output = json.loads(self.zip.read(prefix + "header.json"))
+        self.header = output["inference_data"]
+        # entry level filters, e.g. byte shuffling
+        self.entry_filters = output.get("filters", {})
+        # deduplicated entries, in the archive and in the shared store
+        self.links = output.get("links", {})
+        self.external = output.get("external", {})
+        if store is None and "store" in output and self.filename is not None:
+            store = os.path.join(os.path.dirname(self.filename), output["store"])
+        self.store = store
+
+    @property
+    def groups(self):
+        """Names of the groups in the archive"""
+        return list(self.header)
+
+    def variables(self, group):
+        """Names of the variables in a group"""
+        return list(self.header[group]["vars"])
+
+    def _data_offset(self, info):
+        """Offset in the archive file of the first byte of the data of an entry"""
+        with open(self.filename, "rb") as f:
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+        # the local header is 30 bytes, then the filename and extra field,
+        # whose lengths are the last two fields of the fixed part
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        return info.header_offset + 30 + name_length + extra_length
+
+    def read_entry(self, name):
+        """
+            Return the array in the entry <prefix><name>.npy, undoing any
+            byte shuffling. Uncompressed, unshuffled entries are returned
+            as read-only memory maps when reading from a file on disk.
+        """
+        arr = self._read_npy(name)
+        for filt in reversed(self.entry_filters.get(name, [])):
+            if filt["id"] == "shuffle":
+                # plane k holds byte k of every element
+                arr = (
+                    np.ascontiguousarray(np.moveaxis(arr, 0, -1))
+                    .view(filt["dtype"])
+                    .reshape(arr.shape[1:])
+                )
+        return arr
+
+    def _read_npy(self, name):
+        if name in self.external:
+            if self.store is None:
+                raise ValueError(f"{name} is in a shared store, but no store was given")
+            return np.load(os.path.join(self.store, self.external[name]), mmap_mode="r")
+        if name in self.links:
+            info = self.zip.getinfo(self.links[name] + ".npy")
+        else:
+            info = self.zip.getinfo(self.prefix + name + ".npy")
+        with self.zip.open(info) as f:
+            if info.compress_type != zipfile.ZIP_STORED or self.filename is None:
+                return np.lib.format.read_array(f, allow_pickle=False)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            npy_offset = f.tell()
+        if 0 in shape:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(
+            self.filename,
+            dtype=dtype,
+            mode="r",
+            shape=shape,
+            order="F" if fortran_order else "C",
+            offset=self._data_offset(info) + npy_offset,
+        )
+
+    def get_array(self, group, var, key=None):
+        """
+            Return the array stored for a variable, exactly as written (i.e.
+            after any dtype conversion in `fix_dtype`). Variables written in
+            chunks are reassembled into a single array. If key is given (a
+            tuple of ints and slices, as in arr[key]), return only that part
+            of the array, reading only the chunks that it touches.
+        """
+        var_header = self.header[group]["vars"][var]
+        if "chunks" not in var_header:
+            arr = self.read_entry(var_header["array_name"])
+            return arr if key is None else arr[key]
+        shape = var_header["shape"]
+        key = tuple(key or ()) + (slice(None),) * (len(shape) - len(key or ()))
+        # the wanted indices along each axis, in increasing order
+        ranges = [_index_range(k, n) for k, n in zip(key, shape)]
+        flip = [r.step < 0 for r in ranges]
+        ranges = [r[::-1] if f else r for r, f in zip(ranges, flip)]
+        arr = None
+        for start, stop, name in self._chunk_extents(var_header):
+            # the wanted indices inside this chunk, and where they go in arr
+            inner, outer = [], []
+            for r, lo, hi in zip(ranges, start, stop):
+                first = min(len(r), max(0, -(-(lo - r.start) // r.step)))
+                last = min(len(r), max(0, -(-(hi - r.start) // r.step)))
+                if first == last:
+                    break
+                inner.append(slice(r[first] - lo, r[last - 1] - lo + 1, r.step))
+                outer.append(slice(first, last))
+            else:
+                chunk = self.read_entry(name)
+                if arr is None:
+                    arr = np.empty([len(r) for r in ranges], dtype=chunk.dtype)
+                arr[tuple(outer)] = chunk[tuple(inner)]
+        if arr is None:
+            # nothing was selected; the dtype is that of any chunk
+            dtype = self.read_entry(var_header["chunks"]["array_names"][0]).dtype
+            arr = np.empty([len(r) for r in ranges], dtype=dtype)
+        # undo the reversal of negative steps; integer indices drop their axis
+        return arr[
+            tuple(
+                0 if isinstance(k, (int, np.integer)) else slice(None, None, -1 if f else 1)
+                for k, f in zip(key, flip)
+            )
+        ]
+
+    def _chunk_extents(self, var_header):
+        """Yield (start, stop, entry name) of each chunk of a variable, from
+        its header alone"""
+        chunks = var_header["chunks"]
+        shape = var_header["shape"]
+        # chunks of appended archives (NpzAppender) give their own starts;
+        # each chunk ends where the next begins along the appended axis
+        offsets = chunks.get("offsets")
+        if offsets:
+            for i, (start, name) in enumerate(zip(offsets, chunks["array_names"])):
+                following = offsets[i + 1] if i + 1 < len(offsets) else shape
+                stop = [f if f > s else n for s, f, n in zip(start, following, shape)]
+                yield start, stop, name
+            return
+        for index, name in zip(np.ndindex(*chunks["grid"]), chunks["array_names"]):
+            start = [i * size for i, size in zip(index, chunks["shape"])]
+            stop = [min(s + size, n) for s, size, n in zip(start, chunks["shape"], shape)]
+            yield start, stop, name
+
+    def get_coord(self, group, coord):
+        """Return the values of a coordinate, whether it was written to the
+        header (as a list, or as encoded dates or durations) or as an array
+        entry"""
+        values = self.header[group]["coords"][coord]
+        if isinstance(values, dict) and "values" in values:
+            return decode_coord(values["values"], values)
+        if isinstance(values, dict):
+            return decode_coord(self.read_entry(values["array_name"]), values)
+        return values
+
+    def get_summary(self, group, var):
+        """Return the summary statistics written for a variable (arviz_to_json(...,
+        summary=True)) as a mapping of {stat name: array over the other dimensions}"""
+        summary = self.header[group]["vars"][var]["summary"]
+        arr = self.read_entry(summary["array_name"])
+        return dict(zip(summary["stats"], arr))
+
+    def get_dag(self, group="sample_stats"):
+        """Return the DAG stored in the "graph" attribute of a group, whether
+        it was written as JSON or as arrays (arviz_to_json(..., dag_format="csr"))"""
+        graph = self.header[group]["attrs"]["graph"]
+        if _is_encoded_dag(graph):
+            return decode_dag(graph, self.read_entry)
+        return graph
+
+    def to_dataset(self, group):
+        """Return a group as an xarray Dataset, whose variables are loaded lazily"""
+        group_header = self.header[group]
+        data_vars = {}
+        for var, var_header in group_header["vars"].items():
+            data = indexing.LazilyIndexedArray(_LazyEntryArray(self, group, var))
+            data_vars[var] = xr.Variable(var_header["dims"], data, var_header["attrs"])
+        # coordinates that are not dimensions are listed with their dims
+        coord_dims = group_header.get("coord_dims", {})
+        coords = {}
+        for k in group_header["coords"]:
+            if k in coord_dims:
+                coords[k] = (coord_dims[k], self.get_coord(group, k))
+            elif k in group_header["dims"]:
+                coords[k] = self.get_coord(group, k)
+        attrs = dict(group_header["attrs"])
+        if _is_encoded_dag(attrs.get("graph")):
+            attrs["graph"] = self.get_dag(group)
+        return xr.Dataset(data_vars, coords=coords, attrs=attrs)
+
+    def to_inference_data(self, chunks=None):
+        """
+            Return the archive as an ArviZ InferenceData object. No array is
+            read until it is accessed. If chunks is given (e.g. {"draw": 100}),
+            the variables are returned as dask arrays with those chunks.
+        """
+        datasets = {}
+        for group in self.groups:
+            dataset = self.to_dataset(group)
+            if chunks is not None:
+                dataset = dataset.chunk(
+                    {k: v for k, v in chunks.items() if k in dataset.dims}
+                )
+            datasets[group] = dataset
+        return az.InferenceData(**datasets)
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def json_to_arviz(npz_file, prefix="", chunks=None):
+    """
+        Open an archive written by `arviz_to_json` as a lazily loaded
+        InferenceData object. See NpzReader.
+    """
+    return NpzReader(npz_file, prefix=prefix).to_inference_data(chunks=chunks)
@@ -0,0 +1,338 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import zipfile
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+# the whole archive, e.g. for the range request loaders of js/npz.js
+ARCHIVE_PATH = "/archive.npz"
+
+_CONTENT_TYPES = {".json": "application/json", ".npz": "application/zip"}
+
+
+class _EntryCache:
+    """Thread safe LRU of decompressed entries, bounded in total bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._total += len(data)
+            while self._total > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._total -= len(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total = 0
+
+
+class ArchiveServer(ThreadingHTTPServer):
+    """
+        A small HTTP server for one archive written by `arviz_to_json` (or a
+        flat `multi_arviz_to_json` archive), so that browsers can fetch the
+        header and each array separately, rather than the whole archive:
+
+            GET /header.json            the header (/<model>/header.json for flat archives)
+            GET /<entry>.npy            one array, decompressed; arrays of a
+                                        shared store are served from the store
+            GET /archive.npz            the whole archive
+
+        Every resource supports HTTP Range requests and ETag/If-None-Match.
+        Entries are only decompressed to send a body, and whole entries are
+        kept in a bounded LRU cache in memory. If the archive is rewritten, it
+        is reopened on the next request. Use
+        `load_npz_served` in js/npz.js to load from it.
+
+            server = ArchiveServer("model.npz", ("127.0.0.1", 8000))
+            server.serve_forever()
+
+        Parameters:
+        -----------
+
+        archive: The filename of the archive
+        address: The (host, port) to listen on; port 0 picks a free port,
+                 available afterwards as server.server_address
+        cache_bytes: The maximum total size of the decompressed entries kept
+        allow_origin: Value of the Access-Control-Allow-Origin header, so that
+                      pages served from elsewhere can fetch from the server;
+                      None to leave it out
+    """
+
+    daemon_threads = True
+    # set to stop logging every request to stderr
+    quiet = False
+
+    def __init__(self, archive, address=("127.0.0.1", 8000), cache_bytes=2 ** 28, allow_origin="*"):
+        self.archive = os.fspath(archive)
+        self.allow_origin = allow_origin
+        self.cache = _EntryCache(cache_bytes)
+        self._lock = threading.Lock()
+        self._zip = None
+        self._stat = None
+        self.reopen()
+        super().__init__(address, _ArchiveRequestHandler)
+
+    def reopen(self):
+        """Open the archive again if it has changed on disk; returns the open
+        zip file and the version of the archive (which is part of every ETag)"""
+        with self._lock:
+            stat = os.stat(self.archive)
+            if self._stat is None or (stat.st_mtime_ns, stat.st_size) != self._stat:
+                # the old zip file is not closed here: requests still reading
+                # from it hold a reference, and it is closed once they finish
+                self._zip = zipfile.ZipFile(self.archive)
+                self._stat = (stat.st_mtime_ns, stat.st_size)
+                self._stores = {}
+                self.cache.clear()
+            return self._zip, f"{self._stat[0]:x}-{self._stat[1]:x}"
+
+    def _store_file(self, zip_file, name):
+        """Path of the store file holding the entry <name>, if it is one of the
+        "external" arrays of the header next to it, or None"""
+        prefix = name[: name.rfind("/") + 1]
+        if prefix not in self._stores:
+            try:
+                output = json.loads(zip_file.read(prefix + "header.json"))
+            except KeyError:
+                output = {}
+            store = output.get("store")
+            directory = os.path.dirname(os.path.abspath(self.archive))
+            self._stores[prefix] = (
+                output.get("external", {}),
+                os.path.join(directory, store) if store is not None else None,
+            )
+        external, store = self._stores[prefix]
+        array = name[len(prefix) :]
+        if array.endswith(".npy") and array[:-4] in external and store is not None:
+            return os.path.join(store, external[array[:-4]])
+        return None
+
+    def resource(self, path):
+        """Return the _Resource of a request path, or None. Nothing is read or
+        decompressed until its body is sent"""
+        zip_file, version = self.reopen()
+        if path == ARCHIVE_PATH:
+            return _Resource(
+                f'"{version}"',
+                _CONTENT_TYPES[".npz"],
+                self._stat[1],
+                lambda start, end: _read_file(self.archive, start, end),
+            )
+        name = path.lstrip("/")
+        content_type = _CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        try:
+            info = zip_file.getinfo(name)
+        except KeyError:
+            store_file = self._store_file(zip_file, name)
+            if store_file is None or not os.path.exists(store_file):
+                return None
+            # store files are named by the hash of their contents
+            return _Resource(
+                f'"{os.path.basename(store_file)}"',
+                content_type,
+                os.path.getsize(store_file),
+                lambda start, end: _read_file(store_file, start, end),
+            )
+        etag = hashlib.blake2b(f"{version}/{name}/{info.CRC}".encode(), digest_size=12)
+        return _Resource(
+            f'"{etag.hexdigest()}"',
+            content_type,
+            info.file_size,
+            lambda start, end: self._read_entry(zip_file, (version, name), info, start, end),
+        )
+
+    def _read_entry(self, zip_file, key, info, start, end):
+        """Yield bytes start:end of a decompressed entry. Whole entries go
+        through the cache; a range of an entry that is not cached is only
+        decompressed up to its end"""
+        data = self.cache.get(key)
+        whole = start == 0 and end == info.file_size
+        if data is None and whole and info.file_size <= self.cache.max_bytes:
+            data = zip_file.read(info)
+            self.cache.put(key, data)
+        if data is not None:
+            yield memoryview(data)[start:end]
+            return
+        with zip_file.open(info) as f:
+            f.seek(start)
+            yield from _read_blocks(f, end - start)
+
+    def server_close(self):
+        super().server_close()
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+                self._zip = None
+
+
+class _Resource:
+    """A resource of the server: its ETag, content type and size, and
+    read(start, end), which yields the bytes start:end of its body"""
+
+    def __init__(self, etag, content_type, size, read):
+        self.etag = etag
+        self.content_type = content_type
+        self.size = size
+        self.read = read
+
+
+def _read_blocks(f, length, block_size=2 ** 20):
+    """Yield length bytes of a file object, in blocks"""
+    while length > 0:
+        block = f.read(min(length, block_size))
+        if not block:
+            break
+        yield block
+        length -= len(block)
+
+
+def _read_file(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        yield from _read_blocks(f, end - start)
+
+
+def parse_range(header, size):
+    """
+        Parse a Range header for a resource of size bytes. Returns (start, end)
+        of the requested bytes (end exclusive), None to send the whole resource
+        (no header, or a form that is not supported, such as several ranges),
+        or False if the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # the last n bytes
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = size if last == "" else min(int(last) + 1, size)
+    if start >= size or start >= end:
+        return False
+    return start, end
+
+
+class _ArchiveRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def _respond(self, send_body):
+        path = unquote(urlsplit(self.path).path)
+        resource = self.server.resource(path)
+        if resource is None:
+            self._send_status(HTTPStatus.NOT_FOUND)
+            return
+        etag, size = resource.etag, resource.size
+
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None and etag in {t.strip() for t in if_none_match.split(",")}:
+            self._send_status(HTTPStatus.NOT_MODIFIED, etag)
+            return
+        byte_range = parse_range(self.headers.get("Range"), size)
+        # a Range with If-Range only applies if the resource has not changed
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            byte_range = None
+        if byte_range is False:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self._send_common_headers(etag)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = byte_range or (0, size)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+        self._send_common_headers(etag)
+        self.send_header("Content-Type", resource.content_type)
+        self.send_header("Content-Length", str(end - start))
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+        self.end_headers()
+        if send_body:
+            for block in resource.read(start, end):
+                self.wfile.write(block)
+
+    def _send_common_headers(self, etag=None):
+        self.send_header("Accept-Ranges", "bytes")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if self.server.allow_origin is not None:
+            self.send_header("Access-Control-Allow-Origin", self.server.allow_origin)
+            self.send_header(
+                "Access-Control-Expose-Headers", "Content-Range, Content-Length, ETag"
+            )
+
+    def _send_status(self, status, etag=None):
+        self.send_response(status)
+        self._send_common_headers(etag)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve_archive(archive, host="127.0.0.1", port=8000, **options):
+    """Serve an archive (see ArchiveServer) until interrupted"""
+    with ArchiveServer(archive, (host, port), **options) as server:
+        host, port = server.server_address[:2]
+        print(f"Serving {archive} on http://{host}:{port}/", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m arviz_json.server",
+        description="Serve the header and arrays of an archive as separate resources.",
+    )
+    parser.add_argument("archive", help="The archive to serve")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--cache-bytes", type=int, default=2 ** 28, help="Memory for decompressed arrays"
+    )
+    args = parser.parse_args(argv)
+    serve_archive(args.archive, args.host, args.port, cache_bytes=args.cache_bytes)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""
+    Benchmarks of export throughput, memory use and DAG extraction.
+
+    Each benchmark records the best wall time over a number of repeats, the
+    peak memory allocated while it runs (measured with tracemalloc, in a
+    separate run so that tracing does not slow the timed runs) and the size
+    of its output. Results can be saved, and compared against a saved
+    baseline:
+
+        python benchmarks/run_benchmarks.py --save baseline.json
+        ... change something ...
+        python benchmarks/run_benchmarks.py --compare baseline.json
+
+    --compare exits with status 1 if any benchmark is slower, or uses more
+    memory, than the baseline by more than --tolerance (default 20%). Times
+    must also have grown by more than --min-time (default 1 ms), so that the
+    noise of sub-millisecond benchmarks is not reported as a regression.
+    The package is imported from this checkout, so it need not be installed.
+    get_dag benchmarks are skipped if PyMC3 is not installed. The start-up
+    benchmark times `import arviz_json` in a fresh interpreter. Its peak
+    memory is traced inside that interpreter, and instead of an output size
+    it records the number of modules that the import loaded.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import arviz as az
+import numpy as np
+
+# the checkout this script is in, so that it runs without installing the package
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from arviz_json import arviz_to_json, fix_dtype, multi_arviz_to_json
+
+# (chains, draws, observations) of the synthetic InferenceData
+EXPORT_SIZES = [(2, 500, 10), (4, 1000, 100), (4, 2000, 1000), (8, 5000, 2000)]
+MULTI_SIZES = [10, 50, 200]
+DAG_SIZES = [10, 50, 200]
+FIX_DTYPES = ["bool", "<i8", "<u8", "|u1", "|i1", "<u2", "<u4", "<i4", "<f4", "<f8"]
+
+
+def synthetic_inference_data(chains, draws, n_obs, seed=0):
+    """InferenceData with the groups of a typical regression model, with
+    scalar, vector and per-observation variables"""
+    rng = np.random.default_rng(seed)
+    sample = lambda *shape: rng.normal(size=(chains, draws) + shape)
+    coords = {"obs": np.arange(n_obs), "coef": ["a", "b", "c"]}
+    dims = {"beta": ["coef"], "y": ["obs"], "mu": ["obs"]}
+    return az.from_dict(
+        posterior={"sigma": np.abs(sample()), "beta": sample(3), "mu": sample(n_obs)},
+        posterior_predictive={"y": sample(n_obs)},
+        log_likelihood={"y": sample(n_obs)},
+        sample_stats={
+            "lp": sample(),
+            "diverging": rng.random((chains, draws)) < 0.01,
+            "tree_depth": rng.integers(1, 10, size=(chains, draws)),
+        },
+        observed_data={"y": rng.normal(size=n_obs)},
+        constant_data={"x": rng.normal(size=(n_obs, 3))},
+        coords=coords,
+        dims=dims,
+    )
+
+
+def synthetic_pymc3_model(n_nodes, seed=0):
+    """A PyMC3 model of n_nodes random variables, each depending on up to
+    three earlier ones, with observed, deterministic and potential nodes"""
+    import pymc3 as pm
+
+    rng = np.random.default_rng(seed)
+    with pm.Model() as model:
+        nodes = [pm.Normal("x0", mu=0, sd=1)]
+        for i in range(1, n_nodes):
+            parents = rng.choice(len(nodes), size=min(3, len(nodes)), replace=False)
+            mu = sum(nodes[p] for p in parents)
+            kind = i % 10
+            if kind == 7:
+                nodes.append(pm.Deterministic(f"x{i}", mu * 2))
+            elif kind == 8:
+                pm.Potential(f"x{i}", -(mu ** 2))
+            elif kind == 9:
+                pm.Normal(f"x{i}", mu=mu, sd=1, observed=rng.normal(size=10))
+            else:
+                nodes.append(pm.Normal(f"x{i}", mu=mu, sd=1))
+    return model
+
+
+def _file_size(path):
+    return os.path.getsize(path)
+
+
+def export_benchmarks(sizes, workdir):
+    """Yield (name, setup, run) triples; run returns the output size"""
+    for chains, draws, n_obs in sizes:
+        output = os.path.join(workdir, "export.npz")
+
+        def setup(chains=chains, draws=draws, n_obs=n_obs):
+            return synthetic_inference_data(chains, draws, n_obs)
+
+        def run(data, output=output):
+            arviz_to_json(data, output)
+            return _file_size(output)
+
+        yield f"arviz_to_json/{chains}x{draws}x{n_obs}", setup, run
+
+
+def multi_benchmarks(sizes, workdir):
+    for n_models in sizes:
+        for layout in ["nested", "flat"]:
+            output = os.path.join(workdir, "multi.zip")
+
+            def setup(n_models=n_models):
+                return {
+                    f"model_{i}": synthetic_inference_data(2, 200, 20, seed=i)
+                    for i in range(n_models)
+                }
+
+            def run(models, layout=layout, output=output):
+                multi_arviz_to_json(models, output, layout=layout)
+                return _file_size(output)
+
+            yield f"multi_arviz_to_json/{layout}/{n_models}", setup, run
+
+
+def fix_dtype_benchmarks(n=1_000_000):
+    for dtype in FIX_DTYPES:
+
+        def setup(dtype=dtype):
+            return np.random.default_rng(0).integers(0, 100, size=n).astype(dtype)
+
+        def run(arr):
+            return fix_dtype(arr).nbytes
+
+        yield f"fix_dtype/{np.dtype(dtype).str}", setup, run
+
+
+def dag_benchmarks(sizes):
+    try:
+        from arviz_json import get_dag, pymc_dag
+        import pymc3  # noqa: F401
+    except ImportError:
+        return
+    for n_nodes in sizes:
+
+        def setup(n_nodes=n_nodes):
+            return synthetic_pymc3_model(n_nodes)
+
+        def run(model):
+            # every timed run extracts the DAG, rather than hitting the cache
+            pymc_dag._dag_cache.clear()
+            return len(json.dumps(get_dag(model)))
+
+        yield f"get_dag/{n_nodes}", setup, run
+
+
+# prints the number of modules loaded by importing arviz_json, and if traced,
+# the peak memory allocated while importing it
+IMPORT_SCRIPT = """
+import sys, tracemalloc
+before = len(sys.modules)
+if "--trace" in sys.argv:
+    tracemalloc.start()
+import arviz_json
+print(len(sys.modules) - before, tracemalloc.get_traced_memory()[1])
+"""
+
+
+def startup_benchmarks():
+    def import_arviz_json(env, *args):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT, *args], env=env, check=True, capture_output=True
+        )
+        return map(int, output.stdout.split())
+
+    def setup():
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([PACKAGE_DIR, env.get("PYTHONPATH", "")])
+        # tracing slows the import down, so memory is traced in its own run
+        _, peak = import_arviz_json(env, "--trace")
+        return env, peak
+
+    def run(arg):
+        env, peak = arg
+        modules, _ = import_arviz_json(env)
+        return {"modules": modules, "peak_memory": peak}
+
+    yield "import arviz_json", setup, run
+
+
+def measure(setup, run, repeat=3):
+    """Return the best wall time, the peak traced memory and the output size
+    of run(setup()). Setup is not included in either measurement. A run that
+    measures itself (e.g. in a subprocess) returns a dict of its metrics
+    instead of an output size, and is not traced here."""
+    arg = setup()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = run(arg)
+        times.append(time.perf_counter() - start)
+    if isinstance(output, dict):
+        return {"time": min(times), **output}
+    tracemalloc.start()
+    try:
+        run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"time": min(times), "peak_memory": peak, "output_size": output}
+
+
+def format_result(name, r):
+    """One line of results, e.g. for printing as benchmarks finish"""
+    line = f"{name:45s} {r['time'] * 1000:10.1f} ms  {r['peak_memory'] / 2**20:8.1f} MiB"
+    if "output_size" in r:
+        line += f"  {r['output_size'] / 2**20:8.2f} MiB out"
+    if "modules" in r:
+        line += f"  {r['modules']:8d} modules"
+    return line
+
+
+def compare(results, baseline, tolerance, min_time=0.001):
+    """Print the change of every metric from the baseline; returns the names
+    of the benchmarks that regressed by more than tolerance (and, for times,
+    by more than min_time seconds)"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes = []
+        for metric in ["time", "peak_memory", "output_size", "modules"]:
+            if metric not in result or metric not in baseline[name]:
+                continue
+            old, new = baseline[name][metric], result[metric]
+            ratio = new / old if old else 1.0
+            changes.append(f"{metric} {ratio:6.2f}x")
+            if metric == "time" and new - old <= min_time:
+                continue
+            if metric in ("time", "peak_memory") and ratio > 1 + tolerance:
+                regressions.append(f"{name} {metric}")
+        print(f"{name:45s} " + "  ".join(changes))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "-k", "--filter", default="", help="Only run benchmarks whose name contains this"
+    )
+    parser.add_argument("--quick", action="store_true", help="Only run the smaller sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each benchmark")
+    parser.add_argument("--save", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown, e.g. 0.2")
+    parser.add_argument(
+        "--min-time", type=float, default=0.001,
+        help="Slowdowns of less than this many seconds are not regressions",
+    )
+    args = parser.parse_args(argv)
+
+    def sizes(all_sizes):
+        return all_sizes[:2] if args.quick else all_sizes
+
+    workdir = tempfile.mkdtemp()
+    try:
+        benchmarks = [
+            *startup_benchmarks(),
+            *export_benchmarks(sizes(EXPORT_SIZES), workdir),
+            *multi_benchmarks(sizes(MULTI_SIZES), workdir),
+            *fix_dtype_benchmarks(),
+            *dag_benchmarks(sizes(DAG_SIZES)),
+        ]
+        results = {}
+        for name, setup, run in benchmarks:
+            if args.filter not in name:
+                continue
+            results[name] = measure(setup, run, args.repeat)
+            print(format_result(name, results[name]))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "machine": {
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "arviz": az.__version__,
+                        "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        print(f"\nCompared to {args.compare}:")
+        regressions = compare(results, baseline, args.tolerance, args.min_time)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
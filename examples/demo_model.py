@@ -89,7 +89,7 @@ if __name__=="__main__":
     model = define_model(poverty)
     dag = get_dag(model)    
     data = capture_inference(model)
-    arviz_to_json(data, "switchpoint.npz")
+    arviz_to_json(data, "switchpoint.npz", dag_format="csr")
 
     # generate multiple models
     models = {
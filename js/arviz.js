@@ -7,19 +7,218 @@
 function reassemble_arviz(npz_block, array_transformer) {
     var transformer = array_transformer || (x=>x);
     var inference_data = npz_block["header.json"].inference_data;        
+    // entry level filters, e.g. byte shuffling (arviz_to_json(..., shuffle=True))
+    var entry_filters = npz_block["header.json"].filters || {};
+    // look up an array block by entry name, undoing its filters
+    // arrays that were not loaded (e.g. by load_npz_summary) are undefined
+    function entry(name) {
+        var arr = npz_block[linkedEntry(npz_block["header.json"], name)];
+        return arr && unfilterEntry(arr, entry_filters[name]);
+    }
     for (k in inference_data) {
+        // reattach coordinates that were written as array entries
+        var coords = inference_data[k].coords;
+        for (var c in coords) {
+            if (coords[c] && coords[c].array_name && entry(coords[c].array_name))
+                coords[c] = decodeCoord(coords[c], entry(coords[c].array_name));
+            else if (coords[c] && !Array.isArray(coords[c]) && coords[c].values)
+                coords[c] = decodeCoord(coords[c], {data: coords[c].values});
+        }
+        // rebuild a DAG written as arrays (arviz_to_json(..., dag_format="csr"))
+        var attrs = inference_data[k].attrs;
+        if (attrs && attrs.graph && attrs.graph.encoding == "csr") {
+            var graph = decodeDag(attrs.graph, entry);
+            if (graph) attrs.graph = graph;
+        }
         vars = inference_data[k].vars;        
         // extract arrays
         for (v in vars) {
             var var_v = vars[v];
-            // lookup the array block
-            var array_fname = var_v.array_name+".npy";            
-            var_v.array = transformer(npz_block[array_fname]);
+            // kept so that refineLOD can find and undo filters on entries loaded later
+            var_v.entry_filters = entry_filters;
+            var_v.entry_links = npz_block["header.json"].links || {};
+            if (var_v.chunks) {
+                // variable was written in chunks; stitch them back together
+                var chunks = var_v.chunks.array_names.map(entry);
+                if (chunks.every(chunk => chunk))
+                    var_v.array = transformer(decodeFilters(var_v, joinChunks(var_v, chunks)));
+            } else {
+                // lookup the array block
+                var arr = entry(var_v.array_name);
+                if (arr)
+                    var_v.array = transformer(decodeFilters(var_v, arr));
+            }
+            // thinned levels of detail, if written; if the full array was not
+            // loaded, use the finest level that was (see load_npz_lod)
+            var_v.step = 1;
+            if (var_v.lod) {
+                for (var level of var_v.lod.slice().reverse()) {
+                    level.array = entry(level.array_name);
+                    if (!var_v.array && level.array) {
+                        var_v.array = transformer(decodeFilters(var_v, level.array));
+                        var_v.step = level.step;
+                    }
+                }
+            }
+            // precomputed summary statistics, if written
+            if (var_v.summary && entry(var_v.summary.array_name))
+                var_v.summary.array = entry(var_v.summary.array_name);
         }
     }    
     return inference_data;
 }
 
+// the smallest int64, which numpy uses for NaT
+var NAT = -9223372036854775808;
+
+// convert a coordinate written as an array entry, or as encoded dates or
+// durations in the header, back to a (nested) list. Strings are decoded from
+// UTF-8, dates become Date objects (null for NaT) and durations milliseconds;
+// both are written as int64 nanoseconds, and read the same from either place
+function decodeCoord(coord, arr) {
+    var values;
+    if (coord.encoding == "utf8") {
+        var width = arr.shape[arr.shape.length - 1];
+        var decoder = new TextDecoder("utf-8");
+        values = [];
+        for (var i = 0; i < arr.data.length; i += width) {
+            var row = arr.data.subarray(i, i + width);
+            var end = row.indexOf(0);
+            values.push(decoder.decode(end < 0 ? row : row.subarray(0, end)));
+        }
+    } else if (coord.encoding == "datetime64[ns]" || coord.encoding == "timedelta64[ns]") {
+        // nanoseconds, as a BigInt64Array from an entry or numbers from the header
+        var dates = coord.encoding == "datetime64[ns]";
+        values = Array.from(arr.data, function (ns) {
+            if (Number(ns) == NAT) return null;
+            return dates ? new Date(Number(ns) / 1e6) : Number(ns) / 1e6;
+        });
+    } else {
+        values = Array.from(arr.data);
+    }
+    // nest according to the shape of the coordinate
+    for (var d = coord.shape.length - 1; d > 0; d--) {
+        var nested = [];
+        for (var j = 0; j < values.length; j += coord.shape[d])
+            nested.push(values.slice(j, j + coord.shape[d]));
+        values = nested;
+    }
+    return values;
+}
+
+// rebuild a DAG written as adjacency arrays and a table of nodes
+// (arviz_to_json(..., dag_format="csr")) as the object written by get_dag:
+// {name: {name, type, parents, size, dims, coords, distribution}}.
+// entry(name) looks up an array; returns null if any array is not loaded
+function decodeDag(graph, entry) {
+    var names = graph.array_names;
+    var arrays = {};
+    for (var field in names) {
+        arrays[field] = entry(names[field]);
+        if (!arrays[field]) return null;
+    }
+    var valuesOf = function (values) {
+        if (!values.array_name) return values;
+        var arr = entry(values.array_name);
+        return arr && decodeCoord(values, arr);
+    };
+    var node_names = valuesOf(graph.names);
+    var coords = {};
+    for (var dim in graph.coords) coords[dim] = valuesOf(graph.coords[dim]);
+    if (!node_names || Object.values(coords).some(c => !c)) return null;
+    var offsets = arrays.parent_offsets.data;
+    var parents = arrays.parent_indices.data;
+    var dag = {};
+    for (var i = 0; i < node_names.length; i++) {
+        var dims = graph.dims[arrays.dims.data[i]];
+        var node_coords = {};
+        dims.filter(d => d in coords).forEach(d => node_coords[d] = coords[d]);
+        dag[node_names[i]] = {
+            name: node_names[i],
+            type: graph.types[arrays.type.data[i]],
+            parents: Array.from(parents.subarray(offsets[i], offsets[i + 1]), p => node_names[p]),
+            size: arrays.size.data[i],
+            dims: dims,
+            coords: node_coords,
+            distribution: graph.distributions[arrays.distribution.data[i]],
+        };
+    }
+    return dag;
+}
+
+// name of the zip entry holding the array <name>, following the "links" of
+// deduplicated archives (arviz_to_json(..., dedup=True)). Arrays in a shared
+// store ("external", see loadStoreEntries) are kept under their own name
+function linkedEntry(header, name) {
+    var links = header.links || {};
+    return (links[name] || name) + ".npy";
+}
+
+// undo the entry level filters listed for an entry in header.json
+// (currently only byte shuffling), in reverse order
+function unfilterEntry(arr, filters) {
+    filters = filters || [];
+    for (var i = filters.length - 1; i >= 0; i--) {
+        if (filters[i].id == "shuffle") arr = NumpyLoader.unshuffle(arr, filters[i].dtype);
+    }
+    return arr;
+}
+
+// undo the encodings listed in the "filters" of a variable's header, in reverse order
+// (e.g. quantization from arviz_to_json(..., precision=...)), returning a new array
+function decodeFilters(var_v, arr) {
+    var filters = var_v.filters || [];
+    for (var i = filters.length - 1; i >= 0; i--) {
+        var filter = filters[i];
+        if (filter.id == "quantize") {
+            var codes = arr.data;
+            var data = new Float64Array(codes.length);
+            for (var j = 0; j < codes.length; j++)
+                data[j] = (codes[j] === filter.nan_code) ? NaN : filter.offset + filter.scale * codes[j];
+            arr = {shape: arr.shape, fortran_order: arr.fortran_order, data: data};
+        }
+        // "astype" and "round" leave a valid float array, so need no decoding
+    }
+    return arr;
+}
+
+// reassemble the arrays of a chunked variable into a single array.
+// chunks are listed in C order of their position in the chunk grid, or
+// placed at the starts given in var.chunks.offsets (appended archives)
+function joinChunks(var_v, chunks) {
+    var shape = var_v.shape;
+    var chunk_shape = var_v.chunks.shape;
+    var grid = var_v.chunks.grid;
+    var size = shape.reduce((a, b) => a * b, 1);
+    var data = new chunks[0].data.constructor(size);
+    // strides of the full array, in elements
+    var strides = shape.map((_, i) => shape.slice(i + 1).reduce((a, b) => a * b, 1));
+    var last = shape.length - 1;
+    for (var c = 0; c < chunks.length; c++) {
+        // position of this chunk in the grid
+        var grid_index = [];
+        for (var i = grid.length - 1, r = c; i >= 0; i--) {
+            grid_index[i] = r % grid[i];
+            r = Math.floor(r / grid[i]);
+        }
+        // start of this chunk along each dimension
+        var start = var_v.chunks.offsets ? var_v.chunks.offsets[c] : grid_index.map((g, i) => g * chunk_shape[i]);
+        var chunk = chunks[c];
+        var row_length = chunk.shape[last];
+        var n_rows = chunk.data.length / row_length;
+        // copy each row (along the last dimension) to its place in the full array
+        for (var row = 0; row < n_rows; row++) {
+            var offset = start[last];
+            for (var i = last - 1, r = row; i >= 0; i--) {
+                offset += (start[i] + r % chunk.shape[i]) * strides[i];
+                r = Math.floor(r / chunk.shape[i]);
+            }
+            data.set(chunk.data.subarray(row * row_length, (row + 1) * row_length), offset);
+        }
+    }
+    return {shape: shape, fortran_order: false, data: data};
+}
+
 function endsWith(s, tail)
 {
     return (s.length >= tail.length && s.slice(-tail.length)===tail);
@@ -28,24 +227,44 @@ function endsWith(s, tail)
 // apply arviz reconstuction to multiple models
 // model comes as a single zip with `model_name.npz` files inside
 // one per model. Potentially also metadata information as JSON blocks, but this
-// is not used at the moment
+// is not used at the moment.
+// In the flat layout, each model is instead a set of `model_name/...` entries,
+// which are grouped by model and reassembled as if they were a single npz
 function reassembleMultiModel(models, array_transformer)
 {
     var arviz_models = {};
     var meta_data = {};
+    var flat_models = {};
     for(k in models)
     {
-        if(endsWith(k, 'npz'))
+        var slash = k.indexOf('/');
+        if(slash >= 0)
+        {
+            var model_name = k.slice(0, slash);
+            flat_models[model_name] = flat_models[model_name] || {};
+            flat_models[model_name][k.slice(slash + 1)] = models[k];
+        }
+        else if(endsWith(k, 'npz'))
         {
             var fname_no_npz = k.slice(0,-4); // remove trailing .npz from filename
             arviz_models[fname_no_npz] = reassemble_arviz(models[k], array_transformer);
         }
-        if(endsWith(k, 'json'))
+        else if(endsWith(k, 'json'))
         {
             var fname_no_json = k.slice(0,-5); // remove trailing .npz from filename
-            meta_data[fname_no_json] = JSON.parse(models[k]);
+            // loadMultiModel has already parsed the JSON
+            meta_data[fname_no_json] = typeof models[k] == "string" ? JSON.parse(models[k]) : models[k];
         }
     }
+    // deduplicated arrays are shared by all models of a flat archive
+    var shared = flat_models["objects"] || {};
+    delete flat_models["objects"];
+    for(model_name in flat_models)
+    {
+        for(k in shared)
+            flat_models[model_name]["objects/" + k] = shared[k];
+        arviz_models[model_name] = reassemble_arviz(flat_models[model_name], array_transformer);
+    }
     return {"models":arviz_models, 
             "meta_data":meta_data};
 }
@@ -57,6 +276,18 @@ function getData(property, varname) {
     return property.vars[varname].array.data;
 }
 
+// return the summary statistics of a variable (written with
+// arviz_to_json(..., summary=true)) as {stat: data}, e.g. {"mean": ..., "r_hat": ...}
+// each entry has one value per coordinate of the non chain/draw dimensions
+function getSummary(property, varname) {
+    var summary = property.vars[varname].summary;
+    var data = summary.array.data;
+    var n = data.length / summary.stats.length;
+    var result = {};
+    summary.stats.forEach((stat, i) => result[stat] = data.subarray(i * n, (i + 1) * n));
+    return result;
+}
+
 // return N samples from a set of variables
 function getNSample(property, vars, n) {
 
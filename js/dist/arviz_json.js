@@ -3397,54 +3397,82 @@ var NumpyLoader = (function () {
         return val;
     }
 
-    function fromArrayBuffer(buf) {
+    // byteOffset gives the start of the npy data within buf, so that arrays
+    // can be read directly from inside a larger buffer (e.g. an uncompressed zip)
+    function fromArrayBuffer(buf, byteOffset) {
+      var start = byteOffset || 0;
       // Check the magic number
-      var magic = asciiDecode(buf.slice(0,6));      
+      var magic = asciiDecode(buf.slice(start, start+6));
       if (magic.slice(1,6) != 'NUMPY') {
           throw new Error('unknown file type');
       }
 
-      var version = new Uint8Array(buf.slice(6,8)),
-          headerLength = readUint16LE(buf.slice(8,10)),
-          headerStr = asciiDecode(buf.slice(10, 10+headerLength));
-          offsetBytes = 10 + headerLength;
+      var version = new Uint8Array(buf.slice(start+6, start+8)),
+          headerLength = readUint16LE(buf.slice(start+8, start+10)),
+          headerStr = asciiDecode(buf.slice(start+10, start+10+headerLength));
+          offsetBytes = start + 10 + headerLength;
           //rest = buf.slice(10+headerLength);  XXX -- This makes a copy!!! https://www.khronos.org/registry/typedarray/specs/latest/#5
 
       // Hacky conversion of dict literal string to JS Object
       eval("var info = " + headerStr.toLowerCase().replace('(','[').replace('),',']'));
-    
-      // Intepret the bytes according to the specified dtype
+
+      // number of elements, so that the view stops at the end of this array
+      var size = info.shape.reduce((a, b) => a * b, 1);
+
+      var data = typedArray(info.descr, buf, offsetBytes, size);
+
+      return {
+          shape: info.shape,
+          fortran_order: info.fortran_order,
+          data: data
+      };
+    }
+
+    // Intepret the bytes of buf from offsetBytes according to the specified dtype
+    function typedArray(descr, buf, offsetBytes, size) {
       var data;
       
-      if (info.descr === "|u1") {
-          data = new Uint8Array(buf, offsetBytes);
+      if (descr === "|u1") {
+          data = new Uint8Array(buf, offsetBytes, size);
       } 
-      else if (info.descr === "|b1") {
-        data = new Uint8Array(buf, offsetBytes);      
-      } else if (info.descr === "|i1") {
-          data = new Int8Array(buf, offsetBytes);
-      } else if (info.descr === "<u2") {
-          data = new Uint16Array(buf, offsetBytes);
-      } else if (info.descr === "<i2") {
-          data = new Int16Array(buf, offsetBytes);
-      } else if (info.descr === "<u4") {
-          data = new Uint32Array(buf, offsetBytes);
-      } else if (info.descr === "<i4") {
-          data = new Int32Array(buf, offsetBytes);
-      } else if (info.descr === "<i8") {
-            data = new Int64Array(buf, offsetBytes);
-      } else if (info.descr === "<f4") {
-          data = new Float32Array(buf, offsetBytes);
-      } else if (info.descr === "<f8") {
-          data = new Float64Array(buf, offsetBytes);
+      else if (descr === "|b1") {
+        data = new Uint8Array(buf, offsetBytes, size);
+      } else if (descr === "|i1") {
+          data = new Int8Array(buf, offsetBytes, size);
+      } else if (descr === "<u2") {
+          data = new Uint16Array(buf, offsetBytes, size);
+      } else if (descr === "<i2") {
+          data = new Int16Array(buf, offsetBytes, size);
+      } else if (descr === "<u4") {
+          data = new Uint32Array(buf, offsetBytes, size);
+      } else if (descr === "<i4") {
+          data = new Int32Array(buf, offsetBytes, size);
+      } else if (descr === "<i8") {
+          data = new BigInt64Array(buf, offsetBytes, size);
+      } else if (descr === "<f4") {
+          data = new Float32Array(buf, offsetBytes, size);
+      } else if (descr === "<f8") {
+          data = new Float64Array(buf, offsetBytes, size);
       } else {
           throw new Error('unknown numeric dtype')
       }
+      return data;
+    }
 
+    // undo a byte shuffle: arr is a |u1 array of shape [itemsize, ...shape],
+    // where plane k holds byte k of every element. Returns the array of dtype descr
+    function unshuffle(arr, descr) {
+      var itemsize = arr.shape[0];
+      var size = arr.data.length / itemsize;
+      var bytes = new Uint8Array(arr.data.length);
+      for (var k = 0; k < itemsize; k++) {
+          var plane = arr.data.subarray(k * size, (k + 1) * size);
+          for (var i = 0; i < size; i++) bytes[i * itemsize + k] = plane[i];
+      }
       return {
-          shape: info.shape,
-          fortran_order: info.fortran_order,
-          data: data
+          shape: arr.shape.slice(1),
+          fortran_order: arr.fortran_order,
+          data: typedArray(descr, bytes.buffer, 0, size)
       };
     }
 
@@ -3474,7 +3502,8 @@ var NumpyLoader = (function () {
     return {
         open: open,
         ajax: ajax,
-        fromBuffer: fromArrayBuffer
+        fromBuffer: fromArrayBuffer,
+        unshuffle: unshuffle
     };
 })();
 
@@ -3555,17 +3584,21 @@ function iterateZip(reader, file_callback) {
     return all_promise;
 }
 
+// unpack a single entry of an NPZ file
+function readNpzEntryBlob(blob, filename, extension) {
+    if (extension == 'npy') return readNpyBlob(blob);
+    if (extension == 'json') return readJSONBlob(blob);
+    else return null;
+}
+
 function parseNpz(reader) {
-    return iterateZip(reader, function (blob, filename, extension) {
-        if (extension == 'npy') return readNpyBlob(blob);
-        if (extension == 'json') return readJSONBlob(blob);
-        else return null;
-    });
+    return iterateZip(reader, readNpzEntryBlob);
 }
 
-function readZipWith(url, readerFn) {
+function readZipWith(url, readerFn, httpReader) {
+    var HttpReader = httpReader || zip.HttpReader;
     return new Promise(function (resolve, reject) {
-        zip.createReader(new zip.HttpReader(url), reader => resolve(readerFn(reader)));
+        zip.createReader(new HttpReader(url), reader => resolve(readerFn(reader)));
     })
 }
 
@@ -3573,6 +3606,227 @@ function load_npz(url) {
     return readZipWith(url, parseNpz);
 }
 
+// read a single zip entry, and unpack it with readFn (e.g. readNpyBlob)
+function readEntry(entry, readFn) {
+    return new Promise(function (resolve, reject) {
+        entry.getData(new zip.BlobWriter(), blob => readFn(blob).then(resolve));
+    });
+}
+
+// load an NPZ file entry by entry using HTTP range requests, so that large
+// variables written in chunks (arviz_to_json(..., chunks=...)) can be shown
+// before the whole file has arrived. header.json is read first, then the
+// first chunk of every variable, then the second chunk of every variable, ...
+// on_chunk(group, var, chunk_index, array, header) is called as each chunk
+// arrives; the promise resolves to the complete npz block, as load_npz
+function load_npz_progressive(url, on_chunk) {
+    return readZipWith(url, function (reader) {
+        return new Promise(function (resolve, reject) {
+            reader.getEntries(function (entries) {
+                var by_name = pairsToObj(entries.map(e => [e.filename, e]));
+                readEntry(by_name["header.json"], readJSONBlob).then(function (header) {
+                    var npz_block = {"header.json": header};
+                    var inference_data = header.inference_data;
+                    // list every array, in order of chunk index
+                    var queue = [];
+                    for (var group in inference_data) {
+                        for (var v in inference_data[group].vars) {
+                            var var_v = inference_data[group].vars[v];
+                            var names = var_v.chunks ? var_v.chunks.array_names : [var_v.array_name];
+                            names.forEach((name, i) => queue.push([i, group, v, linkedEntry(header, name)]));
+                        }
+                    }
+                    queue.sort((a, b) => a[0] - b[0]);
+                    var loaded = queue.reduce(function (previous, item) {
+                        return previous.then(function () {
+                            return readEntry(by_name[item[3]], readNpyBlob).then(function (arr) {
+                                npz_block[item[3]] = arr;
+                                if (on_chunk) on_chunk(item[1], item[2], item[0], arr, header);
+                            });
+                        });
+                    }, Promise.resolve());
+                    loaded.then(() => resolve(npz_block));
+                });
+            });
+        });
+    }, zip.HttpRangeReader);
+}
+
+// load only the entries of an NPZ file for which select(filename) is true,
+// using HTTP range requests so that nothing else is downloaded
+function load_npz_entries(url, select) {
+    return readZipWith(url, function (reader) {
+        return new Promise(function (resolve, reject) {
+            reader.getEntries(function (entries) {
+                var selected = entries.filter(entry => select(entry.filename));
+                Promise.all(selected.map(entry => readEntry(entry, function (blob) {
+                    var extension = entry.filename.split(".").pop();
+                    return readNpzEntryBlob(blob, entry.filename, extension);
+                }))).then(function (results) {
+                    resolve(pairsToObj(selected.map((entry, i) => [entry.filename, results[i]])));
+                });
+            });
+        });
+    }, zip.HttpRangeReader);
+}
+
+// names of the npy entries holding the coordinates of every group that were
+// written as arrays (arviz_to_json(..., coord_threshold=...)), and the
+// arrays of DAGs (arviz_to_json(..., dag_format="csr"))
+function coordEntries(header) {
+    var names = [];
+    for (var group in header.inference_data) {
+        var coords = header.inference_data[group].coords;
+        for (var c in coords) {
+            if (coords[c] && coords[c].array_name) names.push(linkedEntry(header, coords[c].array_name));
+        }
+        var graph = (header.inference_data[group].attrs || {}).graph;
+        if (graph && graph.encoding == "csr") {
+            var dag_names = Object.values(graph.array_names).concat([graph.names.array_name]);
+            for (var dim in graph.coords) {
+                if (graph.coords[dim].array_name) dag_names.push(graph.coords[dim].array_name);
+            }
+            dag_names.forEach(name => names.push(linkedEntry(header, name)));
+        }
+    }
+    return names;
+}
+
+// load the header, then only the entries named by select_names(header),
+// and the coordinates, as an npz block
+function load_npz_selected(url, select_names) {
+    return load_npz_entries(url, name => name == "header.json").then(function (block) {
+        var header = block["header.json"];
+        var wanted = {"header.json": true};
+        select_names(header).concat(coordEntries(header)).forEach(name => wanted[name] = true);
+        return load_npz_entries(url, name => wanted[name]);
+    });
+}
+
+// fetch entries one by one from an archive served by `python -m arviz_json.server`,
+// as an npz block; url is the server, e.g. "http://localhost:8000/", and names
+// are the paths of the entries in the archive. The server sends ETags, so
+// entries fetched before come from the browser cache.
+function fetchServedEntries(url, names) {
+    var base = url.endsWith("/") ? url : url + "/";
+    return Promise.all(names.map(function (name) {
+        return fetch(base + name.split("/").map(encodeURIComponent).join("/")).then(function (response) {
+            if (!response.ok) throw new Error("Could not fetch " + name + ": " + response.status);
+            return name.endsWith(".json") ? response.json() : response.arrayBuffer().then(NumpyLoader.fromBuffer);
+        }).then(value => [name, value]);
+    })).then(pairsToObj);
+}
+
+// as load_npz_selected, from an archive served by `python -m arviz_json.server`:
+// fetch the header, then only the entries named by select_names(header) and the
+// coordinates. model names one model of a flat multi model archive; its entries
+// are under <model>/, but deduplicated arrays (objects/<hash>) are shared at
+// the root of the archive. Resolves to an npz block for reassemble_arviz.
+function load_npz_served(url, select_names, model) {
+    var prefix = model ? model + "/" : "";
+    var path = name => name.startsWith("objects/") ? name : prefix + name;
+    return fetchServedEntries(url, [prefix + "header.json"]).then(function (header_block) {
+        var header = header_block[prefix + "header.json"];
+        var wanted = select_names(header).concat(coordEntries(header));
+        wanted = wanted.filter((name, i) => wanted.indexOf(name) == i);
+        return fetchServedEntries(url, wanted.map(path)).then(function (block) {
+            var npz_block = {"header.json": header};
+            wanted.forEach(name => npz_block[name] = block[path(name)]);
+            return npz_block;
+        });
+    });
+}
+
+// load only the header, the summary statistics and the coordinates of an NPZ file
+// written with arviz_to_json(..., summary=True), skipping all draws
+function load_npz_summary(url) {
+    return load_npz_selected(url, function (header) {
+        var names = [];
+        for (var group in header.inference_data) {
+            for (var v in header.inference_data[group].vars) {
+                var summary = header.inference_data[group].vars[v].summary;
+                if (summary) names.push(linkedEntry(header, summary.array_name));
+            }
+        }
+        return names;
+    });
+}
+
+// names of the npy entries holding the full array of a variable
+function fullArrayEntries(header, var_v) {
+    var names = var_v.chunks ? var_v.chunks.array_names : [var_v.array_name];
+    return names.map(name => linkedEntry(header, name));
+}
+
+// load an NPZ file written with arviz_to_json(..., lod_levels=...), fetching
+// only the coarsest thinned level of each variable that has levels of detail,
+// and the full arrays of all other variables. Resolves to reassembled
+// inference data, where var.step gives the thinning of each loaded array.
+// Use refineLOD() to load finer levels on demand.
+function load_npz_lod(url, array_transformer) {
+    return load_npz_selected(url, function (header) {
+        var inference_data = header.inference_data;
+        var names = [];
+        for (var group in inference_data) {
+            for (var v in inference_data[group].vars) {
+                var var_v = inference_data[group].vars[v];
+                names = names.concat(var_v.lod ? [linkedEntry(header, var_v.lod[0].array_name)] : fullArrayEntries(header, var_v));
+            }
+        }
+        return names;
+    }).then(block => reassemble_arviz(block, array_transformer));
+}
+
+// load the next finer level of detail of a variable from a reassembled archive
+// loaded with load_npz_lod, or the full array once there are no finer levels
+// resolves to the variable, with var.array and var.step updated
+function refineLOD(url, var_v, array_transformer) {
+    var transformer = array_transformer || (x=>x);
+    var finer = (var_v.lod || []).filter(level => level.step < var_v.step);
+    if (var_v.step == 1) return Promise.resolve(var_v);
+    // levels are listed coarsest first
+    var array_names = finer.length ? [finer[0].array_name] : (var_v.chunks ? var_v.chunks.array_names : [var_v.array_name]);
+    var header = {links: var_v.entry_links};
+    var names = array_names.map(name => linkedEntry(header, name));
+    return load_npz_entries(url, name => names.indexOf(name) >= 0).then(function (block) {
+        var entry = (name, i) => unfilterEntry(block[names[i]], var_v.entry_filters[name]);
+        if (finer.length) {
+            finer[0].array = entry(array_names[0], 0);
+            var_v.array = transformer(decodeFilters(var_v, finer[0].array));
+            var_v.step = finer[0].step;
+        } else {
+            var chunks = array_names.map(entry);
+            var full = var_v.chunks ? joinChunks(var_v, chunks) : chunks[0];
+            var_v.array = transformer(decodeFilters(var_v, full));
+            var_v.step = 1;
+        }
+        return var_v;
+    });
+}
+
+// fetch the arrays of an npz block that are in a shared store rather than
+// in the archive itself (arviz_to_json(..., store=...)), adding them to the
+// block so that it can be passed to reassemble_arviz. store_url defaults to
+// the store recorded in the header, relative to the archive url
+function loadStoreEntries(npz_block, url, store_url) {
+    var header = npz_block["header.json"];
+    var external = header.external || {};
+    store_url = store_url || url.slice(0, url.lastIndexOf("/") + 1) + header.store + "/";
+    return Promise.all(Object.keys(external).map(function (name) {
+        return new Promise(function (resolve, reject) {
+            NumpyLoader.ajax(store_url + external[name], function (arr) {
+                npz_block[name + ".npy"] = arr;
+                resolve();
+            });
+        });
+    })).then(() => npz_block);
+}
+
+// load an NPZ file and the arrays it references in a shared store
+function load_npz_with_store(url, store_url) {
+    return load_npz(url).then(block => loadStoreEntries(block, url, store_url));
+}
+
 // load an NPZ file from an in memory blob
 function readNpzBlob(blob) {
     var promise = new Promise(function (resolve, reject) {
@@ -3583,15 +3837,77 @@ function readNpzBlob(blob) {
 
 // load multiple npz files inside a zip file
 // optionally, can be metadata as json inside the zip as well
+// also reads the "flat" layout, where each model is stored as
+// <model>/<array>.npy entries and a <model>/header.json
 function loadMultiModel(url) {
     function parse_multi(reader) {
         return iterateZip(reader, function (blob, filename, extension) {
             if (extension == 'npz') return readNpzBlob(blob);
+            if (extension == 'npy') return readNpyBlob(blob);
             if (extension == 'json') return readJSONBlob(blob);
         });
     }
     return readZipWith(url, parse_multi);
 }
+
+// read an uncompressed NPZ file that is already in memory as an ArrayBuffer
+// (e.g. written with compressed=False, align=64). Each array is a typed array
+// view directly into the archive buffer, so nothing is copied. This only reads
+// STORED entries; the data offsets must be aligned for the array dtypes.
+function readStoredNpz(buf) {
+    var view = new DataView(buf);
+    // find the end of central directory record, searching back over any comment
+    var eocd = buf.byteLength - 22;
+    while (eocd >= 0 && view.getUint32(eocd, true) != 0x06054b50) eocd--;
+    if (eocd < 0) throw new Error('not a zip file');
+    var n_entries = view.getUint16(eocd + 10, true);
+    var index = view.getUint32(eocd + 16, true);
+    var result = {};
+    for (var i = 0; i < n_entries; i++) {
+        var method = view.getUint16(index + 10, true);
+        var size = view.getUint32(index + 20, true);
+        var name_length = view.getUint16(index + 28, true);
+        var extra_length = view.getUint16(index + 30, true);
+        var comment_length = view.getUint16(index + 32, true);
+        var local_offset = view.getUint32(index + 42, true);
+        var filename = asciiDecodeBuffer(buf, index + 46, name_length);
+        if (method != 0) throw new Error(filename + ' is compressed; use load_npz instead');
+        // the local header has its own extra field, which holds the alignment padding
+        var data_offset = local_offset + 30 + view.getUint16(local_offset + 26, true) +
+            view.getUint16(local_offset + 28, true);
+        var extension = filename.split(".").pop();
+        if (extension == 'npy') result[filename] = NumpyLoader.fromBuffer(buf, data_offset);
+        if (extension == 'json') result[filename] = JSON.parse(asciiDecodeBuffer(buf, data_offset, size));
+        index += 46 + name_length + extra_length + comment_length;
+    }
+    return result;
+}
+
+function asciiDecodeBuffer(buf, offset, length) {
+    return new TextDecoder().decode(new Uint8Array(buf, offset, length));
+}
+
+// load an uncompressed, aligned NPZ file from a URL, viewing
+// the arrays directly inside the downloaded buffer
+function load_npz_aligned(url) {
+    return fetch(url).then(response => response.arrayBuffer()).then(readStoredNpz);
+}
+
+// poll an archive that is still being written by NpzAppender: fetch its
+// current header, and every entry that is not already in npz_block, using
+// HTTP range requests. Resolves to the updated block, which can be passed
+// to reassemble_arviz again.
+function load_npz_update(url, npz_block) {
+    npz_block = npz_block || {};
+    return load_npz_entries(url, name => name == "header.json").then(function (block) {
+        npz_block["header.json"] = block["header.json"];
+        return load_npz_entries(url, name => name.endsWith(".npy") && !(name in npz_block));
+    }).then(function (block) {
+        Object.assign(npz_block, block);
+        return npz_block;
+    });
+}
+
 // functions for manipulating ARViz data
 
 // put the arrays back into the places they came from, inside the
@@ -3601,19 +3917,218 @@ function loadMultiModel(url) {
 function reassemble_arviz(npz_block, array_transformer) {
     var transformer = array_transformer || (x=>x);
     var inference_data = npz_block["header.json"].inference_data;        
+    // entry level filters, e.g. byte shuffling (arviz_to_json(..., shuffle=True))
+    var entry_filters = npz_block["header.json"].filters || {};
+    // look up an array block by entry name, undoing its filters
+    // arrays that were not loaded (e.g. by load_npz_summary) are undefined
+    function entry(name) {
+        var arr = npz_block[linkedEntry(npz_block["header.json"], name)];
+        return arr && unfilterEntry(arr, entry_filters[name]);
+    }
     for (k in inference_data) {
+        // reattach coordinates that were written as array entries
+        var coords = inference_data[k].coords;
+        for (var c in coords) {
+            if (coords[c] && coords[c].array_name && entry(coords[c].array_name))
+                coords[c] = decodeCoord(coords[c], entry(coords[c].array_name));
+            else if (coords[c] && !Array.isArray(coords[c]) && coords[c].values)
+                coords[c] = decodeCoord(coords[c], {data: coords[c].values});
+        }
+        // rebuild a DAG written as arrays (arviz_to_json(..., dag_format="csr"))
+        var attrs = inference_data[k].attrs;
+        if (attrs && attrs.graph && attrs.graph.encoding == "csr") {
+            var graph = decodeDag(attrs.graph, entry);
+            if (graph) attrs.graph = graph;
+        }
         vars = inference_data[k].vars;        
         // extract arrays
         for (v in vars) {
             var var_v = vars[v];
-            // lookup the array block
-            var array_fname = var_v.array_name+".npy";            
-            var_v.array = transformer(npz_block[array_fname]);
+            // kept so that refineLOD can find and undo filters on entries loaded later
+            var_v.entry_filters = entry_filters;
+            var_v.entry_links = npz_block["header.json"].links || {};
+            if (var_v.chunks) {
+                // variable was written in chunks; stitch them back together
+                var chunks = var_v.chunks.array_names.map(entry);
+                if (chunks.every(chunk => chunk))
+                    var_v.array = transformer(decodeFilters(var_v, joinChunks(var_v, chunks)));
+            } else {
+                // lookup the array block
+                var arr = entry(var_v.array_name);
+                if (arr)
+                    var_v.array = transformer(decodeFilters(var_v, arr));
+            }
+            // thinned levels of detail, if written; if the full array was not
+            // loaded, use the finest level that was (see load_npz_lod)
+            var_v.step = 1;
+            if (var_v.lod) {
+                for (var level of var_v.lod.slice().reverse()) {
+                    level.array = entry(level.array_name);
+                    if (!var_v.array && level.array) {
+                        var_v.array = transformer(decodeFilters(var_v, level.array));
+                        var_v.step = level.step;
+                    }
+                }
+            }
+            // precomputed summary statistics, if written
+            if (var_v.summary && entry(var_v.summary.array_name))
+                var_v.summary.array = entry(var_v.summary.array_name);
         }
     }    
     return inference_data;
 }
 
+// the smallest int64, which numpy uses for NaT
+var NAT = -9223372036854775808;
+
+// convert a coordinate written as an array entry, or as encoded dates or
+// durations in the header, back to a (nested) list. Strings are decoded from
+// UTF-8, dates become Date objects (null for NaT) and durations milliseconds;
+// both are written as int64 nanoseconds, and read the same from either place
+function decodeCoord(coord, arr) {
+    var values;
+    if (coord.encoding == "utf8") {
+        var width = arr.shape[arr.shape.length - 1];
+        var decoder = new TextDecoder("utf-8");
+        values = [];
+        for (var i = 0; i < arr.data.length; i += width) {
+            var row = arr.data.subarray(i, i + width);
+            var end = row.indexOf(0);
+            values.push(decoder.decode(end < 0 ? row : row.subarray(0, end)));
+        }
+    } else if (coord.encoding == "datetime64[ns]" || coord.encoding == "timedelta64[ns]") {
+        // nanoseconds, as a BigInt64Array from an entry or numbers from the header
+        var dates = coord.encoding == "datetime64[ns]";
+        values = Array.from(arr.data, function (ns) {
+            if (Number(ns) == NAT) return null;
+            return dates ? new Date(Number(ns) / 1e6) : Number(ns) / 1e6;
+        });
+    } else {
+        values = Array.from(arr.data);
+    }
+    // nest according to the shape of the coordinate
+    for (var d = coord.shape.length - 1; d > 0; d--) {
+        var nested = [];
+        for (var j = 0; j < values.length; j += coord.shape[d])
+            nested.push(values.slice(j, j + coord.shape[d]));
+        values = nested;
+    }
+    return values;
+}
+
+// rebuild a DAG written as adjacency arrays and a table of nodes
+// (arviz_to_json(..., dag_format="csr")) as the object written by get_dag:
+// {name: {name, type, parents, size, dims, coords, distribution}}.
+// entry(name) looks up an array; returns null if any array is not loaded
+function decodeDag(graph, entry) {
+    var names = graph.array_names;
+    var arrays = {};
+    for (var field in names) {
+        arrays[field] = entry(names[field]);
+        if (!arrays[field]) return null;
+    }
+    var valuesOf = function (values) {
+        if (!values.array_name) return values;
+        var arr = entry(values.array_name);
+        return arr && decodeCoord(values, arr);
+    };
+    var node_names = valuesOf(graph.names);
+    var coords = {};
+    for (var dim in graph.coords) coords[dim] = valuesOf(graph.coords[dim]);
+    if (!node_names || Object.values(coords).some(c => !c)) return null;
+    var offsets = arrays.parent_offsets.data;
+    var parents = arrays.parent_indices.data;
+    var dag = {};
+    for (var i = 0; i < node_names.length; i++) {
+        var dims = graph.dims[arrays.dims.data[i]];
+        var node_coords = {};
+        dims.filter(d => d in coords).forEach(d => node_coords[d] = coords[d]);
+        dag[node_names[i]] = {
+            name: node_names[i],
+            type: graph.types[arrays.type.data[i]],
+            parents: Array.from(parents.subarray(offsets[i], offsets[i + 1]), p => node_names[p]),
+            size: arrays.size.data[i],
+            dims: dims,
+            coords: node_coords,
+            distribution: graph.distributions[arrays.distribution.data[i]],
+        };
+    }
+    return dag;
+}
+
+// name of the zip entry holding the array <name>, following the "links" of
+// deduplicated archives (arviz_to_json(..., dedup=True)). Arrays in a shared
+// store ("external", see loadStoreEntries) are kept under their own name
+function linkedEntry(header, name) {
+    var links = header.links || {};
+    return (links[name] || name) + ".npy";
+}
+
+// undo the entry level filters listed for an entry in header.json
+// (currently only byte shuffling), in reverse order
+function unfilterEntry(arr, filters) {
+    filters = filters || [];
+    for (var i = filters.length - 1; i >= 0; i--) {
+        if (filters[i].id == "shuffle") arr = NumpyLoader.unshuffle(arr, filters[i].dtype);
+    }
+    return arr;
+}
+
+// undo the encodings listed in the "filters" of a variable's header, in reverse order
+// (e.g. quantization from arviz_to_json(..., precision=...)), returning a new array
+function decodeFilters(var_v, arr) {
+    var filters = var_v.filters || [];
+    for (var i = filters.length - 1; i >= 0; i--) {
+        var filter = filters[i];
+        if (filter.id == "quantize") {
+            var codes = arr.data;
+            var data = new Float64Array(codes.length);
+            for (var j = 0; j < codes.length; j++)
+                data[j] = (codes[j] === filter.nan_code) ? NaN : filter.offset + filter.scale * codes[j];
+            arr = {shape: arr.shape, fortran_order: arr.fortran_order, data: data};
+        }
+        // "astype" and "round" leave a valid float array, so need no decoding
+    }
+    return arr;
+}
+
+// reassemble the arrays of a chunked variable into a single array.
+// chunks are listed in C order of their position in the chunk grid, or
+// placed at the starts given in var.chunks.offsets (appended archives)
+function joinChunks(var_v, chunks) {
+    var shape = var_v.shape;
+    var chunk_shape = var_v.chunks.shape;
+    var grid = var_v.chunks.grid;
+    var size = shape.reduce((a, b) => a * b, 1);
+    var data = new chunks[0].data.constructor(size);
+    // strides of the full array, in elements
+    var strides = shape.map((_, i) => shape.slice(i + 1).reduce((a, b) => a * b, 1));
+    var last = shape.length - 1;
+    for (var c = 0; c < chunks.length; c++) {
+        // position of this chunk in the grid
+        var grid_index = [];
+        for (var i = grid.length - 1, r = c; i >= 0; i--) {
+            grid_index[i] = r % grid[i];
+            r = Math.floor(r / grid[i]);
+        }
+        // start of this chunk along each dimension
+        var start = var_v.chunks.offsets ? var_v.chunks.offsets[c] : grid_index.map((g, i) => g * chunk_shape[i]);
+        var chunk = chunks[c];
+        var row_length = chunk.shape[last];
+        var n_rows = chunk.data.length / row_length;
+        // copy each row (along the last dimension) to its place in the full array
+        for (var row = 0; row < n_rows; row++) {
+            var offset = start[last];
+            for (var i = last - 1, r = row; i >= 0; i--) {
+                offset += (start[i] + r % chunk.shape[i]) * strides[i];
+                r = Math.floor(r / chunk.shape[i]);
+            }
+            data.set(chunk.data.subarray(row * row_length, (row + 1) * row_length), offset);
+        }
+    }
+    return {shape: shape, fortran_order: false, data: data};
+}
+
 function endsWith(s, tail)
 {
     return (s.length >= tail.length && s.slice(-tail.length)===tail);
@@ -3622,19 +4137,46 @@ function endsWith(s, tail)
 // apply arviz reconstuction to multiple models
 // model comes as a single zip with `model_name.npz` files inside
 // one per model. Potentially also metadata information as JSON blocks, but this
-// is not used at the moment
+// is not used at the moment.
+// In the flat layout, each model is instead a set of `model_name/...` entries,
+// which are grouped by model and reassembled as if they were a single npz
 function reassembleMultiModel(models, array_transformer)
 {
     var arviz_models = {};
+    var meta_data = {};
+    var flat_models = {};
     for(k in models)
     {
-        if(endsWith(k, 'npz'))
+        var slash = k.indexOf('/');
+        if(slash >= 0)
+        {
+            var model_name = k.slice(0, slash);
+            flat_models[model_name] = flat_models[model_name] || {};
+            flat_models[model_name][k.slice(slash + 1)] = models[k];
+        }
+        else if(endsWith(k, 'npz'))
         {
             var fname_no_npz = k.slice(0,-4); // remove trailing .npz from filename
             arviz_models[fname_no_npz] = reassemble_arviz(models[k], array_transformer);
         }
+        else if(endsWith(k, 'json'))
+        {
+            var fname_no_json = k.slice(0,-5); // remove trailing .npz from filename
+            // loadMultiModel has already parsed the JSON
+            meta_data[fname_no_json] = typeof models[k] == "string" ? JSON.parse(models[k]) : models[k];
+        }
     }
-    return arviz_models;
+    // deduplicated arrays are shared by all models of a flat archive
+    var shared = flat_models["objects"] || {};
+    delete flat_models["objects"];
+    for(model_name in flat_models)
+    {
+        for(k in shared)
+            flat_models[model_name]["objects/" + k] = shared[k];
+        arviz_models[model_name] = reassemble_arviz(flat_models[model_name], array_transformer);
+    }
+    return {"models":arviz_models, 
+            "meta_data":meta_data};
 }
 
 // return the raw data of an array given a variable name and
@@ -3644,6 +4186,18 @@ function getData(property, varname) {
     return property.vars[varname].array.data;
 }
 
+// return the summary statistics of a variable (written with
+// arviz_to_json(..., summary=true)) as {stat: data}, e.g. {"mean": ..., "r_hat": ...}
+// each entry has one value per coordinate of the non chain/draw dimensions
+function getSummary(property, varname) {
+    var summary = property.vars[varname].summary;
+    var data = summary.array.data;
+    var n = data.length / summary.stats.length;
+    var result = {};
+    summary.stats.forEach((stat, i) => result[stat] = data.subarray(i * n, (i + 1) * n));
+    return result;
+}
+
 // return N samples from a set of variables
 function getNSample(property, vars, n) {
 
@@ -14,54 +14,82 @@ var NumpyLoader = (function () {
         return val;
     }
 
-    function fromArrayBuffer(buf) {
+    // byteOffset gives the start of the npy data within buf, so that arrays
+    // can be read directly from inside a larger buffer (e.g. an uncompressed zip)
+    function fromArrayBuffer(buf, byteOffset) {
+      var start = byteOffset || 0;
       // Check the magic number
-      var magic = asciiDecode(buf.slice(0,6));      
+      var magic = asciiDecode(buf.slice(start, start+6));
       if (magic.slice(1,6) != 'NUMPY') {
           throw new Error('unknown file type');
       }
 
-      var version = new Uint8Array(buf.slice(6,8)),
-          headerLength = readUint16LE(buf.slice(8,10)),
-          headerStr = asciiDecode(buf.slice(10, 10+headerLength));
-          offsetBytes = 10 + headerLength;
+      var version = new Uint8Array(buf.slice(start+6, start+8)),
+          headerLength = readUint16LE(buf.slice(start+8, start+10)),
+          headerStr = asciiDecode(buf.slice(start+10, start+10+headerLength));
+          offsetBytes = start + 10 + headerLength;
           //rest = buf.slice(10+headerLength);  XXX -- This makes a copy!!! https://www.khronos.org/registry/typedarray/specs/latest/#5
 
       // Hacky conversion of dict literal string to JS Object
       eval("var info = " + headerStr.toLowerCase().replace('(','[').replace('),',']'));
-    
-      // Intepret the bytes according to the specified dtype
+
+      // number of elements, so that the view stops at the end of this array
+      var size = info.shape.reduce((a, b) => a * b, 1);
+
+      var data = typedArray(info.descr, buf, offsetBytes, size);
+
+      return {
+          shape: info.shape,
+          fortran_order: info.fortran_order,
+          data: data
+      };
+    }
+
+    // Intepret the bytes of buf from offsetBytes according to the specified dtype
+    function typedArray(descr, buf, offsetBytes, size) {
       var data;
       
-      if (info.descr === "|u1") {
-          data = new Uint8Array(buf, offsetBytes);
+      if (descr === "|u1") {
+          data = new Uint8Array(buf, offsetBytes, size);
       } 
-      else if (info.descr === "|b1") {
-        data = new Uint8Array(buf, offsetBytes);      
-      } else if (info.descr === "|i1") {
-          data = new Int8Array(buf, offsetBytes);
-      } else if (info.descr === "<u2") {
-          data = new Uint16Array(buf, offsetBytes);
-      } else if (info.descr === "<i2") {
-          data = new Int16Array(buf, offsetBytes);
-      } else if (info.descr === "<u4") {
-          data = new Uint32Array(buf, offsetBytes);
-      } else if (info.descr === "<i4") {
-          data = new Int32Array(buf, offsetBytes);
-      } else if (info.descr === "<i8") {
-            data = new Int64Array(buf, offsetBytes);
-      } else if (info.descr === "<f4") {
-          data = new Float32Array(buf, offsetBytes);
-      } else if (info.descr === "<f8") {
-          data = new Float64Array(buf, offsetBytes);
+      else if (descr === "|b1") {
+        data = new Uint8Array(buf, offsetBytes, size);
+      } else if (descr === "|i1") {
+          data = new Int8Array(buf, offsetBytes, size);
+      } else if (descr === "<u2") {
+          data = new Uint16Array(buf, offsetBytes, size);
+      } else if (descr === "<i2") {
+          data = new Int16Array(buf, offsetBytes, size);
+      } else if (descr === "<u4") {
+          data = new Uint32Array(buf, offsetBytes, size);
+      } else if (descr === "<i4") {
+          data = new Int32Array(buf, offsetBytes, size);
+      } else if (descr === "<i8") {
+          data = new BigInt64Array(buf, offsetBytes, size);
+      } else if (descr === "<f4") {
+          data = new Float32Array(buf, offsetBytes, size);
+      } else if (descr === "<f8") {
+          data = new Float64Array(buf, offsetBytes, size);
       } else {
           throw new Error('unknown numeric dtype')
       }
+      return data;
+    }
 
+    // undo a byte shuffle: arr is a |u1 array of shape [itemsize, ...shape],
+    // where plane k holds byte k of every element. Returns the array of dtype descr
+    function unshuffle(arr, descr) {
+      var itemsize = arr.shape[0];
+      var size = arr.data.length / itemsize;
+      var bytes = new Uint8Array(arr.data.length);
+      for (var k = 0; k < itemsize; k++) {
+          var plane = arr.data.subarray(k * size, (k + 1) * size);
+          for (var i = 0; i < size; i++) bytes[i * itemsize + k] = plane[i];
+      }
       return {
-          shape: info.shape,
-          fortran_order: info.fortran_order,
-          data: data
+          shape: arr.shape.slice(1),
+          fortran_order: arr.fortran_order,
+          data: typedArray(descr, bytes.buffer, 0, size)
       };
     }
 
@@ -91,7 +119,8 @@ var NumpyLoader = (function () {
     return {
         open: open,
         ajax: ajax,
-        fromBuffer: fromArrayBuffer
+        fromBuffer: fromArrayBuffer,
+        unshuffle: unshuffle
     };
 })();
 
@@ -74,17 +74,21 @@ function iterateZip(reader, file_callback) {
     return all_promise;
 }
 
+// unpack a single entry of an NPZ file
+function readNpzEntryBlob(blob, filename, extension) {
+    if (extension == 'npy') return readNpyBlob(blob);
+    if (extension == 'json') return readJSONBlob(blob);
+    else return null;
+}
+
 function parseNpz(reader) {
-    return iterateZip(reader, function (blob, filename, extension) {
-        if (extension == 'npy') return readNpyBlob(blob);
-        if (extension == 'json') return readJSONBlob(blob);
-        else return null;
-    });
+    return iterateZip(reader, readNpzEntryBlob);
 }
 
-function readZipWith(url, readerFn) {
+function readZipWith(url, readerFn, httpReader) {
+    var HttpReader = httpReader || zip.HttpReader;
     return new Promise(function (resolve, reject) {
-        zip.createReader(new zip.HttpReader(url), reader => resolve(readerFn(reader)));
+        zip.createReader(new HttpReader(url), reader => resolve(readerFn(reader)));
     })
 }
 
@@ -92,6 +96,227 @@ function load_npz(url) {
     return readZipWith(url, parseNpz);
 }
 
+// read a single zip entry, and unpack it with readFn (e.g. readNpyBlob)
+function readEntry(entry, readFn) {
+    return new Promise(function (resolve, reject) {
+        entry.getData(new zip.BlobWriter(), blob => readFn(blob).then(resolve));
+    });
+}
+
+// load an NPZ file entry by entry using HTTP range requests, so that large
+// variables written in chunks (arviz_to_json(..., chunks=...)) can be shown
+// before the whole file has arrived. header.json is read first, then the
+// first chunk of every variable, then the second chunk of every variable, ...
+// on_chunk(group, var, chunk_index, array, header) is called as each chunk
+// arrives; the promise resolves to the complete npz block, as load_npz
+function load_npz_progressive(url, on_chunk) {
+    return readZipWith(url, function (reader) {
+        return new Promise(function (resolve, reject) {
+            reader.getEntries(function (entries) {
+                var by_name = pairsToObj(entries.map(e => [e.filename, e]));
+                readEntry(by_name["header.json"], readJSONBlob).then(function (header) {
+                    var npz_block = {"header.json": header};
+                    var inference_data = header.inference_data;
+                    // list every array, in order of chunk index
+                    var queue = [];
+                    for (var group in inference_data) {
+                        for (var v in inference_data[group].vars) {
+                            var var_v = inference_data[group].vars[v];
+                            var names = var_v.chunks ? var_v.chunks.array_names : [var_v.array_name];
+                            names.forEach((name, i) => queue.push([i, group, v, linkedEntry(header, name)]));
+                        }
+                    }
+                    queue.sort((a, b) => a[0] - b[0]);
+                    var loaded = queue.reduce(function (previous, item) {
+                        return previous.then(function () {
+                            return readEntry(by_name[item[3]], readNpyBlob).then(function (arr) {
+                                npz_block[item[3]] = arr;
+                                if (on_chunk) on_chunk(item[1], item[2], item[0], arr, header);
+                            });
+                        });
+                    }, Promise.resolve());
+                    loaded.then(() => resolve(npz_block));
+                });
+            });
+        });
+    }, zip.HttpRangeReader);
+}
+
+// load only the entries of an NPZ file for which select(filename) is true,
+// using HTTP range requests so that nothing else is downloaded
+function load_npz_entries(url, select) {
+    return readZipWith(url, function (reader) {
+        return new Promise(function (resolve, reject) {
+            reader.getEntries(function (entries) {
+                var selected = entries.filter(entry => select(entry.filename));
+                Promise.all(selected.map(entry => readEntry(entry, function (blob) {
+                    var extension = entry.filename.split(".").pop();
+                    return readNpzEntryBlob(blob, entry.filename, extension);
+                }))).then(function (results) {
+                    resolve(pairsToObj(selected.map((entry, i) => [entry.filename, results[i]])));
+                });
+            });
+        });
+    }, zip.HttpRangeReader);
+}
+
+// names of the npy entries holding the coordinates of every group that were
+// written as arrays (arviz_to_json(..., coord_threshold=...)), and the
+// arrays of DAGs (arviz_to_json(..., dag_format="csr"))
+function coordEntries(header) {
+    var names = [];
+    for (var group in header.inference_data) {
+        var coords = header.inference_data[group].coords;
+        for (var c in coords) {
+            if (coords[c] && coords[c].array_name) names.push(linkedEntry(header, coords[c].array_name));
+        }
+        var graph = (header.inference_data[group].attrs || {}).graph;
+        if (graph && graph.encoding == "csr") {
+            var dag_names = Object.values(graph.array_names).concat([graph.names.array_name]);
+            for (var dim in graph.coords) {
+                if (graph.coords[dim].array_name) dag_names.push(graph.coords[dim].array_name);
+            }
+            dag_names.forEach(name => names.push(linkedEntry(header, name)));
+        }
+    }
+    return names;
+}
+
+// load the header, then only the entries named by select_names(header),
+// and the coordinates, as an npz block
+function load_npz_selected(url, select_names) {
+    return load_npz_entries(url, name => name == "header.json").then(function (block) {
+        var header = block["header.json"];
+        var wanted = {"header.json": true};
+        select_names(header).concat(coordEntries(header)).forEach(name => wanted[name] = true);
+        return load_npz_entries(url, name => wanted[name]);
+    });
+}
+
+// fetch entries one by one from an archive served by `python -m arviz_json.server`,
+// as an npz block; url is the server, e.g. "http://localhost:8000/", and names
+// are the paths of the entries in the archive. The server sends ETags, so
+// entries fetched before come from the browser cache.
+function fetchServedEntries(url, names) {
+    var base = url.endsWith("/") ? url : url + "/";
+    return Promise.all(names.map(function (name) {
+        return fetch(base + name.split("/").map(encodeURIComponent).join("/")).then(function (response) {
+            if (!response.ok) throw new Error("Could not fetch " + name + ": " + response.status);
+            return name.endsWith(".json") ? response.json() : response.arrayBuffer().then(NumpyLoader.fromBuffer);
+        }).then(value => [name, value]);
+    })).then(pairsToObj);
+}
+
+// as load_npz_selected, from an archive served by `python -m arviz_json.server`:
+// fetch the header, then only the entries named by select_names(header) and the
+// coordinates. model names one model of a flat multi model archive; its entries
+// are under <model>/, but deduplicated arrays (objects/<hash>) are shared at
+// the root of the archive. Resolves to an npz block for reassemble_arviz.
+function load_npz_served(url, select_names, model) {
+    var prefix = model ? model + "/" : "";
+    var path = name => name.startsWith("objects/") ? name : prefix + name;
+    return fetchServedEntries(url, [prefix + "header.json"]).then(function (header_block) {
+        var header = header_block[prefix + "header.json"];
+        var wanted = select_names(header).concat(coordEntries(header));
+        wanted = wanted.filter((name, i) => wanted.indexOf(name) == i);
+        return fetchServedEntries(url, wanted.map(path)).then(function (block) {
+            var npz_block = {"header.json": header};
+            wanted.forEach(name => npz_block[name] = block[path(name)]);
+            return npz_block;
+        });
+    });
+}
+
+// load only the header, the summary statistics and the coordinates of an NPZ file
+// written with arviz_to_json(..., summary=True), skipping all draws
+function load_npz_summary(url) {
+    return load_npz_selected(url, function (header) {
+        var names = [];
+        for (var group in header.inference_data) {
+            for (var v in header.inference_data[group].vars) {
+                var summary = header.inference_data[group].vars[v].summary;
+                if (summary) names.push(linkedEntry(header, summary.array_name));
+            }
+        }
+        return names;
+    });
+}
+
+// names of the npy entries holding the full array of a variable
+function fullArrayEntries(header, var_v) {
+    var names = var_v.chunks ? var_v.chunks.array_names : [var_v.array_name];
+    return names.map(name => linkedEntry(header, name));
+}
+
+// load an NPZ file written with arviz_to_json(..., lod_levels=...), fetching
+// only the coarsest thinned level of each variable that has levels of detail,
+// and the full arrays of all other variables. Resolves to reassembled
+// inference data, where var.step gives the thinning of each loaded array.
+// Use refineLOD() to load finer levels on demand.
+function load_npz_lod(url, array_transformer) {
+    return load_npz_selected(url, function (header) {
+        var inference_data = header.inference_data;
+        var names = [];
+        for (var group in inference_data) {
+            for (var v in inference_data[group].vars) {
+                var var_v = inference_data[group].vars[v];
+                names = names.concat(var_v.lod ? [linkedEntry(header, var_v.lod[0].array_name)] : fullArrayEntries(header, var_v));
+            }
+        }
+        return names;
+    }).then(block => reassemble_arviz(block, array_transformer));
+}
+
+// load the next finer level of detail of a variable from a reassembled archive
+// loaded with load_npz_lod, or the full array once there are no finer levels
+// resolves to the variable, with var.array and var.step updated
+function refineLOD(url, var_v, array_transformer) {
+    var transformer = array_transformer || (x=>x);
+    var finer = (var_v.lod || []).filter(level => level.step < var_v.step);
+    if (var_v.step == 1) return Promise.resolve(var_v);
+    // levels are listed coarsest first
+    var array_names = finer.length ? [finer[0].array_name] : (var_v.chunks ? var_v.chunks.array_names : [var_v.array_name]);
+    var header = {links: var_v.entry_links};
+    var names = array_names.map(name => linkedEntry(header, name));
+    return load_npz_entries(url, name => names.indexOf(name) >= 0).then(function (block) {
+        var entry = (name, i) => unfilterEntry(block[names[i]], var_v.entry_filters[name]);
+        if (finer.length) {
+            finer[0].array = entry(array_names[0], 0);
+            var_v.array = transformer(decodeFilters(var_v, finer[0].array));
+            var_v.step = finer[0].step;
+        } else {
+            var chunks = array_names.map(entry);
+            var full = var_v.chunks ? joinChunks(var_v, chunks) : chunks[0];
+            var_v.array = transformer(decodeFilters(var_v, full));
+            var_v.step = 1;
+        }
+        return var_v;
+    });
+}
+
+// fetch the arrays of an npz block that are in a shared store rather than
+// in the archive itself (arviz_to_json(..., store=...)), adding them to the
+// block so that it can be passed to reassemble_arviz. store_url defaults to
+// the store recorded in the header, relative to the archive url
+function loadStoreEntries(npz_block, url, store_url) {
+    var header = npz_block["header.json"];
+    var external = header.external || {};
+    store_url = store_url || url.slice(0, url.lastIndexOf("/") + 1) + header.store + "/";
+    return Promise.all(Object.keys(external).map(function (name) {
+        return new Promise(function (resolve, reject) {
+            NumpyLoader.ajax(store_url + external[name], function (arr) {
+                npz_block[name + ".npy"] = arr;
+                resolve();
+            });
+        });
+    })).then(() => npz_block);
+}
+
+// load an NPZ file and the arrays it references in a shared store
+function load_npz_with_store(url, store_url) {
+    return load_npz(url).then(block => loadStoreEntries(block, url, store_url));
+}
+
 // load an NPZ file from an in memory blob
 function readNpzBlob(blob) {
     var promise = new Promise(function (resolve, reject) {
@@ -102,12 +327,73 @@ function readNpzBlob(blob) {
 
 // load multiple npz files inside a zip file
 // optionally, can be metadata as json inside the zip as well
+// also reads the "flat" layout, where each model is stored as
+// <model>/<array>.npy entries and a <model>/header.json
 function loadMultiModel(url) {
     function parse_multi(reader) {
         return iterateZip(reader, function (blob, filename, extension) {
             if (extension == 'npz') return readNpzBlob(blob);
+            if (extension == 'npy') return readNpyBlob(blob);
             if (extension == 'json') return readJSONBlob(blob);
         });
     }
     return readZipWith(url, parse_multi);
-}
\ No newline at end of file
+}
+
+// read an uncompressed NPZ file that is already in memory as an ArrayBuffer
+// (e.g. written with compressed=False, align=64). Each array is a typed array
+// view directly into the archive buffer, so nothing is copied. This only reads
+// STORED entries; the data offsets must be aligned for the array dtypes.
+function readStoredNpz(buf) {
+    var view = new DataView(buf);
+    // find the end of central directory record, searching back over any comment
+    var eocd = buf.byteLength - 22;
+    while (eocd >= 0 && view.getUint32(eocd, true) != 0x06054b50) eocd--;
+    if (eocd < 0) throw new Error('not a zip file');
+    var n_entries = view.getUint16(eocd + 10, true);
+    var index = view.getUint32(eocd + 16, true);
+    var result = {};
+    for (var i = 0; i < n_entries; i++) {
+        var method = view.getUint16(index + 10, true);
+        var size = view.getUint32(index + 20, true);
+        var name_length = view.getUint16(index + 28, true);
+        var extra_length = view.getUint16(index + 30, true);
+        var comment_length = view.getUint16(index + 32, true);
+        var local_offset = view.getUint32(index + 42, true);
+        var filename = asciiDecodeBuffer(buf, index + 46, name_length);
+        if (method != 0) throw new Error(filename + ' is compressed; use load_npz instead');
+        // the local header has its own extra field, which holds the alignment padding
+        var data_offset = local_offset + 30 + view.getUint16(local_offset + 26, true) +
+            view.getUint16(local_offset + 28, true);
+        var extension = filename.split(".").pop();
+        if (extension == 'npy') result[filename] = NumpyLoader.fromBuffer(buf, data_offset);
+        if (extension == 'json') result[filename] = JSON.parse(asciiDecodeBuffer(buf, data_offset, size));
+        index += 46 + name_length + extra_length + comment_length;
+    }
+    return result;
+}
+
+function asciiDecodeBuffer(buf, offset, length) {
+    return new TextDecoder().decode(new Uint8Array(buf, offset, length));
+}
+
+// load an uncompressed, aligned NPZ file from a URL, viewing
+// the arrays directly inside the downloaded buffer
+function load_npz_aligned(url) {
+    return fetch(url).then(response => response.arrayBuffer()).then(readStoredNpz);
+}
+
+// poll an archive that is still being written by NpzAppender: fetch its
+// current header, and every entry that is not already in npz_block, using
+// HTTP range requests. Resolves to the updated block, which can be passed
+// to reassemble_arviz again.
+function load_npz_update(url, npz_block) {
+    npz_block = npz_block || {};
+    return load_npz_entries(url, name => name == "header.json").then(function (block) {
+        npz_block["header.json"] = block["header.json"];
+        return load_npz_entries(url, name => name.endsWith(".npy") && !(name in npz_block));
+    }).then(function (block) {
+        Object.assign(npz_block, block);
+        return npz_block;
+    });
+}
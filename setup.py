@@ -16,5 +16,6 @@ setup(
      url = 'https://github.com/johnhw/arviz_json', # use the URL to the github repo
     download_url = 'https://github.com/johnhw/arviz_json/tarball/0.1',
     keywords=["arviz", "probabilistic", "javascript", "probabilistic programming", 
-    "inference", "json", "inferencedata"]
+    "inference", "json", "inferencedata"],
+    entry_points={"console_scripts": ["arviz-json=arviz_json.cli:main"]},
  )
\ No newline at end of file
@@ -4,11 +4,27 @@ from arviz_json import (
     arviz_to_json,
     fix_dtype,
     write_for_js,
+    NpzWriter,
+    NpzAppender,
+    NpzReader,
+    EntryCache,
+    ArchiveCache,
+    iter_archive,
+    ArchiveServer,
+    json_to_arviz,
     get_dag,
+    model_hash,
     multi_arviz_to_json,
 )
 import numpy as np
 import zipfile, json
+import asyncio
+import io
+import os
+import shutil
+import threading
+import urllib.error
+import urllib.request
 import arviz as az
 
 
@@ -51,6 +67,28 @@ def test_multi_model():
             check_zip(npz_name)
 
 
+def test_multi_model_flat():
+    models = {
+        "centered": az.load_arviz_data("centered_eight"),
+        "noncentered": az.load_arviz_data("non_centered_eight"),
+    }
+    for processes in [None, 2]:
+        multi_arviz_to_json(models, "multimodel.zip", layout="flat", processes=processes)
+        z = zipfile.ZipFile("multimodel.zip")
+        elements = z.namelist()
+        arrays = np.load("multimodel.zip")
+        for key in models:
+            assert key + "/header.json" in elements
+            header = json.loads(z.read(key + "/header.json"))["inference_data"]
+            posterior = header["posterior"]
+            for var, var_header in posterior["vars"].items():
+                array = arrays[key + "/" + var_header["array_name"]]
+                assert np.array_equal(array, models[key].posterior[var].values)
+
+    with pytest.raises(ValueError):
+        multi_arviz_to_json(models, "multimodel.zip", layout="sideways")
+
+
 def test_arviz_to_json():
     import arviz as az
 
@@ -63,6 +101,19 @@ def test_arviz_to_json():
         arviz_to_json(data, f)
     check_zip("centered_eight_as_f.npz")
 
+    # a failed export leaves the previous archive as it was, and no partial one
+    before = os.path.getmtime("centered_eight.npz")
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "centered_eight.npz", precision={"posterior": "f2"})
+    assert os.path.getmtime("centered_eight.npz") == before
+    check_zip("centered_eight.npz")
+    if os.path.exists("failed.npz"):
+        os.remove("failed.npz")
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "failed.npz", precision={"posterior": "f2"})
+    assert not os.path.exists("failed.npz")
+    assert not any(f.endswith(".tmp") for f in os.listdir("."))
+
 
 def _check_zip(f):
     z = zipfile.ZipFile(f)
@@ -107,6 +158,727 @@ def test_write_for_js():
     check_zip("test.npz")
 
 
+def test_npz_writer():
+    from io import BytesIO
+
+    f = BytesIO()
+    with NpzWriter(f) as npz:
+        npz.write_array("array_1", np.arange(20.0).reshape(4, 5))
+        npz.write_array("array_2", np.ones(400, dtype=np.int8))
+        npz.write_header({"test": np.float64(1.5)})
+
+    z = zipfile.ZipFile(f)
+    # header is written in the same pass, as the last entry
+    assert z.namelist() == ["array_1.npy", "array_2.npy", "header.json"]
+    assert json.loads(z.read("header.json")) == {"inference_data": {"test": 1.5}}
+    f.seek(0)
+    arrays = np.load(f)
+    assert np.array_equal(arrays["array_1"], np.arange(20.0).reshape(4, 5))
+    assert arrays["array_2"].dtype == np.int8
+
+
+def test_parallel_compression():
+    from concurrent.futures import ThreadPoolExecutor
+
+    test_arrays = {
+        f"array_{i}": np.random.normal(0, 1, (10, i + 1)) for i in range(20)
+    }
+    test_arrays["ints"] = np.arange(100, dtype=np.int8)
+    for compressed in [True, False]:
+        write_for_js("test.npz", {}, test_arrays, compressed=compressed, workers=4)
+        arrays = check_zip("test.npz")
+        assert zipfile.ZipFile("test.npz").testzip() is None
+        # entries stay in the order they were passed in
+        assert list(arrays.keys())[:-1] == list(test_arrays.keys())
+        for k in test_arrays:
+            assert np.array_equal(arrays[k], test_arrays[k])
+
+    # an existing executor can be shared
+    with ThreadPoolExecutor(2) as executor:
+        data = az.load_arviz_data("centered_eight")
+        arviz_to_json(data, "centered_eight.npz", workers=executor)
+    check_zip("centered_eight.npz")
+
+
+def _data_offset(raw, info):
+    """Offset in raw of the data of the zip entry info"""
+    name_length, extra_length = np.frombuffer(
+        raw[info.header_offset + 26 : info.header_offset + 30], dtype="<u2"
+    )
+    return info.header_offset + 30 + int(name_length) + int(extra_length)
+
+
+def test_aligned():
+    test_arrays = {
+        "a": np.arange(7, dtype=np.int8),
+        "bb": np.ones((3, 5)),
+        "ccc": np.zeros((2, 2), dtype=np.float32),
+    }
+    for workers in [None, 2]:
+        write_for_js("test.npz", {}, test_arrays, compressed=False, align=64, workers=workers)
+        arrays = check_zip("test.npz")
+        with open("test.npz", "rb") as f:
+            raw = f.read()
+        z = zipfile.ZipFile("test.npz")
+        for k, v in test_arrays.items():
+            info = z.getinfo(k + ".npy")
+            assert info.compress_type == zipfile.ZIP_STORED
+            start = _data_offset(raw, info)
+            assert start % 64 == 0
+            # the array data follows the (64 byte padded) npy header
+            header_length = np.frombuffer(raw[start + 8 : start + 10], dtype="<u2")[0]
+            assert (10 + header_length) % 64 == 0
+            view = np.frombuffer(
+                raw, dtype=v.dtype, count=v.size, offset=start + 10 + header_length
+            )
+            assert np.array_equal(view.reshape(v.shape), v)
+            assert np.array_equal(arrays[k], v)
+
+    with pytest.raises(ValueError):
+        write_for_js("test.npz", {}, test_arrays, compressed=True, align=64)
+
+    # the arrays of each model of a nested multi model archive stay aligned
+    models = {"centered": az.load_arviz_data("centered_eight")}
+    for processes in [None, 2]:
+        multi_arviz_to_json(models, "aligned.zip", compressed=False, align=64, processes=processes)
+        with open("aligned.zip", "rb") as f:
+            raw = f.read()
+        outer = zipfile.ZipFile("aligned.zip")
+        base = _data_offset(raw, outer.getinfo("centered.npz"))
+        inner = zipfile.ZipFile(io.BytesIO(outer.read("centered.npz")))
+        for info in inner.infolist():
+            if info.filename.endswith(".npy"):
+                assert (base + _data_offset(raw[base:], info)) % 64 == 0
+    with pytest.raises(ValueError):
+        multi_arviz_to_json(models, "aligned.zip", align=64)
+
+
+def test_chunks():
+    data = az.load_arviz_data("centered_eight")
+    arviz_to_json(data, "chunked.npz", chunks={"chain": 1, "draw": 200})
+    z = zipfile.ZipFile("chunked.npz")
+    header = json.loads(z.read("header.json"))["inference_data"]
+    theta = header["posterior"]["vars"]["theta"]
+    # 4 chains, 500 draws -> 4 x 3 chunks, the last one shorter
+    assert theta["chunks"]["shape"] == [1, 200, 8]
+    assert theta["chunks"]["grid"] == [4, 3, 1]
+    assert len(theta["chunks"]["array_names"]) == 12
+    arrays = np.load("chunked.npz")
+    assert arrays[theta["array_name"] + "/3.2.0"].shape == (1, 100, 8)
+    assert np.array_equal(
+        arrays[theta["array_name"] + "/1.2.0"], data.posterior.theta.values[1:2, 400:]
+    )
+    # variables without chain or draw dimensions are not split
+    assert "chunks" not in header["observed_data"]["vars"]["obs"]
+
+    loaded = json_to_arviz("chunked.npz")
+    assert np.array_equal(loaded.posterior.theta.values, data.posterior.theta.values)
+
+
+def test_summary():
+    data = az.load_arviz_data("centered_eight")
+    arviz_to_json(data, "summary.npz", summary=True)
+    z = zipfile.ZipFile("summary.npz")
+    header = json.loads(z.read("header.json"))["inference_data"]
+    theta = header["posterior"]["vars"]["theta"]
+    assert theta["summary"]["stats"] == ["mean", "sd", "hdi_3%", "hdi_97%", "ess_bulk", "r_hat"]
+    assert theta["summary"]["dims"] == ["school"]
+    assert "summary" not in header["observed_data"]["vars"]["obs"]
+
+    reader = NpzReader("summary.npz")
+    summary = reader.get_summary("posterior", "theta")
+    expected = az.summary(data, var_names=["theta"], round_to="none")
+    assert np.allclose(summary["mean"], expected["mean"])
+    assert np.allclose(summary["sd"], expected["sd"])
+    assert np.allclose(summary["hdi_3%"], expected["hdi_3%"])
+    assert np.allclose(summary["ess_bulk"], expected["ess_bulk"])
+    assert np.allclose(summary["r_hat"], expected["r_hat"])
+    assert reader.get_summary("sample_stats", "diverging")["mean"].shape == ()
+
+
+def test_lod():
+    data = az.load_arviz_data("centered_eight")
+    arviz_to_json(data, "lod.npz", lod_target=100)
+    z = zipfile.ZipFile("lod.npz")
+    header = json.loads(z.read("header.json"))["inference_data"]
+    lod = header["posterior"]["vars"]["theta"]["lod"]
+    # 500 draws -> 250, 125, 63; coarsest first
+    assert [level["step"] for level in lod] == [8, 4, 2]
+    assert lod[0]["shape"] == [4, 63, 8]
+    arrays = np.load("lod.npz")
+    assert np.array_equal(
+        arrays[lod[1]["array_name"]], data.posterior.theta.values[:, ::4]
+    )
+    assert "lod" not in header["posterior_predictive"]["vars"]["obs"]
+
+    arviz_to_json(data, "lod.npz", lod_levels=1)
+    header = json.loads(zipfile.ZipFile("lod.npz").read("header.json"))["inference_data"]
+    assert [level["step"] for level in header["prior"]["vars"]["mu"]["lod"]] == [2]
+
+
+def test_precision():
+    data = az.load_arviz_data("centered_eight")
+    data.posterior["theta"][0, 0, 0] = np.nan
+    precision = {
+        "posterior": "u2",
+        "posterior/mu": 3,
+        "posterior_predictive": "f4",
+        "prior": "u1",
+        "sample_stats": "u1",
+    }
+    arviz_to_json(data, "precision.npz", precision=precision, chunks={"draw": 100})
+    z = zipfile.ZipFile("precision.npz")
+    header = json.loads(z.read("header.json"))["inference_data"]
+    theta = header["posterior"]["vars"]["theta"]["filters"][0]
+    assert theta["id"] == "quantize" and theta["dtype"] == "<u2"
+    assert theta["nan_code"] == 65535
+    assert 0 < theta["max_abs_error"] <= theta["scale"] / 2 + 1e-12
+    assert header["posterior"]["vars"]["mu"]["filters"][0]["id"] == "round"
+    # integer and bool variables are never encoded
+    assert "filters" not in header["sample_stats"]["vars"]["diverging"]
+    assert "filters" not in header["observed_data"]["vars"]["obs"]
+
+    loaded = json_to_arviz("precision.npz")
+    for group, var in [
+        ("posterior", "theta"),
+        ("posterior", "mu"),
+        ("posterior_predictive", "obs"),
+        ("prior", "tau"),
+    ]:
+        error = header[group]["vars"][var]["filters"][0]["max_abs_error"]
+        original = data[group][var].values
+        decoded = loaded[group][var].values
+        assert decoded.dtype == original.dtype
+        assert np.array_equal(np.isnan(decoded), np.isnan(original))
+        assert np.nanmax(np.abs(decoded - original)) <= error + 1e-12
+        # and the encoding is actually lossy
+        assert error > 0
+    assert np.array_equal(loaded.sample_stats.diverging, data.sample_stats.diverging)
+
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "precision.npz", precision={"posterior": "f2"})
+
+
+def test_shuffle():
+    data = az.load_arviz_data("centered_eight")
+    arviz_to_json(data, "shuffled.npz", shuffle=True)
+    arviz_to_json(data, "plain.npz")
+    z = zipfile.ZipFile("shuffled.npz")
+    output = json.loads(z.read("header.json"))
+    header = output["inference_data"]
+    theta = header["posterior"]["vars"]["theta"]
+    assert output["filters"][theta["array_name"]] == [{"id": "shuffle", "dtype": "<f8"}]
+    # bytes are stored as planes, one per byte of the dtype
+    with z.open(theta["array_name"] + ".npy") as f:
+        planes = np.lib.format.read_array(f)
+    assert planes.dtype == np.uint8 and planes.shape == (8,) + tuple(theta["shape"])
+    # integer and bool variables are not shuffled
+    diverging = header["sample_stats"]["vars"]["diverging"]["array_name"]
+    assert diverging not in output["filters"]
+    assert os.path.getsize("shuffled.npz") < os.path.getsize("plain.npz")
+
+    loaded = json_to_arviz("shuffled.npz")
+    for group in data._groups:
+        for var in getattr(data, group).data_vars:
+            assert np.array_equal(
+                loaded[group][var].values, data[group][var].values, equal_nan=True
+            )
+
+    # write_for_js archives are self describing too
+    arr = np.linspace(0, 1, 1000)
+    write_for_js("shuffled.npz", {"x": "x"}, {"x": arr}, shuffle=True)
+    z = zipfile.ZipFile("shuffled.npz")
+    assert json.loads(z.read("header.json"))["filters"]["x"][0]["id"] == "shuffle"
+
+
+def test_coords():
+    n = 2000
+    dates = np.arange("2020-01-01", n, dtype="datetime64[D]").astype("datetime64[ns]")
+    dates[3] = np.datetime64("NaT")
+    dates[5] = np.datetime64("2020-01-06T00:00:00.123456789")
+    data = az.from_dict(
+        observed_data={"y": np.arange(n, dtype=float)},
+        coords={"obs": [f"ob\u00e9{i}" for i in range(n)]},
+        dims={"y": ["obs"]},
+    )
+    data.observed_data = data.observed_data.assign_coords(
+        date=("obs", dates),
+        index=("obs", np.arange(n) * 3),
+        wait=("obs", np.diff(dates, append=dates[0])),
+    )
+    arviz_to_json(data, "coords.npz", coord_threshold=100, shuffle=True)
+    z = zipfile.ZipFile("coords.npz")
+    coords = json.loads(z.read("header.json"))["inference_data"]["observed_data"]["coords"]
+    assert coords["obs"]["array_name"] == "coords/observed_data/obs"
+    assert coords["obs"]["encoding"] == "utf8"
+    assert coords["date"]["encoding"] == "datetime64[ns]"
+    assert coords["wait"]["encoding"] == "timedelta64[ns]"
+    assert coords["index"]["encoding"] is None
+    assert "coords/observed_data/date.npy" in z.namelist()
+
+    with NpzReader("coords.npz") as reader:
+        for k in ["obs", "date", "wait", "index"]:
+            values = reader.get_coord("observed_data", k)
+            original = data.observed_data[k].values
+            assert values.dtype == original.dtype
+            assert np.array_equal(values, original, equal_nan=original.dtype.kind != "U")
+    loaded = json_to_arviz("coords.npz")
+    assert list(loaded.observed_data.obs.values) == list(data.observed_data.obs.values)
+
+    # small coordinates stay as lists in the header
+    arviz_to_json(data, "coords.npz", coord_threshold=None)
+    z = zipfile.ZipFile("coords.npz")
+    group_header = json.loads(z.read("header.json"))["inference_data"]["observed_data"]
+    assert group_header["coords"]["obs"][:2] == ["ob\u00e90", "ob\u00e91"]
+    assert group_header["coord_dims"] == {"date": ["obs"], "index": ["obs"], "wait": ["obs"]}
+
+    # coordinates that are not dimensions are read back with their dims
+    for coord_threshold in [None, 100]:
+        arviz_to_json(data, "coords.npz", coord_threshold=coord_threshold)
+        loaded = json_to_arviz("coords.npz").observed_data
+        for k in ["date", "index", "wait"]:
+            assert loaded[k].dims == ("obs",)
+            assert np.array_equal(loaded[k].values, data.observed_data[k].values, equal_nan=True)
+
+    # dates and durations read back the same, and exactly, on both sides of
+    # the threshold
+    timed = az.from_dict(
+        observed_data={"y": np.zeros(n), "z": np.zeros(n - 1)},
+        coords={"date": dates, "wait": np.diff(dates)},
+        dims={"y": ["date"], "z": ["wait"]},
+    )
+    for coord_threshold in [None, 100]:
+        arviz_to_json(timed, "coords.npz", coord_threshold=coord_threshold)
+        loaded = json_to_arviz("coords.npz")
+        for k in ["date", "wait"]:
+            original = timed.observed_data[k].values
+            assert loaded.observed_data[k].dtype == original.dtype
+            assert np.array_equal(loaded.observed_data[k].values, original, equal_nan=True)
+        assert str(loaded.observed_data.date.values[5]) == "2020-01-06T00:00:00.123456789"
+
+
+def test_csr_graph():
+    # a DAG as written by get_dag, with a long coordinate
+    graph = {
+        f"x{i}": {
+            "name": f"x{i}",
+            "type": ["free", "observed", "deterministic"][i % 3],
+            "parents": [f"x{j}" for j in range(max(0, i - 3), i)],
+            "size": i,
+            "dims": ["obs"] if i % 2 else [],
+            "coords": {"obs": [str(k) for k in range(2000)]} if i % 2 else {},
+            "distribution": {"dist": "Normal", "type": "Continuous", "shape": [2000]}
+            if i % 2
+            else {},
+        }
+        for i in range(50)
+    }
+    data = az.from_dict(sample_stats={"lp": np.zeros((2, 10))})
+    data.sample_stats.attrs["graph"] = graph
+    arviz_to_json(data, "graph.npz", dag_format="csr")
+    z = zipfile.ZipFile("graph.npz")
+    header = json.loads(z.read("header.json"))["inference_data"]
+    encoded = header["sample_stats"]["attrs"]["graph"]
+    assert encoded["encoding"] == "csr"
+    assert encoded["n_nodes"] == 50
+    assert encoded["types"] == ["free", "observed", "deterministic"]
+    assert "dag/sample_stats/coords/obs.npy" in z.namelist()
+
+    with NpzReader("graph.npz") as reader:
+        assert reader.get_dag() == graph
+        offsets = reader.read_entry("dag/sample_stats/parent_offsets")
+        assert list(offsets[:5]) == [0, 0, 1, 3, 6]
+    assert json_to_arviz("graph.npz").sample_stats.attrs["graph"] == graph
+
+    graph["x3"]["parents"].append("missing")
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "graph.npz", dag_format="csr")
+
+
+def test_out_of_core():
+    import xarray as xr
+
+    x = np.random.randn(2, 300, 40)
+    x[1, 3, 4] = np.nan
+    xr.Dataset({"mu": (("chain", "draw", "obs"), x)}).to_netcdf("lazy.nc")
+    with xr.open_dataset("lazy.nc") as lazy:
+        data = az.InferenceData(posterior=lazy)
+        # blocks of a few rows of draws
+        report = arviz_to_json(data, "lazy.npz", block_size=2000)
+        assert report["variables"]["posterior/mu"]["raw_bytes"] == x.nbytes
+        assert np.array_equal(json_to_arviz("lazy.npz").posterior.mu.values, x, equal_nan=True)
+        arviz_to_json(data, "lazy.npz", block_size=2000, precision={"posterior": "u2"})
+        loaded = json_to_arviz("lazy.npz").posterior.mu.values
+        assert np.nanmax(np.abs(loaded - x)) < (np.nanmax(x) - np.nanmin(x)) / 60000
+        # the variable was never loaded whole
+        assert not lazy.mu.variable._in_memory
+
+    with NpzWriter("blocks.npz") as npz:
+        npz.write_blocks("x", (3, 4), "<f8", [np.zeros(5), np.ones(7)])
+        with pytest.raises(ValueError):
+            npz.write_blocks("y", (3, 4), "<f8", [np.zeros(5)])
+    with zipfile.ZipFile("blocks.npz") as z:
+        assert np.array_equal(np.load(z.open("x.npy")).reshape(-1), [0] * 5 + [1] * 7)
+
+    # blocks of a chunked file start and end on its chunks
+    from arviz_json.arviz_json import _block_slices, _source_chunks
+
+    pytest.importorskip("h5netcdf")
+    encoding = {"mu": {"chunksizes": (1, 70, 40)}}
+    xr.Dataset({"mu": (("chain", "draw", "obs"), x)}).to_netcdf(
+        "chunked.nc", engine="h5netcdf", encoding=encoding
+    )
+    with xr.open_dataset("chunked.nc", engine="h5netcdf") as lazy:
+        chunks = _source_chunks(lazy.mu)
+        assert chunks == ((1, 1), (70, 70, 70, 70, 20), (40,))
+        slices = _block_slices(lazy.mu.shape, 8, 2000, chunks)
+        assert [s[1] for s in slices[:5]] == [slice(i, min(i + 70, 300)) for i in range(0, 300, 70)]
+        assert [s[1] for s in _block_slices(lazy.mu.shape, 8, 50000, chunks)[:2]] == [
+            slice(0, 140),
+            slice(140, 280),
+        ]
+        arviz_to_json(az.InferenceData(posterior=lazy), "lazy.npz", block_size=2000)
+        assert np.array_equal(json_to_arviz("lazy.npz").posterior.mu.values, x, equal_nan=True)
+
+
+def test_iter_archive():
+    data = az.load_arviz_data("centered_eight")
+    other = az.load_arviz_data("non_centered_eight")
+    cache = ArchiveCache()
+
+    async def collect(data, **options):
+        return [chunk async for chunk in iter_archive(data, chunk_size=1000, **options)]
+
+    async def stop_early():
+        chunks = iter_archive(data, chunk_size=100)
+        await chunks.__anext__()
+        await chunks.aclose()
+
+    chunks = asyncio.run(collect(data, cache=cache, shuffle=True))
+    assert max(len(chunk) for chunk in chunks) == 1000
+    archive = b"".join(chunks)
+    with NpzReader(io.BytesIO(archive)) as reader:
+        assert np.array_equal(reader.get_array("posterior", "mu"), data.posterior.mu.values)
+
+    # the same model and options are served from the cache
+    assert cache.misses == 1 and cache.hits == 0
+    assert b"".join(asyncio.run(collect(data, cache=cache, shuffle=True))) == archive
+    assert cache.hits == 1
+    asyncio.run(collect(data, cache=cache))
+    asyncio.run(collect(other, cache=cache, shuffle=True))
+    assert len(cache) == 3 and cache.hits == 1
+
+    # least recently used archives are dropped to fit
+    small = ArchiveCache(max_bytes=int(2.5 * len(archive)))
+    for key in ["a", "b", "c", "b"]:
+        asyncio.run(collect(data, cache=small, key=key, shuffle=True))
+    assert len(small) == 2 and small.hits == 1
+    asyncio.run(collect(data, cache=small, key="a", shuffle=True))
+    assert small.hits == 1
+
+    asyncio.run(stop_early())
+    with pytest.raises(ValueError):
+        asyncio.run(collect(data, precision={"posterior": "f2"}))
+
+
+def test_selection():
+    data = az.load_arviz_data("centered_eight")
+    report = arviz_to_json(
+        data,
+        "selected.npz",
+        groups=["posterior", "observed_data"],
+        var_names=["theta", "obs"],
+        coords={"school": ["Choate", "Deerfield"], "draw": slice(0, 99)},
+    )
+    assert sorted(report["variables"]) == ["observed_data/obs", "posterior/theta"]
+    loaded = json_to_arviz("selected.npz")
+    assert list(loaded.posterior.data_vars) == ["theta"]
+    assert loaded.posterior.theta.shape == (4, 100, 2)
+    assert list(loaded.observed_data.school.values) == ["Choate", "Deerfield"]
+    expected = data.posterior.theta.sel(school=["Choate", "Deerfield"]).isel(draw=slice(100))
+    assert np.array_equal(loaded.posterior.theta.values, expected.values)
+
+    arviz_to_json(data, "selected.npz", var_names=["^t"], filter_vars="regex")
+    loaded = json_to_arviz("selected.npz")
+    assert list(loaded.posterior.data_vars) == ["theta", "tau"]
+    assert list(loaded.sample_stats.data_vars) == ["tree_depth"]
+    assert "observed_data" not in loaded._groups
+    arviz_to_json(data, "selected.npz", groups="posterior", var_names="~theta")
+    assert list(json_to_arviz("selected.npz").posterior.data_vars) == ["mu", "tau"]
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "selected.npz", var_names=["theta", "nope"])
+    with pytest.raises(ValueError):
+        arviz_to_json(data, "selected.npz", groups=["posterior", "nope"])
+
+    # options for one model of a multi model archive
+    multi_arviz_to_json(
+        {"a": data, "b": data},
+        "selected.zip",
+        layout="flat",
+        groups="posterior",
+        model_options={"b": {"var_names": "mu"}},
+    )
+    assert list(json_to_arviz("selected.zip", prefix="a/").posterior.data_vars) == [
+        "mu",
+        "theta",
+        "tau",
+    ]
+    assert list(json_to_arviz("selected.zip", prefix="b/").posterior.data_vars) == ["mu"]
+
+
+def test_dedup():
+    data = az.load_arviz_data("centered_eight")
+    other = data.copy()
+    other.posterior["mu"] = other.posterior["mu"] + 1
+    multi_arviz_to_json({"a": data, "b": other}, "dedup.zip", layout="flat", dedup=True)
+    z = zipfile.ZipFile("dedup.zip")
+    headers = {name: json.loads(z.read(f"{name}/header.json")) for name in "ab"}
+
+    def entry(name, group, var):
+        header = headers[name]
+        return header["links"][header["inference_data"][group]["vars"][var]["array_name"]]
+
+    mu = {name: entry(name, "posterior", "mu") for name in "ab"}
+    obs = {name: entry(name, "observed_data", "obs") for name in "ab"}
+    # identical arrays share one entry, changed ones do not
+    assert obs["a"] == obs["b"] and obs["a"].startswith("objects/")
+    assert mu["a"] != mu["b"]
+    objects = [name for name in z.namelist() if name.startswith("objects/")]
+    assert len(objects) == len(set(objects)) < 2 * len(headers["a"]["links"])
+    loaded = json_to_arviz("dedup.zip", prefix="b/")
+    assert np.array_equal(loaded.posterior.mu.values, other.posterior.mu.values)
+    assert np.array_equal(loaded.observed_data.obs.values, data.observed_data.obs.values)
+
+    # later exports only ship arrays that are not already in the store
+    shutil.rmtree("store", ignore_errors=True)
+    arviz_to_json(data, "first.npz", store="store")
+    arviz_to_json(other, "second.npz", store="store")
+    header = json.loads(zipfile.ZipFile("second.npz").read("header.json"))
+    assert header["store"] == "store"
+    mu_name = header["inference_data"]["posterior"]["vars"]["mu"]["array_name"]
+    assert list(header["links"]) == [mu_name]
+    assert len(header["external"]) > 0
+    assert os.path.getsize("second.npz") < os.path.getsize("first.npz")
+    loaded = json_to_arviz("second.npz")
+    for group in data._groups:
+        for var in getattr(data, group).data_vars:
+            assert np.array_equal(
+                loaded[group][var].values, other[group][var].values, equal_nan=True
+            )
+
+
+def test_appender():
+    data = az.load_arviz_data("centered_eight")
+    groups = ["posterior", "sample_stats", "observed_data"]
+    if os.path.exists("appended.npz"):
+        os.remove("appended.npz")
+    appender = NpzAppender("appended.npz", shuffle=True)
+    for i, (start, stop) in enumerate([(0, 100), (100, 250), (250, 500)]):
+        if i == 2:
+            # carries on from the archive on disk
+            appender = NpzAppender("appended.npz", shuffle=True)
+        batch = az.InferenceData(
+            posterior=data.posterior.isel(draw=slice(start, stop)),
+            sample_stats=data.sample_stats.isel(draw=slice(start, stop)),
+            observed_data=data.observed_data,
+        )
+        appender.append(batch)
+        z = zipfile.ZipFile("appended.npz")
+        header = json.loads(z.read("header.json"))["inference_data"]
+        assert header["posterior"]["dims"]["draw"] == stop
+        assert header["posterior"]["coords"]["draw"] == list(range(stop))
+        theta = header["posterior"]["vars"]["theta"]
+        assert theta["shape"] == [4, stop, 8]
+        assert theta["chunks"]["offsets"][-1] == [0, start, 0]
+        # the header is replaced, not duplicated, and earlier entries stay put
+        assert z.namelist().count("header.json") == 1
+        first = z.getinfo(theta["chunks"]["array_names"][0] + ".npy").header_offset
+        if i == 0:
+            first_offset = first
+        assert first == first_offset
+
+    # archives written otherwise cannot be appended to
+    arviz_to_json(data, "not_appended.npz")
+    with pytest.raises(ValueError):
+        NpzAppender("not_appended.npz")
+
+    loaded = json_to_arviz("appended.npz")
+    for group in groups:
+        for var in data[group].data_vars:
+            assert np.array_equal(
+                loaded[group][var].values, data[group][var].values, equal_nan=True
+            )
+
+    with pytest.raises(ValueError):
+        appender.append(az.InferenceData(posterior=data.posterior.isel(school=slice(0, 2))))
+
+
+def test_cache():
+    data = az.load_arviz_data("centered_eight")
+    shutil.rmtree("cache", ignore_errors=True)
+    n_arrays = sum(len(data[group].data_vars) for group in data._groups)
+    for workers in [None, 2]:
+        cache = EntryCache("cache")
+        arviz_to_json(data, "uncached.npz", cache=cache, workers=workers)
+        hits = cache.hits
+        arviz_to_json(data, "cached.npz", cache=cache, workers=workers)
+        # every array of the second export comes from the cache
+        assert cache.hits - hits == n_arrays
+        uncached = zipfile.ZipFile("uncached.npz")
+        cached = zipfile.ZipFile("cached.npz")
+        assert [(i.filename, i.CRC, i.compress_size) for i in uncached.infolist()] == [
+            (i.filename, i.CRC, i.compress_size) for i in cached.infolist()
+        ]
+    loaded = json_to_arviz("cached.npz")
+    assert np.array_equal(loaded.posterior.theta.values, data.posterior.theta.values)
+
+    # least recently used entries are evicted to keep within max_bytes
+    cache = EntryCache("cache", max_bytes=200000)
+    arviz_to_json(data, "cached.npz", cache=cache)
+    sizes = [os.path.getsize(os.path.join("cache", f)) for f in os.listdir("cache")]
+    assert sum(sizes) <= 200000
+    cache.clear()
+    assert os.listdir("cache") == []
+
+
+def test_cli():
+    from arviz_json.cli import main
+
+    data = az.load_arviz_data("centered_eight")
+    shutil.rmtree("cli", ignore_errors=True)
+    os.makedirs("cli/inputs/nested")
+    data.to_netcdf("cli/inputs/a.nc")
+    data.to_netcdf("cli/inputs/nested/b.nc")
+    args = ["cli/inputs", "-o", "cli/out", "-j", "2", "-q", "--shuffle"]
+    assert main(args) == 0
+    assert sorted(os.listdir("cli/out")) == ["a.npz", "b.npz"]
+    loaded = json_to_arviz("cli/out/b.npz")
+    assert np.array_equal(loaded.posterior.mu.values, data.posterior.mu.values)
+
+    # up to date outputs are skipped
+    mtime = os.path.getmtime("cli/out/a.npz")
+    assert main(args) == 0
+    assert os.path.getmtime("cli/out/a.npz") == mtime
+    assert main(args + ["--skip", "hash"]) == 0
+    mtime = os.path.getmtime("cli/out/a.npz")
+    os.utime("cli/inputs/a.nc")
+    assert main(args + ["--skip", "hash"]) == 0
+    assert os.path.getmtime("cli/out/a.npz") == mtime
+
+    # outputs written with other writer options, or left incomplete, are rewritten
+    assert main(args[:-1]) == 0
+    with NpzReader("cli/out/a.npz") as reader:
+        assert not reader.entry_filters
+    for skip in ["mtime", "hash"]:
+        with zipfile.ZipFile("cli/out/a.npz", "w") as z:
+            z.writestr("posterior_mu.npy", b"")
+        with open("cli/out/b.npz", "wb") as f:
+            f.write(b"PK\x03\x04")
+        assert main(args + ["--skip", skip]) == 0
+        check_zip("cli/out/a.npz")
+        check_zip("cli/out/b.npz")
+    assert not any(f.endswith(".tmp") for f in os.listdir("cli/out"))
+
+    # every input packed into one multi-model file
+    assert main(["cli/inputs/**/*.nc", "-q", "--multi", "cli/multi.zip", "--layout", "flat"]) == 0
+    assert json_to_arviz("cli/multi.zip", prefix="b/").posterior.mu.shape == (4, 500)
+    assert main(["cli/missing.nc", "-q"]) == 2
+
+    # inputs that would be written to the same archive, or model, are refused
+    data.to_netcdf("cli/inputs/nested/a.nc")
+    assert main(args) == 2
+    assert main(["cli/inputs", "-q", "--multi", "cli/multi.zip"]) == 2
+    with pytest.raises(SystemExit):
+        main(["cli/inputs/a.nc", "--groups"])
+
+
+def test_report():
+    data = az.load_arviz_data("centered_eight")
+    reports = []
+    report = arviz_to_json(data, "report.npz", summary=True, on_report=reports.append)
+    assert reports == [report]
+    assert set(report["timings"]) == {
+        "header",
+        "conversion",
+        "summary",
+        "compression",
+        "header_serialization",
+        "total",
+    }
+    assert report["timings"]["total"] >= sum(
+        t for stage, t in report["timings"].items() if stage != "total"
+    )
+    diverging = report["variables"]["sample_stats/diverging"]
+    assert diverging["dtype"] == "|b1" and diverging["stored_dtype"] == "|i1"
+    assert diverging["coerced"]
+    assert not report["variables"]["posterior/mu"]["coerced"]
+    # the bool draws, and six float summary statistics
+    assert diverging["raw_bytes"] == data.sample_stats.diverging.size + 6 * 8
+    z = zipfile.ZipFile("report.npz")
+    entries = [info for info in z.infolist() if info.filename != "header.json"]
+    assert report["compressed_bytes"] == sum(info.compress_size for info in entries)
+    theta = report["variables"]["posterior/theta"]
+    assert theta["ratio"] == theta["raw_bytes"] / theta["compressed_bytes"]
+
+    report = write_for_js("report.npz", {}, {"x": np.zeros(1000)})
+    assert report["variables"]["x"]["raw_bytes"] == 8000
+    assert report["variables"]["x"]["ratio"] > 10
+
+
+def test_reader():
+    data = az.load_arviz_data("centered_eight")
+    for compressed in [True, False]:
+        arviz_to_json(data, "centered_eight.npz", compressed=compressed)
+        with NpzReader("centered_eight.npz") as reader:
+            assert set(reader.groups) == set(data._groups)
+            assert set(reader.variables("posterior")) == set(data.posterior.data_vars)
+            mu = reader.get_array("posterior", "mu")
+            # uncompressed entries are mapped straight from the archive
+            assert isinstance(mu, np.memmap) != compressed
+            assert np.array_equal(mu, data.posterior.mu.values)
+
+        loaded = json_to_arviz("centered_eight.npz")
+        for group in data._groups:
+            original = getattr(data, group)
+            for var in original.data_vars:
+                # round trips back to the original dtype, e.g. bool
+                assert loaded[group][var].dtype == original[var].dtype
+                assert np.array_equal(
+                    loaded[group][var].values, original[var].values, equal_nan=True
+                )
+        assert list(loaded.posterior.school.values) == list(data.posterior.school.values)
+        assert float(loaded.posterior.theta.sel(school="Choate", chain=0, draw=3)) == float(
+            data.posterior.theta.sel(school="Choate", chain=0, draw=3)
+        )
+
+    # lazy variables read only the chunks an index touches, and entries that
+    # are not chunked are decompressed once however often they are indexed
+    arviz_to_json(data, "centered_eight.npz", chunks={"draw": 100})
+    with NpzReader("centered_eight.npz") as reader:
+        entries = []
+        read_entry = reader.read_entry
+        reader.read_entry = lambda name: entries.append(name) or read_entry(name)
+        assert np.array_equal(
+            reader.get_array("posterior", "theta", (1, slice(250, 150, -20), -1)),
+            data.posterior.theta.values[1, 250:150:-20, -1],
+        )
+        assert len(entries) == 2
+        entries.clear()
+        loaded = reader.to_inference_data()
+        theta = loaded.posterior.theta[:, 120:180].values
+        assert np.array_equal(theta, data.posterior.theta[:, 120:180].values)
+        assert len(entries) == 1
+        entries.clear()
+        for school in range(3):
+            assert float(loaded.observed_data.obs[school]) == float(data.observed_data.obs[school])
+        assert len(entries) == 1
+
+    # models in a flat multi-model archive
+    multi_arviz_to_json({"centered": data}, "multimodel.zip", layout="flat")
+    loaded = json_to_arviz("multimodel.zip", prefix="centered/")
+    assert np.array_equal(loaded.posterior.tau.values, data.posterior.tau.values)
+
+
 def test_extract_dag():
     import pymc3 as pm
 
@@ -148,3 +920,156 @@ def test_extract_dag():
     assert dag["y_obs"]["distribution"]["type"] == "Normal"
     assert dag["left_slope"]["distribution"]["type"] == "Normal"
 
+
+def test_deterministic_chain():
+    import time
+    import pymc3 as pm
+
+    # each deterministic is the only parent of the next, so only the last one
+    # is a parent of the likelihood; this used to take exponential time
+    with pm.Model() as model:
+        x = pm.Normal("x", mu=0, sd=1)
+        sd = pm.HalfNormal("sd", sd=1)
+        chain = [pm.Deterministic("d0", x + 1)]
+        for i in range(1, 25):
+            chain.append(pm.Deterministic(f"d{i}", chain[-1] * 0.5 + chain[-1] ** 2))
+        pm.Normal("y", mu=chain[-1], sd=sd, observed=np.ones(10))
+    start = time.perf_counter()
+    dag = get_dag(model)
+    assert time.perf_counter() - start < 10
+    assert dag["d0"]["parents"] == ["x"]
+    for i in range(1, 25):
+        assert dag[f"d{i}"]["parents"] == [f"d{i - 1}"]
+    assert sorted(dag["y"]["parents"]) == ["d24", "sd"]
+
+
+def test_dag_cache():
+    import pymc3 as pm
+
+    with pm.Model() as model:
+        a = pm.Normal("a", mu=0, sd=1)
+        b = pm.Deterministic("b", a * 2)
+    dag = get_dag(model)
+    # a cached dag is returned as a copy
+    dag["b"]["parents"].append("c")
+    assert get_dag(model)["b"]["parents"] == ["a"]
+
+    # an identical model has the same hash; a changed model does not
+    with pm.Model() as same:
+        a = pm.Normal("a", mu=0, sd=1)
+        b = pm.Deterministic("b", a * 2)
+    assert model_hash(same) == model_hash(model)
+    with model:
+        pm.Normal("c", mu=b, sd=3)
+    assert model_hash(same) != model_hash(model)
+    assert get_dag(model)["c"]["parents"] == ["b"]
+
+    # models that differ only in shape= have different hashes and DAGs
+    with pm.Model() as vector:
+        pm.Normal("d", mu=0, sd=1, shape=3)
+    with pm.Model() as longer:
+        pm.Normal("d", mu=0, sd=1, shape=5)
+    assert model_hash(vector) != model_hash(longer)
+    assert get_dag(vector)["d"]["size"] == 3
+    assert get_dag(longer)["d"]["size"] == 5
+    assert get_dag(longer)["d"]["distribution"]["shape"] == [5]
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+
+    # writing archives should not need PyMC3, Theano, ArviZ or xarray
+    script = (
+        "import sys, arviz_json; arviz_json.arviz_to_json; "
+        "print(sorted({'pymc3', 'theano', 'arviz', 'xarray'} & set(sys.modules)), "
+        "'get_dag' in dir(arviz_json))"
+    )
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=package_dir)
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True)
+    assert output.stdout.decode().strip() == "[] True"
+
+    # a star import binds the lazy names as well, importing their modules
+    pytest.importorskip("pymc3")
+    script = "from arviz_json import *; print(json_to_arviz.__module__, NpzReader.__name__)"
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True)
+    assert output.stdout.decode().strip() == "arviz_json.reader NpzReader"
+
+
+def test_server():
+    data = az.load_arviz_data("centered_eight")
+    shutil.rmtree("served_store", ignore_errors=True)
+    arviz_to_json(data, "first.npz", store="served_store")
+    # arrays already in the store are only referenced from the header
+    arviz_to_json(data, "served.npz", store="served_store")
+    server = ArchiveServer("served.npz", ("127.0.0.1", 0), cache_bytes=2 ** 20)
+    server.quiet = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+
+    def get(path, **headers):
+        request = urllib.request.Request(url + path, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, b""
+
+    try:
+        status, headers, body = get("header.json")
+        assert status == 200 and headers["Content-Type"] == "application/json"
+        header = json.loads(body)
+        assert header["external"] and header == json.loads(zipfile.ZipFile("served.npz").read("header.json"))
+        name = header["inference_data"]["posterior"]["vars"]["theta"]["array_name"]
+        status, _, body = get(name + ".npy")
+        stored = np.load(io.BytesIO(body))
+        assert status == 200 and stored.shape == data.posterior.theta.shape
+        reader = NpzReader("served.npz")
+        assert np.array_equal(stored, reader.read_entry(name))
+
+        status, headers, part = get(name + ".npy", Range="bytes=10-19")
+        assert status == 206 and part == body[10:20]
+        assert headers["Content-Range"] == "bytes 10-19/%d" % len(body)
+        assert get(name + ".npy", Range="bytes=-5")[2] == body[-5:]
+        assert get(name + ".npy", Range="bytes=%d-" % len(body))[0] == 416
+
+        etag = get(name + ".npy")[1]["ETag"]
+        assert get(name + ".npy", **{"If-None-Match": etag})[0] == 304
+        assert get("nope.npy")[0] == 404
+        etag = get("header.json")[1]["ETag"]
+        assert get("header.json", **{"If-None-Match": etag})[0] == 304
+        assert get("archive.npz")[2] == open("served.npz", "rb").read()
+
+        # a rewritten archive is reopened, with new ETags
+        arviz_to_json(data, "served.npz", var_names="theta")
+        status, headers, _ = get("header.json", **{"If-None-Match": etag})
+        assert status == 200 and headers["ETag"] != etag
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # a flat multi model archive with shared, deduplicated arrays; entries too
+    # large for the cache are only decompressed to send a body
+    multi_arviz_to_json({"a": data, "b": data}, "served.zip", layout="flat", dedup=True)
+    server = ArchiveServer("served.zip", ("127.0.0.1", 0), cache_bytes=1000)
+    server.quiet = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    try:
+        header = json.loads(get("a/header.json")[2])
+        name = header["inference_data"]["posterior"]["vars"]["theta"]["array_name"]
+        target = header["links"][name]
+        assert target.startswith("objects/") and get("a/" + target + ".npy")[0] == 404
+        status, _, body = get(target + ".npy")
+        assert status == 200
+        expected = zipfile.ZipFile("served.zip").read(target + ".npy")
+        assert body == expected and len(body) > 1000
+        request = urllib.request.Request(url + target + ".npy", method="HEAD")
+        with urllib.request.urlopen(request) as response:
+            assert int(response.headers["Content-Length"]) == len(expected)
+        assert get(target + ".npy", Range="bytes=100-199")[2] == expected[100:200]
+        assert len(server.cache._entries) == 0
+    finally:
+        server.shutdown()
+        server.server_close()